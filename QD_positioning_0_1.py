@@ -1,6 +1,7 @@
 # Script for controlling the whole setup automagically
 import ThorlabsCam as TC
-import SLM, QD_tracking
+import SLM, QD_tracking, SLM_worker, SLM_precompiler, SLM_trajectory, SLM_output
+import particle_tracking
 import ThorlabsMotor as TM
 import TemperatureControllerTED4015
 import find_particle_threshold as fpt
@@ -88,12 +89,22 @@ def start_threads(c_p, thread_list):
             print('Could not start motor z thread')
 
     if c_p['slm']:
-        slm_thread =CreatePhasemaskThread(5,'Thread-SLM')
+        append_c_p(c_p, SLM.get_SLM_c_p())
+        mask_shape = (c_p['phasemask_height'], c_p['phasemask_width'])
+        if np.shape(c_p['phasemask']) != mask_shape:
+            c_p['phasemask'] = np.zeros(mask_shape)
+        c_p['SLM_output'] = SLM_output.get_phasemask_output(c_p)
+        if c_p['SLM_worker_process']:
+            slm_thread = SLM_worker.CreatePhasemaskProcessThread(5,
+                'Thread-SLM', c_p, mask_shape=mask_shape)
+        else:
+            slm_thread = SLM.CreatePhasemaskThread(5, 'Thread-SLM', c_p)
         slm_thread.start()
         thread_list.append(slm_thread)
         print('SLM thread started')
 
     if c_p['tracking']:
+        append_c_p(c_p, particle_tracking.get_tracking_c_p())
         tracking_thread = ExperimentControlThread(6,'Tracker_thread')
         tracking_thread.start()
         thread_list.append(tracking_thread)
@@ -201,6 +212,7 @@ def start_threads(c_p, thread_list):
 
     if c_p['QD_tracking']:
         append_c_p(c_p, QD_tracking.get_QD_tracking_c_p())
+        append_c_p(c_p, particle_tracking.get_tracking_c_p())
 
         try:
             QD_Tracking_Thread = QD_tracking.QD_Tracking_Thread(
@@ -637,7 +649,7 @@ class UserInterface:
                 self.new.focus()
         except:
             self.new = tkinter.Toplevel(self.window)
-            self.SLM_Window = _class(self.new)
+            self.SLM_Window = _class(c_p, self.new)
 
     def get_temperature_info(self):
         global c_p
@@ -954,17 +966,29 @@ class SLM_window(Frame):
         self.master.geometry("1920x1080+1920+0")
         self.pack(fill=BOTH, expand=1)
 
-        render = PIL.ImageTk.PhotoImage(image=PIL.Image.fromarray(c_p['phasemask']))
+        self.c_p = c_p
+        render = PIL.ImageTk.PhotoImage(image=self.get_phasemask_image())
         self.img = Label(self, image=render)
         self.img.place(x=420, y=0)
         self.img.image = image
         self.delay = 500 # Delay in ms
-        self.c_p = c_p
         self.update()
 
+    def get_phasemask_image(self):
+        '''
+        Image of the current phasemask. Uses the uint8 display buffer of
+        c_p['SLM_output'] without copying it if available.
+        '''
+        output = self.c_p.get('SLM_output', None)
+        if output is None:
+            return PIL.Image.fromarray(self.c_p['phasemask'])
+        buffer = output.get_display_buffer(self.c_p['phasemask'])
+        height, width = np.shape(buffer)
+        return PIL.Image.frombuffer('L', (width, height), buffer, 'raw', 'L', 0, 1)
+
     def update(self):
         # This implementation does work but is perhaps a tiny bit janky
-        self.photo = PIL.ImageTk.PhotoImage(image=PIL.Image.fromarray(self.c_p['phasemask']))
+        self.photo = PIL.ImageTk.PhotoImage(image=self.get_phasemask_image())
         del self.img.image
         self.img = Label(self, image=self.photo)
         self.img.image = self.photo
@@ -993,10 +1017,25 @@ class ExperimentControlThread(threading.Thread):
         self.threadID = threadID
         self.name = name
         self.setDaemon(True)
+        self.tracker = particle_tracking.ROITracker(self.find_particles,
+            c_p['ROI_half_width'], c_p['ROI_margin'],
+            c_p['ROI_full_frame_interval'])
+        self.linker = particle_tracking.get_linker(c_p)
 
    def __del__(self):
        c_p['tracking_on'] = False
 
+   def find_particles(self, image):
+        '''
+        Detects the particles in image, or a part of it, with the current
+        thresholds.
+        '''
+        x, y, _ = fpt.find_particle_centers(image,
+                  threshold=c_p['particle_threshold'],
+                  particle_size_threshold=c_p['particle_size_threshold'],
+                  bright_particle=c_p['bright_particle'])
+        return x, y
+
    def catch_particle(self, min_index_trap=None, min_index_particle=None):
         '''
         Function for determimning where and how to move when min_index_particle
@@ -1006,8 +1045,13 @@ class ExperimentControlThread(threading.Thread):
         if min_index_particle is not None:
           c_p['target_trap_pos'] = [c_p['traps_relative_pos'][0][min_index_trap],
                                     c_p['traps_relative_pos'][1][min_index_trap]]
-          c_p['target_particle_center'] = [c_p['particle_centers'][0][min_index_particle],
-                                            c_p['particle_centers'][1][min_index_particle]]
+          # Aim at where the particle will be when the motors have moved
+          predicted = particle_tracking.predict_particle_centers(c_p,
+              c_p['motor_latency'])
+          if predicted is None:
+              predicted = c_p['particle_centers']
+          c_p['target_particle_center'] = [predicted[0][min_index_particle],
+                                            predicted[1][min_index_particle]]
 
           if True in c_p['traps_occupied']:
               c_p['xy_movement_limit'] = 40
@@ -1066,16 +1110,20 @@ class ExperimentControlThread(threading.Thread):
         '''
         Checks if all traps are occupied. Returns true if this is the case.
         Tries to catch the closes unoccupied particle.
+        Unless a tracking_func is given the particles are tracked in windows
+        around their previous positions and the traps, see
+        particle_tracking.ROITracker.
         '''
-        if tracking_func is None:
-            x, y = fpt.find_particle_centers(copy.copy(image),
-                      threshold=c_p['particle_threshold'],
-                      particle_size_threshold=c_p['particle_size_threshold'],
-                      bright_particle=c_p['bright_particle'])
-        else:
+        image = c_p['image']
+        if tracking_func is not None:
             x, y = tracking_func(copy.copy(image))
+        elif c_p['ROI_tracking']:
+            x, y = self.tracker.track(image, c_p['traps_relative_pos'],
+                particle_tracking.predict_particle_centers(c_p))
+        else:
+            x, y = self.find_particles(copy.copy(image))
 
-        c_p['particle_centers'] = [x, y]
+        particle_tracking.update_particle_centers(c_p, self.linker, x, y)
         c_p['traps_occupied'] = [False for i in range(len(c_p['traps_absolute_pos'][0]))]
         min_index_trap, min_index_particle = find_closest_unoccupied()
 
@@ -1100,6 +1148,8 @@ class ExperimentControlThread(threading.Thread):
 
         snapshot(c_p['measurement_name']+'_pre'+time_stamp)
         zoom_in()
+        self.tracker.reset() # The particles moved in the image
+        self.linker.reset()
         c_p['recording'] = True
         patiance = 50
         patiance_counter = 0
@@ -1116,6 +1166,8 @@ class ExperimentControlThread(threading.Thread):
                 break
         c_p['recording'] = False
         zoom_out()
+        self.tracker.reset()
+        self.linker.reset()
         snapshot(c_p['measurement_name']+'_after'+time_stamp)
         if time.time() >= start + duration:
             return 0
@@ -1128,18 +1180,11 @@ class ExperimentControlThread(threading.Thread):
        # Update number of ghost traps.
        c_p['nbr_ghost_traps'] = len(ghost_traps_x)
 
-       # Convert traps positions to SLM positions.
-       if min(ghost_traps_x) >= 1:
-           ghost_traps_x = pixels_to_SLM_locs(ghost_traps_x, 0)
-       if min(ghost_traps_y) >= 1:
-           ghost_traps_y = pixels_to_SLM_locs(ghost_traps_y, 1)
-       if ghost_traps_z is None:
-           ghost_traps_z = np.zeros(c_p['nbr_ghost_traps'])
-
-       # Append ghost traps to xm, ym and zm
-       c_p['xm'] += ghost_traps_x
-       c_p['ym'] += ghost_traps_y
-       c_p['zm'] += ghost_traps_z
+       # Append ghost traps to xm, ym and zm, the same way as when the
+       # phasemasks are precompiled.
+       c_p['xm'], c_p['ym'], c_p['zm'] = SLM_precompiler.append_ghost_traps(
+           c_p['xm'], c_p['ym'], c_p['zm'], ghost_traps_x, ghost_traps_y, c_p,
+           ghost_traps_z)
 
        # Update the phasemask
        c_p['new_phasemask'] = True
@@ -1172,6 +1217,10 @@ class ExperimentControlThread(threading.Thread):
         global c_p
         c_p['nbr_experiments'] = len(c_p['experiment_schedule'])
         c_p['experiment_progress'] = 0
+        if c_p['slm'] and c_p['SLM_precompile']:
+            # Calculate the phasemasks of all experiments while recording
+            precompiler = SLM_precompiler.PhasemaskPrecompiler(c_p)
+            precompiler.start()
 
         while c_p['program_running']: # Change to continue tracking?
             time.sleep(0.3)
@@ -1425,9 +1474,11 @@ def update_c_p(update_dict, wait_for_completion=True):
     ok_parameters = ['use_LGO', 'LGO_order', 'xm', 'ym', 'zm', 'setpoint_temperature',
     'recording_duration', 'target_experiment_z', 'SLM_iterations',
     'temperature_output_on','activate_traps_one_by_one','need_T_stable',
-    'measurement_name','phasemask','QD_target_loc_x','QD_target_loc_y']
+    'measurement_name','phasemask','QD_target_loc_x','QD_target_loc_y',
+    'SLM_decimation','SLM_camera_feedback']
 
-    requires_new_phasemask = ['use_LGO', 'LGO_order', 'xm', 'ym', 'zm', 'SLM_iterations']
+    requires_new_phasemask = ['use_LGO', 'LGO_order', 'xm', 'ym', 'zm', 'SLM_iterations',
+    'SLM_decimation']
 
     for key in update_dict:
         if key in ok_parameters:
@@ -1571,22 +1622,19 @@ def get_particle_trap_distances():
     '''
     global c_p
     update_traps_relative_pos(c_p) # just in case
-    nbr_traps = len(c_p['traps_relative_pos'][0])
-    nbr_particles = len(c_p['particle_centers'][0])
-    distances = np.ones((nbr_traps, nbr_particles))
-
-    for i in range(nbr_traps):
-        for j in range(nbr_particles):
-            dx = (c_p['traps_relative_pos'][0][i] - c_p['particle_centers'][0][j])
-            dy = (c_p['traps_relative_pos'][1][i] - c_p['particle_centers'][1][j])
-            distances[i,j] = np.sqrt(dx * dx + dy * dy)
-    return distances
+    dx = np.subtract.outer(np.asarray(c_p['traps_relative_pos'][0], dtype=float),
+                           np.asarray(c_p['particle_centers'][0], dtype=float))
+    dy = np.subtract.outer(np.asarray(c_p['traps_relative_pos'][1], dtype=float),
+                           np.asarray(c_p['particle_centers'][1], dtype=float))
+    return np.sqrt(dx * dx + dy * dy)
 
 
 def trap_occupied(distances, trap_index):
     '''
     Checks if a specific trap is occupied by a particle. If so set that trap to occupied.
     Updates if the trap is occupied or not and returns the index of the particle in the trap
+    If the particles have track IDs the particle which was in the trap before
+    is preferred, otherwise the closest one.
     '''
     global c_p
 
@@ -1594,11 +1642,19 @@ def trap_occupied(distances, trap_index):
     if trap_index > len(c_p['traps_occupied']) or trap_index < 0:
         print('Trap index out of range')
         return None
-    for i in range(len(distances[trap_index, :])):
-        dist_to_trap = distances[trap_index, i]
-        if dist_to_trap <= c_p['movement_threshold']:
-            c_p['traps_occupied'][trap_index] = True
-            return i
+    in_trap = np.flatnonzero(distances[trap_index, :] <= c_p['movement_threshold'])
+    ids = particle_tracking.get_particle_ids(c_p)
+    trapped_ids = c_p.setdefault('trapped_particle_ids', {})
+    if len(in_trap) > 0:
+        c_p['traps_occupied'][trap_index] = True
+        particle_index = in_trap[np.argmin(distances[trap_index, in_trap])]
+        if ids is not None:
+            for i in in_trap:
+                if ids[i] == trapped_ids.get(trap_index):
+                    particle_index = i
+            trapped_ids[trap_index] = ids[particle_index]
+        return particle_index
+    trapped_ids.pop(trap_index, None)
     try:
         c_p['traps_occupied'][trap_index] = False
         return None
@@ -1873,12 +1929,7 @@ def pixels_to_SLM_locs(locs, axis):
     Function for converting from PIXELS to SLM locations.
     '''
     global c_p
-    if axis != 0 and axis != 1:
-        print('cannot perform conversion, incorrect choice of axis')
-        return locs
-    offset = c_p['slm_x_center'] if not axis else c_p['slm_y_center']
-    new_locs = [((x - offset) / c_p['slm_to_pixel']) for x in locs]
-    return new_locs
+    return SLM_precompiler.pixels_to_SLM_locs(locs, axis, c_p)
 
 
 def SLM_loc_to_trap_loc(xm, ym):
@@ -1887,17 +1938,14 @@ def SLM_loc_to_trap_loc(xm, ym):
     on the SLM.
     '''
     global c_p
-    tmp_x = [x * c_p['slm_to_pixel'] + c_p['slm_x_center'] for x in xm]
-    tmp_y = [y * c_p['slm_to_pixel'] + c_p['slm_y_center'] for y in ym]
-    tmp = np.asarray([tmp_x, tmp_y])
-    c_p['traps_absolute_pos'] = tmp
-    print('Traps are at: ', c_p['traps_absolute_pos'] )
-    update_traps_relative_pos(c_p)
+    SLM.SLM_loc_to_trap_loc(c_p, xm, ym)
 
 
 def save_phasemask():
     # Helperfunction for saving the SLM.
     # Should probably save parameters of this at same time as well.
+    # The phasemask cache is filled by the PhasemaskCalculator, which knows
+    # whether the phasemask was warm started or corrected by camera feedback.
     global c_p
 
     now = datetime.now()
@@ -1938,36 +1986,68 @@ def move_particles_slowly(last_d=30e-6):
     return
 
 
+def move_traps_along_trajectory(xm_end, ym_end, nbr_steps=20, rate=None,
+    wait_for_completion=True):
+    '''
+    Moves the traps from their current positions to xm_end, ym_end in
+    nbr_steps steps. All phasemasks are calculated before the traps start to
+    move and are then shown at rate phasemasks per second
+    (c_p['SLM_trajectory_rate'] if None) so the speed is set by how fast the
+    particles can follow rather than by the phasemask calculations.
+    Positions larger than 1 are treated as pixels, as in update_c_p.
+    '''
+    global c_p
+    if min(xm_end) > 1:
+        xm_end = pixels_to_SLM_locs(xm_end, 0)
+    if min(ym_end) > 1:
+        ym_end = pixels_to_SLM_locs(ym_end, 1)
+    layouts = SLM_trajectory.get_trajectory(c_p['xm'], c_p['ym'], xm_end, ym_end,
+        nbr_steps, zm_start=c_p['zm'], zm_end=c_p['zm'])
+    if layouts is None:
+        return
+    phasemasks, reports = SLM_trajectory.calculate_trajectory(layouts,
+        SLM.get_phasemask_parameters(c_p), image_width=c_p['phasemask_width'],
+        image_height=c_p['phasemask_height'],
+        aperture_radius=c_p['SLM_aperture_radius'])
+    streamer = SLM_trajectory.TrajectoryStreamer(c_p, phasemasks, layouts,
+        rate=rate, step_callback=SLM_loc_to_trap_loc)
+    streamer.start()
+    if wait_for_completion:
+        streamer.join()
+
+
 ############### Main script starts here ####################################
-c_p = get_default_c_p()
-c_p['camera_model'] = 'basler_large'#'ThorlabsCam'
+# Guarded since the SLM worker process imports this module on Windows.
+if __name__ == '__main__':
+    c_p = get_default_c_p()
+    c_p['camera_model'] = 'basler_large'#'ThorlabsCam'
 
 
-# Create a empty list to put the threads in
-thread_list = []
-d0x = -80e-6
-d0y = -80e-6
+    # Create a empty list to put the threads in
+    thread_list = []
+    d0x = -80e-6
+    d0y = -80e-6
 
-# Define experiment to be run. Can also be read from a file nowadays.
-xm1, ym1 = SLM.get_xm_ym_rect(nbr_rows=2, nbr_columns=1, d0x=d0x, d0y=d0y, dx=20e-6, dy=20e-6,)
-experiment_schedule = [
-{'xm':xm1, 'ym':ym1, 'use_LGO':[False],'target_experiment_z':1000,
-'LGO_order':4,  'recording_duration':1000,' SLM_iterations':30,'activate_traps_one_by_one':False},
-]
+    # Define experiment to be run. Can also be read from a file nowadays.
+    xm1, ym1 = SLM.get_xm_ym_rect(nbr_rows=2, nbr_columns=1, d0x=d0x, d0y=d0y, dx=20e-6, dy=20e-6,)
+    experiment_schedule = [
+    {'xm':xm1, 'ym':ym1, 'use_LGO':[False],'target_experiment_z':1000,
+    'LGO_order':4,  'recording_duration':1000,' SLM_iterations':30,'activate_traps_one_by_one':False},
+    ]
 
-c_p['experiment_schedule'] = experiment_schedule
-append_c_p(c_p,get_thread_activation_parameters())
+    c_p['experiment_schedule'] = experiment_schedule
+    append_c_p(c_p,get_thread_activation_parameters())
 
-c_p['stage_stepper_x'] = True
-c_p['stage_stepper_y'] = True
-c_p['stage_stepper_z'] = True
-# c_p['stage_piezo_x'] = True
-# c_p['stage_piezo_y'] = True
-# c_p['stage_piezo_z'] = True
-c_p['arduino_LED'] = True
-c_p['QD_tracking'] = True
+    c_p['stage_stepper_x'] = True
+    c_p['stage_stepper_y'] = True
+    c_p['stage_stepper_z'] = True
+    # c_p['stage_piezo_x'] = True
+    # c_p['stage_piezo_y'] = True
+    # c_p['stage_piezo_z'] = True
+    c_p['arduino_LED'] = True
+    c_p['QD_tracking'] = True
 
 
-T_D = UserInterface(tkinter.Tk(), "Control display", c_p, thread_list)
+    T_D = UserInterface(tkinter.Tk(), "Control display", c_p, thread_list)
 
-sys.exit()
+    sys.exit()
@@ -3,25 +3,117 @@ import numpy as np
 import cv2
 from find_particle_threshold import find_particle_centers
 from numba import jit
-from threading import  Thread
+from threading import  Thread, Lock
 from time import sleep, time
+from functools import lru_cache
+from collections import OrderedDict
+import os, pickle
 import pyfftw
+from particle_tracking import ROITracker, get_linker, get_particle_ids, \
+    update_particle_centers, predict_particle_centers
 pyfftw.interfaces.cache.enable()
 # TODO incorporate also radial symmetry in the tracking.
 
 
-def get_fft_object(image_shape):
+# FFTW plans are created lazily, one per image shape, since measuring a plan
+# for a full 3008x3600 frame takes seconds. Until the measured plan of a new
+# shape is ready, created in a background thread, a quickly estimated plan is
+# used so that changing the AOI never stalls the tracking. The measurements
+# are saved as FFTW wisdom so that later sessions can create the measured
+# plans directly.
+wisdom_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'FFTW_wisdom.pickle')
+max_fft_objects = 4 # Number of image shapes to keep plans for
+fft_objects = OrderedDict()
+fft_lock = Lock()
+measuring_shapes = set()
+wisdom_loaded = False
+
+
+def load_wisdom(path=None):
+    '''
+    Loads FFTW wisdom saved by save_wisdom. Returns True if successful.
+    '''
+    path = wisdom_file if path is None else path
+    try:
+        with open(path, 'rb') as f:
+            pyfftw.import_wisdom(pickle.load(f))
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+        print('Could not load FFTW wisdom', e)
+        return False
+    return True
+
+
+def save_wisdom(path=None):
+    '''
+    Saves the wisdom of the FFTW plans measured so far.
+    '''
+    path = wisdom_file if path is None else path
+    try:
+        with open(path, 'wb') as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+    except OSError as e:
+        print('Could not save FFTW wisdom', e)
+
+
+def create_fft_object(image_shape, flags=('FFTW_MEASURE',)):
     a = pyfftw.empty_aligned(image_shape, dtype='complex64')
     b = pyfftw.empty_aligned(image_shape, dtype='complex64')
-
     # Over the both axes
-    print('Creating FFT object')
-    fft_object = pyfftw.FFTW(a, b, axes=(0,1))
-    print('FFTW object returned')
-    return fft_object
+    return pyfftw.FFTW(a, b, axes=(0,1), flags=flags)
+
+
+def store_fft_object(image_shape, fft_object):
+    # Adds a plan to the cache, dropping the least recently used ones.
+    with fft_lock:
+        fft_objects[image_shape] = fft_object
+        fft_objects.move_to_end(image_shape)
+        while len(fft_objects) > max_fft_objects:
+            fft_objects.popitem(last=False)
 
-image_shape = [3008, 3600]
-fft_object = get_fft_object(image_shape)
+
+def measure_fft_object(image_shape):
+    # Replaces the estimated plan of image_shape with a measured one.
+    print('Measuring FFTW plan for', image_shape)
+    fft_object = create_fft_object(image_shape)
+    # The wisdom is useful even if the shape is no longer in use
+    save_wisdom()
+    with fft_lock:
+        measuring_shapes.discard(image_shape)
+        if image_shape not in fft_objects:
+            return
+    store_fft_object(image_shape, fft_object)
+    print('FFTW plan for', image_shape, 'ready')
+
+
+def get_fft_object(image_shape):
+    '''
+    Returns a forward FFTW plan over both axes of complex64 images of
+    image_shape. The plan's arrays are shared between calls.
+    '''
+    global wisdom_loaded
+    image_shape = tuple(image_shape)
+    with fft_lock:
+        if image_shape in fft_objects:
+            fft_objects.move_to_end(image_shape)
+            return fft_objects[image_shape]
+        if not wisdom_loaded:
+            wisdom_loaded = True
+            load_wisdom()
+    try:
+        fft_object = create_fft_object(image_shape,
+                                       ('FFTW_MEASURE', 'FFTW_WISDOM_ONLY'))
+    except RuntimeError:
+        # No wisdom for this shape, measure a plan in the background
+        fft_object = create_fft_object(image_shape, ('FFTW_ESTIMATE',))
+        with fft_lock:
+            measure = image_shape not in measuring_shapes
+            measuring_shapes.add(image_shape)
+        if measure:
+            Thread(target=measure_fft_object, args=(image_shape,),
+                   daemon=True).start()
+    store_fft_object(image_shape, fft_object)
+    return fft_object
 
 
 @jit
@@ -56,13 +148,23 @@ def create_circular_mask_inverse(h, w, center=None, radius=100):
     mask = dist_from_center >= radius
     return mask
 
-# Create default mask to speed things up
-filter_radii = [20, 100]
-s = [0,0]
-s[0] = int(image_shape[1]/2)
-s[1] = int(image_shape[0]/2)
-mask = create_circular_mask(image_shape[0],image_shape[1],s,filter_radii[0])
-outer_mask = create_circular_mask_inverse(image_shape[0],image_shape[1],s,filter_radii[1])
+@lru_cache(maxsize=8)
+def get_filter_mask(image_shape, inner_filter_width, outer_filter_width):
+    '''
+    Frequencies removed by fourier_filter, True in the center and outside of
+    the outer filter width of the shifted spectrum. Returned unshifted, in the
+    layout of the FFT output, and read only.
+    '''
+    s = [0,0]
+    s[0] = int(image_shape[1] / 2)
+    s[1] = int(image_shape[0] / 2)
+    mask = create_circular_mask(image_shape[0], image_shape[1], s,
+                                inner_filter_width)
+    mask |= create_circular_mask_inverse(image_shape[0], image_shape[1], s,
+                                         outer_filter_width)
+    mask = np.fft.ifftshift(mask)
+    mask.setflags(write=False)
+    return mask
 
 def fourier_filter(image, inner_filter_width=20, outer_filter_width=100):
     '''
@@ -74,38 +176,22 @@ def fourier_filter(image, inner_filter_width=20, outer_filter_width=100):
         inner_filter_width - How many elements in the middle of the fourier-transformed image should be removed
         outer_filter_width -
     Outputs:
-        Filtered image
+        Filtered image, flipped in both directions since the forward
+        transform is used twice. Shared with later calls of the same size.
     '''
-    # Make use of global object to avoid having to recreate them at each call.
-    global image_shape, mask, outer_mask, filter_radii, fft_object
-
-    d = np.shape(image)
-
-    if not d == image_shape or not inner_filter_width == filter_radii[0]\
-        or not outer_filter_width == filter_radii[1]:
-        s = [0,0]
-        s[0] = int(d[1] / 2)
-        s[1] = int(d[0] / 2)
-        filter_radii[0] = inner_filter_width
-        mask = create_circular_mask(d[0], d[1], s, inner_filter_width)
-
-        filter_radii[1] = outer_filter_width
-        outer_mask = create_circular_mask_inverse(d[0], d[1], s, outer_filter_width)
-
-    if not d == image_shape:
-        image_shape = d
-        fft_object = get_fft_object(image_shape)
-
-    ff = fft_object(image)
-    fshift = np.fft.fftshift(ff)
+    # The FFT objects and masks are cached per image shape.
+    d = tuple(np.shape(image))
+    fft_object = get_fft_object(d)
+    mask = get_filter_mask(d, inner_filter_width, outer_filter_width)
 
-
-    fshift[mask] = 0 # set center to 0
-    fshift[outer_mask] = 0 # set outer region to 0
-
-    inv = np.fft.ifftshift(fshift)
-    inv = fft_object(inv)
-    return inv
+    # The arrays are copied into the input array of the plan explicitly since
+    # calling it with an array of the right type would make the plan use
+    # that array as its input from then on.
+    fft_object.input_array[:] = image
+    ff = fft_object()
+    ff[mask] = 0 # set center and outer region to 0
+    fft_object.input_array[:] = ff
+    return fft_object()
 
 
 def find_QDs(image, inner_filter_width=15, outer_filter_width=300,threshold=0.11,
@@ -171,13 +257,19 @@ def get_QD_tracking_c_p():
 def is_trapped(c_p, trap_dist):
     '''
     Calculate distance between trap and particle centers.
+    Returns if the closest QD is within trap_dist of the trap and its track
+    ID, or its index in c_p['particle_centers'] if the QDs are not linked.
     '''
     if len(c_p['particle_centers'][0]) < 1:
         return False, None
-    dists_x = np.asarray(c_p['particle_centers'][0] - c_p['traps_absolute_pos'][0][0])
-    dists_y = np.asarray(c_p['particle_centers'][1] - c_p['traps_absolute_pos'][1][0])
+    dists_x = np.asarray(c_p['particle_centers'][0]) - c_p['traps_absolute_pos'][0][0]
+    dists_y = np.asarray(c_p['particle_centers'][1]) - c_p['traps_absolute_pos'][1][0]
     dists_tot = dists_x**2 + dists_y**2
-    return min(dists_tot) < trap_dist
+    closest = int(np.argmin(dists_tot))
+    ids = get_particle_ids(c_p)
+    if ids is not None:
+        closest = ids[closest]
+    return dists_tot.min() < trap_dist**2, closest
 
 class QD_Tracking_Thread(Thread):
    '''
@@ -191,6 +283,11 @@ class QD_Tracking_Thread(Thread):
         self.c_p = c_p
         self.sleep_time = sleep_time
         self.setDaemon(True)
+        # find_QDs discards tracking_edge pixels at the border of the images
+        self.tracker = ROITracker(self.find_QDs_in_window,
+            c_p['ROI_half_width'], c_p['ROI_margin'] + c_p['tracking_edge'],
+            c_p['ROI_full_frame_interval'])
+        self.linker = get_linker(c_p)
 
    def __del__(self):
        self.c_p['tracking_on'] = False
@@ -214,9 +311,13 @@ class QD_Tracking_Thread(Thread):
        # Has been solved by setting the paramter 'piezo_move_to_target' to true
        pass
 
+       # Aim with the position the QD is predicted to have when the piezos
+       # have moved rather than assuming it is at the center of the trap.
+       offset_x, offset_y = self.get_QD_offset()
+
        # Update target position of piezo in x-direction
        x_move = self.c_p['QD_target_loc_x'][self.c_p['nbr_quantum_dots_stuck']] - \
-            self.c_p['piezo_current_position'][0]
+            self.c_p['piezo_current_position'][0] - offset_x
        if x_move < 0:
            self.c_p['piezo_target_pos'][0] += max(x_move, -self.c_p['step_size'])
        else:
@@ -224,12 +325,28 @@ class QD_Tracking_Thread(Thread):
 
        # Update target position of piezo in y-direction
        y_move = self.c_p['QD_target_loc_y'][self.c_p['nbr_quantum_dots_stuck']] - \
-            self.c_p['piezo_current_position'][1]
+            self.c_p['piezo_current_position'][1] - offset_y
        if y_move < 0:
            self.c_p['piezo_target_pos'][1] += max(y_move, -self.c_p['step_size'])
        else:
            self.c_p['piezo_target_pos'][1] += min(y_move, self.c_p['step_size'])
 
+   def get_QD_offset(self):
+       '''
+       Position of the trapped QD relative to the trap, in piezo units, when
+       the piezos have moved. Predicted from its velocity, zero if the QD has
+       not been tracked.
+       '''
+       predicted = predict_particle_centers(self.c_p, self.c_p['piezo_latency'])
+       ids = get_particle_ids(self.c_p)
+       if predicted is None or self.c_p['closest_QD'] not in ids:
+           return 0, 0
+       index = ids.index(self.c_p['closest_QD'])
+       # Same conversion between pixels and piezo units as in extract_piezo_image
+       scale = 1000 / self.c_p['mmToPixel']
+       return (predicted[0][index] - self.c_p['traps_relative_pos'][0][0]) * scale, \
+           (predicted[1][index] - self.c_p['traps_relative_pos'][1][0]) * scale
+
    def look_for_quantum_dot(self):
        pass
 
@@ -284,6 +401,17 @@ class QD_Tracking_Thread(Thread):
 
        return self.c_p['image'][x_start:x_end, y_start:y_end], True
 
+   def find_QDs_in_window(self, image):
+       '''
+       Detects the quantum dots in a part of the camera image. The Fourier
+       filter widths are scaled with the size of the part so that the same
+       spatial frequencies as in the full frame are filtered out.
+       '''
+       scale = np.shape(image)[1] / np.shape(self.c_p['image'])[1]
+       return find_QDs(image, inner_filter_width=15*scale,
+                       outer_filter_width=300*scale,
+                       edge=self.c_p['tracking_edge'])[:2]
+
    def run(self):
 
        while self.c_p['program_running']:
@@ -297,10 +425,15 @@ class QD_Tracking_Thread(Thread):
                # if not image_extracted:
                #     pass
                print('Starting tracking ', np.shape(self.c_p['image']))
-               x, y = find_QDs(self.c_p['image'])
+               if self.c_p['ROI_tracking']:
+                   x, y = self.tracker.track(self.c_p['image'],
+                                             self.c_p['traps_relative_pos'],
+                                             predict_particle_centers(self.c_p))
+               else:
+                   x, y = find_QDs(self.c_p['image'])[:2]
                if len(x)>0:
                    print('x: ', x)
-               self.c_p['particle_centers'] = [x, y]
+               update_particle_centers(self.c_p, self.linker, x, y)
                # Check trapping status
                # self.trapped_now()
                #
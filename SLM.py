@@ -2,17 +2,29 @@ import numpy as np
 import matplotlib.pyplot as plt
 from math import ceil,pi
 from random import random
-from time import time
+from time import time, sleep
 from math import atan2
-from threading import Thread
+from threading import Thread, local, Lock
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+import pyfftw
+from SLM_phasemask_cache import PhasemaskCache, get_phasemask_key, \
+    phasemask_to_phase
 # TODO: investigate if we can change to smaller
 # datatypes to improve performance
-# See if smaller datatypes and upscaling can be used to improve performance
+
+# Optical parameters of the setup used when calculating delta.
+SLM_pixel_size = 9e-6
+focal_length = np.sqrt(2e-4*0.4) # Focal length of imaging system. Empirically found value
+laser_wavelength = 532e-9
 
 
 def atan2_vec_2d(Y, X):
     '''
     Function for calculating atan2 of 2 2d arrays of coordinate positions(X,Y)
+    Legacy function which loops over every element, use np.arctan2 instead.
+    Kept as reference for SLM_benchmark.
 
     Parameters
     ----------
@@ -40,26 +52,47 @@ def atan2_vec_2d(Y, X):
         return None
 
 
-def get_LGO(image_width=1080, order=-8):
+def get_LGO(image_width=1080, order=-8, image_height=None, center=None):
     '''
     Parameters
     ----------
-    image_width : TYPE, optional
-        DESCRIPTION. The default is 1080.
+    image_width : int, optional
+        Width of the phasemask in pixels. The default is 1080.
+    order : int, optional
+        Order of the laguerre gaussian mode. The default is -8.
+    image_height : int, optional
+        Height of the phasemask in pixels. Defaults to image_width.
+    center : tuple, optional
+        (xc, yc) center of the vortex in pixels. Defaults to the center of the
+        phasemask.
 
     Returns
     -------
-    LGO : TYPE
+    LGO : 2d-array of shape (image_height, image_width)
         LGO, phase shift required to delta to get a laguerre gaussian instead of a gaussian.
+        The array is shared between calls with the same arguments and is
+        therefore read only, copy it before modifying it.
 
     '''
-
-    xc = image_width / 2
-    yc = image_width / 2
-    xxx,yyy = np.meshgrid(np.linspace(1, image_width, image_width),
-                    np.linspace(1, image_width, image_width))
-    LGO = np.mod((order * atan2_vec_2d(yyy-yc, xxx-xc)), (2*pi)) # Ther should maybe be a +pi before mod 2pi
-
+    if image_height is None:
+        image_height = image_width
+    if center is None:
+        center = (image_width / 2, image_height / 2)
+    return _get_LGO_cached(int(image_width), int(image_height), int(order),
+                           float(center[0]), float(center[1]))
+
+
+@lru_cache(maxsize=8)
+def _get_LGO_cached(image_width, image_height, order, xc, yc):
+    # Vortex phase calculated with broadcasting of the 1-d coordinate vectors
+    # rather than pixel by pixel with atan2_vec_2d.
+    xxx = np.linspace(1, image_width, image_width) - xc
+    yyy = np.reshape(np.linspace(1, image_height, image_height) - yc,
+                     (image_height, 1))
+    LGO = np.arctan2(yyy, xxx)
+    LGO *= order
+    np.mod(LGO, 2*pi, out=LGO) # Ther should maybe be a +pi before mod 2pi
+    LGO.setflags(write=False)
     return LGO
 
 
@@ -70,43 +103,669 @@ def RM(N, M, Delta,image_width):
 
 def RS(N, M, Delta):
     # Random Superposition Algorithm (SR)
-    RN = np.transpose(np.random.uniform(low=0.0, high=2*pi, size=(1,M)))*np.ones((1,N))
-    return np.angle(np.sum(np.exp(1j*(Delta+RN)),axis=0))+pi
+    # Sums one trap at a time to avoid M x N temporaries.
+    RN = np.random.uniform(low=0.0, high=2*pi, size=(1,M))
+    field = np.zeros(N, dtype=np.complex128)
+    for m in range(M):
+        field += np.exp(1j*(Delta[m]+RN[0, m]))
+    return np.angle(field)+pi
+
+
+def get_uniformity(V_abs):
+    '''
+    Uniformity of the trap amplitudes V_abs, 1 if all traps are equally
+    bright and 0 if at least one trap is dark.
+    '''
+    V_max = np.max(V_abs)
+    V_min = np.min(V_abs)
+    return 1 - (V_max - V_min) / (V_max + V_min)
+
+
+def get_efficiency(V_abs):
+    '''
+    Fraction of the light which ends up in the traps.
+    '''
+    return np.sum(V_abs**2)
+
+
+def get_feedback_weights(W, intensities, gain=1):
+    '''
+    New trap weights from measured trap intensities, e.g. from
+    measure_trap_intensities. Traps which are dimmer than average get a higher
+    weight: W * (mean(intensities) / intensities)^(gain/2), the square root
+    since the weights are amplitudes. Traps which were not seen at all get the
+    highest weight of the others.
+
+    Returns
+    -------
+    W : M x 1 array
+        The new weights, normalized to a mean of 1.
+    '''
+    intensities = np.ravel(np.asarray(intensities, dtype=float))
+    bright = intensities > 0
+    if not np.any(bright):
+        print('No trap intensities measured, keeping the weights')
+        return np.reshape(W, (-1, 1))
+    correction = np.ones(len(intensities))
+    correction[bright] = (np.mean(intensities[bright]) /
+                          intensities[bright])**(gain / 2)
+    correction[~bright] = np.max(correction[bright])
+    W = np.ravel(W) * correction
+    return np.reshape(W / np.mean(W), (-1, 1))
+
+
+def measure_trap_intensities(image, x, y, radius=3, background=None):
+    '''
+    Measures the brightness of traps in a camera image.
 
+    Parameters
+    ----------
+    image : array
+        Camera image, e.g. c_p['image'].
+    x, y : lists or arrays
+        Trap positions in image pixels, e.g. c_p['traps_relative_pos'][0] and
+        c_p['traps_relative_pos'][1].
+    radius : int, optional
+        Half width of the square around each trap which is summed.
+    background : float, optional
+        Background level of a pixel, the median of the image if None.
 
-def GSW(N, M, Delta=None, image_width=1080, nbr_iterations=30):
-    # Weighted Gerchberg-Saxton Algorithm (GSW)
+    Returns
+    -------
+    intensities : array
+        Background corrected sum of the pixels around each trap, at least 0.
+    '''
+    image = np.asarray(image, dtype=float)
+    if image.ndim == 3:
+        image = image[:, :, 0]
+    if background is None:
+        background = np.median(image)
+    height, width = np.shape(image)
+    intensities = np.zeros(len(x))
+    for index, (px, py) in enumerate(zip(x, y)):
+        left = int(max(round(px) - radius, 0))
+        right = int(min(round(px) + radius + 1, width))
+        top = int(max(round(py) - radius, 0))
+        bottom = int(min(round(py) + radius + 1, height))
+        window = image[top:bottom, left:right]
+        intensities[index] = max(np.sum(window) - background * np.size(window),
+                                 0)
+    return intensities
+
+
+def _phase_to_mask(Phi, image_width, image_height=None, aperture=None):
+    # Converts a phase in radians to the phasemask format used by the SLM.
+    # With an aperture Phi only holds the active pixels, the others get
+    # zero phase.
+    if image_height is None:
+        image_height = image_width
+    if aperture is None:
+        return np.reshape(128+Phi*255/(2*pi), (image_height, image_width))
+    phasemask = np.full((image_height, image_width), 128.0)
+    phasemask[aperture] = 128+np.ravel(Phi)*255/(2*pi)
+    return phasemask
+
+
+def _fill_report(state, V_abs, iterations, start):
+    # Stores the convergence report of a hologram algorithm in state.
+    if state is None:
+        return
+    state['iterations'] = iterations
+    state['uniformity'] = None if V_abs is None else float(get_uniformity(V_abs))
+    state['efficiency'] = None if V_abs is None else float(get_efficiency(V_abs))
+    state['time'] = time() - start
+
+
+def GSW(N, M, Delta=None, image_width=1080, nbr_iterations=30, Phi=None, W=None,
+    state=None, tolerance=None, max_time=None, trap_phases=None,
+    fixed_weights=False, image_height=None, aperture=None):
+    '''
+    Weighted Gerchberg-Saxton Algorithm (GSW)
+
+    Phi and W can be used to warm start the algorithm from a previous solution,
+    for instance when the traps have only moved slightly. Phi is the phase
+    (length N) and W the trap weights (M x 1) as stored in state. If they do not
+    match N and M they are ignored.
+    When the traps have moved the old phase is a poor guess, instead
+    trap_phases, the phases of the trap fields V of the previous solution
+    (length M, as stored in state), can be given together with W. The
+    initial phase is then the weighted superposition of the new traps with
+    these phases.
+
+    fixed_weights : bool, optional
+        Keep W as given instead of updating it from the trap fields, used when
+        the weights come from measured trap intensities, see
+        get_feedback_weights.
+    tolerance : float, optional
+        Stop before nbr_iterations when the non-uniformity of the traps,
+        1-uniformity, is at most tolerance.
+    max_time : float, optional
+        Stop after the first iteration finishing later than max_time seconds.
+    state : dict, optional
+        Filled with the final phase and weights, 'Phi' and 'W', the phases of
+        the trap fields, 'trap_phases', and a report of
+        the run: 'iterations' used, 'uniformity' and 'efficiency' of the traps
+        of the returned phasemask and wall 'time' in s. Unless the tolerance
+        was reached this costs one more evaluation of the trap fields.
+    image_height : int, optional
+        Height of the phasemask, image_width if None.
+    aperture : 2d array of bools, optional
+        Active pixels of the SLM, see get_aperture. Delta and Phi then only
+        hold these N pixels and the other pixels get zero phase.
+    '''
+    start = time()
     if Delta is None:
-        Delta = SLM.get_delta(image_width=image_width)
-    Phi = RS(N, M, Delta) # Initial guess
-    W = np.ones((M,1))
+        Delta, N, M = get_delta(image_width=image_width,
+            image_height=image_height, aperture=aperture)
+    if W is None or np.size(W) != M:
+        W = np.ones((M,1))
+    W = np.reshape(W, (M,1))
     I_m =np.uint8(np.ones((M,1)))
     I_N = np.uint8(np.ones((1,N)))
     Delta_J = np.exp(1j*Delta)
+    if trap_phases is not None and np.size(trap_phases) == M:
+        Phi = np.angle(sum(np.multiply(Delta_J,
+            np.multiply(W, np.exp(1j*np.reshape(trap_phases, (M, 1))))*I_N)))
+    elif Phi is None or np.size(Phi) != N:
+        Phi = RS(N, M, Delta) # Initial guess
+    V = None
+    V_abs = None
+    iterations = 0
     for J in range(nbr_iterations):
-        V = np.reshape(np.mean((np.exp(1j*(I_m*Phi)-Delta)), axis=1), (M, 1))
+        V = np.reshape(np.mean((np.exp(1j*(I_m*Phi-Delta))), axis=1), (M, 1))
         V_abs = abs(V)
-        W = np.mean(V_abs)*np.divide(W,V_abs)
+        if tolerance is not None and 1 - get_uniformity(V_abs) <= tolerance:
+            break
+        if not fixed_weights:
+            W = np.mean(V_abs)*np.divide(W,V_abs)
         Phi = np.angle(sum(np.multiply(Delta_J, np.divide(np.multiply(W, V), V_abs)*I_N)))
+        iterations += 1
         print('Iteration: ', J+1, 'of ', nbr_iterations)
-
-    return np.reshape(128+Phi*255/(2*pi), (image_width, image_width))
-
-
-def  GS(N, M, Delta=None, image_width=1080, nbr_iterations=30):
+        if max_time is not None and time() - start > max_time:
+            break
+
+    if state is not None:
+        if iterations > 0 and iterations == J+1:
+            # The phase was updated after V was calculated
+            V = np.reshape(np.mean((np.exp(1j*(I_m*Phi-Delta))), axis=1), (M, 1))
+            V_abs = abs(V)
+        state['Phi'] = Phi
+        state['W'] = W
+        state['trap_phases'] = None if V is None else np.angle(np.ravel(V))
+        _fill_report(state, V_abs, iterations, start)
+    return _phase_to_mask(Phi, image_width, image_height, aperture)
+
+
+def  GS(N, M, Delta=None, image_width=1080, nbr_iterations=30, Phi=None,
+    state=None, tolerance=None, max_time=None, trap_phases=None,
+    image_height=None, aperture=None):
+    '''
+    Gerchberg-Saxton Algorithm (GS)
+    Phi, trap_phases, state, tolerance, max_time, image_height and aperture
+    are used in the same way as in GSW.
+    '''
+    start = time()
     if Delta is None:
-        Delta = SLM.get_delta(image_width=image_width)
-    Phi = RS(N,M,Delta) # Initial guess
+        Delta, N, M = get_delta(image_width=image_width,
+            image_height=image_height, aperture=aperture)
     W = np.ones((M,1))
     I_m =np.uint8(np.ones((M,1)))
     I_N = np.uint8(np.ones((1,N)))
     Delta_J = np.exp(1j*Delta)
+    if trap_phases is not None and np.size(trap_phases) == M:
+        Phi = np.angle(sum(np.multiply(Delta_J,
+            np.exp(1j*np.reshape(trap_phases, (M, 1)))*I_N)))
+    elif Phi is None or np.size(Phi) != N:
+        Phi = RS(N,M,Delta) # Initial guess
+    V = None
+    V_abs = None
+    iterations = 0
+    for J in range(nbr_iterations):
+        V = np.reshape( np.transpose( np.mean((np.exp(1j*(I_m*Phi-Delta))),axis=1) ),(M,1))
+        V_abs = abs(V)
+        if tolerance is not None and 1 - get_uniformity(V_abs) <= tolerance:
+            break
+        Phi = np.angle(sum(np.multiply(Delta_J,np.divide(V,V_abs))*I_N ))
+        iterations += 1
+        print('Iteration: ', J+1, 'of ', nbr_iterations)
+        if max_time is not None and time() - start > max_time:
+            break
+    if state is not None:
+        if iterations > 0 and iterations == J+1:
+            # The phase was updated after V was calculated
+            V = np.reshape(np.mean((np.exp(1j*(I_m*Phi-Delta))), axis=1), (M, 1))
+            V_abs = abs(V)
+        state['Phi'] = Phi
+        state['W'] = W
+        state['trap_phases'] = None if V is None else np.angle(np.ravel(V))
+        _fill_report(state, V_abs, iterations, start)
+    return _phase_to_mask(Phi, image_width, image_height, aperture)
+
+
+class GSWorkspace:
+    '''
+    Preallocated work buffers for GSW_float32 and GS_float32. Reusing one
+    workspace between calls avoids reallocating exp(i*Delta) (M x N) and the
+    length N phase buffers for every phasemask.
+    '''
+    def __init__(self, dtype=np.complex64):
+        self.dtype = np.dtype(dtype)
+        self.real_dtype = np.float32 if self.dtype == np.complex64 else np.float64
+        self.Delta_J = None # exp(i*Delta)
+        self.field = None # Field on the SLM, superposition of the traps
+        self.exp_Phi = None # exp(-i*Phi)
+        self.Phi = None
+        self.pool = None # Thread pool used by GSW_tiled
+        self.nbr_workers = 0
+
+    def get_pool(self, nbr_workers):
+        '''
+        Returns a thread pool with nbr_workers threads, kept between calls.
+        '''
+        if self.pool is None or self.nbr_workers != nbr_workers:
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.pool = ThreadPoolExecutor(max_workers=nbr_workers)
+            self.nbr_workers = nbr_workers
+        return self.pool
+
+    def prepare(self, Delta):
+        '''
+        Allocates the buffers if the shape of Delta has changed and fills
+        Delta_J with exp(i*Delta).
+        If Delta is quantized (uint16, see quantize_phase) Delta_J is not
+        stored, GSW_tiled then looks up exp(i*Delta) one tile at a time.
+        '''
+        M, N = np.shape(Delta)
+        self.Delta = Delta
+        if Delta.dtype == np.uint16:
+            self.Delta_J = None
+            self.tile_buffers = local()
+        elif self.Delta_J is None or np.shape(self.Delta_J) != (M, N):
+            self.Delta_J = None # Release the old buffer before allocating
+            self.Delta_J = np.empty((M, N), dtype=self.dtype)
+        if self.Phi is None or len(self.Phi) != N:
+            self.field = np.empty(N, dtype=self.dtype)
+            self.exp_Phi = np.empty(N, dtype=self.dtype)
+            self.Phi = np.empty(N, dtype=self.real_dtype)
+        if self.Delta_J is not None:
+            np.cos(Delta, out=self.Delta_J.real)
+            np.sin(Delta, out=self.Delta_J.imag)
+        return self.Delta_J
+
+    def get_Delta_J(self, tile):
+        '''
+        Returns exp(i*Delta) for the pixels in tile (a slice). For a quantized
+        Delta it is looked up in the phase table into a buffer owned by the
+        calling thread.
+        '''
+        if self.Delta_J is not None:
+            return self.Delta_J[:, tile]
+        Delta = self.Delta[:, tile]
+        buffers = self.tile_buffers.__dict__
+        if np.shape(Delta) not in buffers:
+            buffers[np.shape(Delta)] = np.empty(np.shape(Delta), dtype=self.dtype)
+        return np.take(get_phase_table(self.dtype), Delta, mode='clip',
+                       out=buffers[np.shape(Delta)])
+
+
+def _superposition_phase(coefficients, workspace):
+    # Phase of the superposition sum_m coefficients[m]*exp(i*Delta[m]), written
+    # to workspace.Phi. A single vector-matrix product, no M x N temporaries.
+    np.dot(np.asarray(coefficients, dtype=workspace.dtype), workspace.Delta_J,
+           out=workspace.field)
+    np.arctan2(workspace.field.imag, workspace.field.real, out=workspace.Phi)
+    return workspace.Phi
+
+
+def _trap_fields(workspace):
+    # V[m] = mean(exp(i*(Phi-Delta[m]))) calculated as a matrix-vector product.
+    Phi = workspace.Phi
+    exp_Phi = workspace.exp_Phi
+    np.cos(Phi, out=exp_Phi.real)
+    np.sin(Phi, out=exp_Phi.imag)
+    np.negative(exp_Phi.imag, out=exp_Phi.imag)
+    return np.conj(np.dot(workspace.Delta_J, exp_Phi)) / len(Phi)
+
+
+def _GS_inplace(N, M, Delta, image_width, nbr_iterations, Phi, W, state,
+    tolerance, max_time, workspace, weighted, trap_phases=None,
+    fixed_weights=False, image_height=None, aperture=None):
+    # Common implementation of GSW_float32 and GS_float32.
+    start = time()
+    if workspace is None:
+        workspace = GSWorkspace()
+    workspace.prepare(Delta)
+    if W is None or np.size(W) != M or not weighted:
+        W = np.ones(M)
+    W = np.reshape(W, M)
+    if trap_phases is not None and np.size(trap_phases) == M:
+        _superposition_phase(W * np.exp(1j*np.reshape(trap_phases, M)), workspace)
+    elif Phi is None or np.size(Phi) != N:
+        # Random superposition as initial guess
+        _superposition_phase(np.exp(1j*np.random.uniform(0, 2*pi, M)), workspace)
+    else:
+        workspace.Phi[:] = np.reshape(Phi, N)
+
+    V = None
+    V_abs = None
+    iterations = 0
+    for J in range(nbr_iterations):
+        V = _trap_fields(workspace)
+        V_abs = np.abs(V)
+        if tolerance is not None and 1 - get_uniformity(V_abs) <= tolerance:
+            break
+        if weighted and not fixed_weights:
+            W = np.mean(V_abs) * W / V_abs
+        _superposition_phase(W * V / V_abs, workspace)
+        iterations += 1
+        print('Iteration: ', J+1, 'of ', nbr_iterations)
+        if max_time is not None and time() - start > max_time:
+            break
+
+    if state is not None:
+        if iterations > 0 and iterations == J+1:
+            # The phase was updated after V was calculated
+            V = _trap_fields(workspace)
+            V_abs = np.abs(V)
+        state['Phi'] = workspace.Phi.copy()
+        state['W'] = np.reshape(W, (M, 1))
+        state['trap_phases'] = None if V is None else np.angle(V)
+        _fill_report(state, V_abs, iterations, start)
+    return _phase_to_mask(workspace.Phi, image_width, image_height, aperture)
+
+
+def GSW_float32(N, M, Delta, image_width=1080, nbr_iterations=30, Phi=None,
+    W=None, state=None, tolerance=None, max_time=None, workspace=None,
+    trap_phases=None, fixed_weights=False, image_height=None, aperture=None):
+    '''
+    Single precision version of GSW. Works in complex64 and reuses the
+    buffers in workspace (a GSWorkspace) across iterations and calls.
+    Both the trap fields V and the new phase are calculated with matrix-vector
+    products so the only M x N array used is exp(i*Delta).
+    Other parameters are the same as for GSW.
+    '''
+    return _GS_inplace(N, M, Delta, image_width, nbr_iterations, Phi, W, state,
+        tolerance, max_time, workspace, weighted=True, trap_phases=trap_phases,
+        fixed_weights=fixed_weights, image_height=image_height,
+        aperture=aperture)
+
+
+def GS_float32(N, M, Delta, image_width=1080, nbr_iterations=30, Phi=None,
+    state=None, tolerance=None, max_time=None, workspace=None, trap_phases=None,
+    image_height=None, aperture=None):
+    '''
+    Single precision version of GS, see GSW_float32.
+    '''
+    return _GS_inplace(N, M, Delta, image_width, nbr_iterations, Phi, None,
+        state, tolerance, max_time, workspace, weighted=False,
+        trap_phases=trap_phases, image_height=image_height, aperture=aperture)
+
+
+def _get_tiles(N, M, tile_size=None):
+    # Splits the N pixels into tiles such that a tile of exp(i*Delta), M x
+    # tile_size complex64, fits in the L2 cache of a core (about 512 kB).
+    if tile_size is None:
+        tile_size = max(2048, 2**19 // (8*M))
+    return [slice(start, min(start+tile_size, N)) for start in range(0, N, tile_size)]
+
+
+def _tile_pass(workspace, tile, coefficients):
+    # Processes the pixels in tile. If coefficients is given the phase is first
+    # updated to the phase of the superposition. Returns the contribution of
+    # the tile to sum(exp(i*(Phi-Delta[m]))). Runs with the GIL released in
+    # the numpy calls.
+    Delta_J = workspace.get_Delta_J(tile)
+    Phi = workspace.Phi[tile]
+    if coefficients is not None:
+        field = workspace.field[tile]
+        np.dot(coefficients, Delta_J, out=field)
+        np.arctan2(field.imag, field.real, out=Phi)
+    exp_Phi = workspace.exp_Phi[tile]
+    np.cos(Phi, out=exp_Phi.real)
+    np.sin(Phi, out=exp_Phi.imag)
+    np.negative(exp_Phi.imag, out=exp_Phi.imag)
+    return np.conj(np.dot(Delta_J, exp_Phi))
+
+
+def GSW_tiled(N, M, Delta, image_width=1080, nbr_iterations=30, Phi=None,
+    W=None, state=None, tolerance=None, max_time=None, workspace=None,
+    nbr_workers=None, tile_size=None, trap_phases=None, fixed_weights=False,
+    image_height=None, aperture=None):
+    '''
+    Multi-core version of GSW_float32. The SLM pixels are split into cache
+    sized tiles which are processed by a pool of threads. Each tile updates
+    its part of the phase and returns its contribution to the trap fields V
+    in the same pass, the contributions are then summed in tile order.
+    The result therefore does not depend on the number of workers and agrees
+    with GSW_float32 to within single precision rounding.
+    Delta can also be quantized (uint16, see quantize_phase), exp(i*Delta)
+    is then looked up one tile at a time and never stored for all pixels.
+
+    nbr_workers : int, optional
+        Number of threads. Defaults to the number of cores.
+    tile_size : int, optional
+        Number of pixels per tile. Defaults to a tile of exp(i*Delta) of about
+        512 kB.
+    Other parameters are the same as for GSW.
+    '''
+    start = time()
+    if workspace is None:
+        workspace = GSWorkspace()
+    if nbr_workers is None:
+        nbr_workers = cpu_count()
+    workspace.prepare(Delta)
+    pool = workspace.get_pool(nbr_workers)
+    tiles = _get_tiles(N, M, tile_size)
+
+    def run_pass(coefficients):
+        if coefficients is not None:
+            coefficients = np.asarray(coefficients, dtype=workspace.dtype)
+        partial_sums = pool.map(
+            lambda tile: _tile_pass(workspace, tile, coefficients), tiles)
+        V = np.zeros(M, dtype=np.complex128)
+        for partial_sum in partial_sums:
+            V += partial_sum
+        return V / N
+
+    if W is None or np.size(W) != M:
+        W = np.ones(M)
+    W = np.reshape(W, M)
+    if trap_phases is not None and np.size(trap_phases) == M:
+        V = run_pass(W * np.exp(1j*np.reshape(trap_phases, M)))
+    elif Phi is None or np.size(Phi) != N:
+        # Random superposition as initial guess
+        V = run_pass(np.exp(1j*np.random.uniform(0, 2*pi, M)))
+    else:
+        workspace.Phi[:] = np.reshape(Phi, N)
+        V = run_pass(None)
+
+    iterations = 0
+    V_abs = np.abs(V)
+    # The pass which updates the phase also gives V of the new phase, so V is
+    # always that of the returned phasemask.
     for J in range(nbr_iterations):
-        V = np.reshape( np.transpose( np.mean((np.exp(1j*(I_m*Phi)-Delta)),axis=1) ),(M,1))
-        Phi = np.angle(sum(np.multiply(Delta_J,np.divide(V,abs(V)))*I_N ))
+        if tolerance is not None and 1 - get_uniformity(V_abs) <= tolerance:
+            break
+        if not fixed_weights:
+            W = np.mean(V_abs) * W / V_abs
+        V = run_pass(W * V / V_abs)
+        V_abs = np.abs(V)
+        iterations += 1
         print('Iteration: ', J+1, 'of ', nbr_iterations)
-    result = np.reshape(128+Phi*255/(2*pi),(image_width,image_width))
-    return  result
+        if max_time is not None and time() - start > max_time:
+            break
+
+    if state is not None:
+        state['Phi'] = workspace.Phi.copy()
+        state['W'] = np.reshape(W, (M, 1))
+        state['trap_phases'] = np.angle(V)
+        _fill_report(state, V_abs, iterations, start)
+    return _phase_to_mask(workspace.Phi, image_width, image_height, aperture)
+
+
+def get_focal_plane_indices(xm, ym, image_width=1080, oversampling=1):
+    '''
+    Finds the pixels of the discretized focal plane, the 2d FFT of the SLM
+    plane, which correspond to traps at xm, ym. A trap at xm gives a phase
+    gradient of 2*pi*p*xm/(lambda*f) per SLM pixel which is the same as FFT
+    frequency p*xm*image_width/(lambda*f). Positions are rounded to the
+    nearest pixel, oversampling > 1 zero pads the SLM plane to get a finer
+    focal plane grid.
+
+    Returns
+    -------
+    rows, columns : 1d-arrays of ints
+        Indices of the traps in the (unshifted) focal plane.
+    '''
+    size = image_width * oversampling
+    scale = SLM_pixel_size * size / (laser_wavelength * focal_length)
+    columns = np.mod(np.round(np.asarray(xm) * scale).astype(int), size)
+    rows = np.mod(np.round(np.asarray(ym) * scale).astype(int), size)
+    return rows, columns
+
+
+def camera_to_focal_plane_indices(x, y, c_p, image_width=1080, oversampling=1):
+    '''
+    Same as get_focal_plane_indices but for traps given in camera pixels, e.g.
+    c_p['traps_absolute_pos']. The camera pixels are converted to SLM
+    locations with the slm_x_center, slm_y_center and slm_to_pixel
+    calibration in c_p.
+    '''
+    xm = [(px - c_p['slm_x_center']) / c_p['slm_to_pixel'] for px in x]
+    ym = [(py - c_p['slm_y_center']) / c_p['slm_to_pixel'] for py in y]
+    return get_focal_plane_indices(xm, ym, image_width, oversampling)
+
+
+# FFTW plans of GS_FFT, one set per thread since a plan works on its own
+# arrays and GS_FFT may run in several threads at once, e.g. when
+# calculating a trajectory or precompiling phasemasks.
+_fft_plans = local()
+_fft_planner_lock = Lock()
+
+
+def _get_fft_plans(size, max_sizes=4):
+    # Forward and backward FFTW plans between the (padded) SLM plane and the
+    # focal plane of the calling thread. Creating the plans is slow so they
+    # are kept between calls.
+    plans = getattr(_fft_plans, 'plans', None)
+    if plans is None:
+        plans = _fft_plans.plans = {}
+    if size not in plans:
+        if len(plans) >= max_sizes:
+            plans.clear()
+        slm_plane = pyfftw.empty_aligned((size, size), dtype='complex64')
+        focal_plane = pyfftw.empty_aligned((size, size), dtype='complex64')
+        with _fft_planner_lock:
+            forward = pyfftw.FFTW(slm_plane, focal_plane, axes=(0, 1),
+                threads=cpu_count())
+            backward = pyfftw.FFTW(focal_plane, slm_plane, axes=(0, 1),
+                direction='FFTW_BACKWARD', threads=cpu_count())
+        plans[size] = (forward, backward)
+    return plans[size]
+
+
+def GS_FFT(xm, ym, image_width=1080, nbr_iterations=30, Phi=None, W=None,
+    state=None, tolerance=None, max_time=None, oversampling=1, trap_phases=None,
+    fixed_weights=False, image_height=None, aperture=None):
+    '''
+    Weighted Gerchberg-Saxton algorithm which propagates between the SLM and
+    a discretized focal plane with FFTs instead of summing the phase of every
+    trap in every pixel. The cost of an iteration is therefore independent of
+    the number of traps which makes it suitable for large trap arrays.
+    Traps are placed on the nearest focal plane pixel, see
+    get_focal_plane_indices. zm and LGO are not supported.
+    A rectangular SLM is zero padded to a square and pixels outside the
+    aperture are dark.
+    The rounding to focal plane pixels costs accuracy: on the FFT grid the
+    traps are close to perfectly uniform, but at the real trap positions,
+    the Delta model used by GSW, the uniformity is typically 0.7-0.8 and the
+    efficiency about 0.5 against 0.99 and 0.9 for GSW (256-512 pixel SLM,
+    9-25 traps). oversampling=4 (c_p['SLM_oversampling']) gives about 0.98
+    and 0.89 at 512 pixels but takes about 16 times longer. The tolerance and
+    the reported uniformity and efficiency are evaluated at the real trap
+    positions, with the separable trap phase as in RS_traps.
+
+    oversampling : int, optional
+        Zero padding factor of the SLM plane. Gives a focal plane grid which is
+        oversampling times finer at the cost of larger FFTs.
+    Other parameters are the same as for GSW.
+    '''
+    start = time()
+    if image_height is None:
+        image_height = image_width
+    size = max(image_width, image_height) * oversampling
+    N = get_nbr_pixels(image_width, image_height, aperture)
+    forward, backward = _get_fft_plans(size)
+    slm_plane = forward.input_array
+    focal_plane = forward.output_array
+    illuminated = slm_plane[:image_height, :image_width]
+    rows, columns = get_focal_plane_indices(xm, ym,
+        max(image_width, image_height), oversampling)
+    M = len(rows)
+
+    if W is None or np.size(W) != M:
+        W = np.ones(M)
+    W = np.reshape(W, M)
+    if trap_phases is not None and np.size(trap_phases) == M:
+        focal_plane[:] = 0
+        focal_plane[rows, columns] = W * np.exp(1j*np.reshape(trap_phases, M))
+        backward()
+        Phi = np.angle(illuminated)
+    elif Phi is None or np.size(Phi) != N:
+        # Random superposition as initial guess
+        focal_plane[:] = 0
+        focal_plane[rows, columns] = np.exp(1j*np.random.uniform(0, 2*pi, M))
+        backward()
+        Phi = np.angle(illuminated)
+    elif aperture is not None:
+        Phi_plane = np.zeros((image_height, image_width))
+        Phi_plane[aperture] = Phi
+        Phi = Phi_plane
+    Phi = np.reshape(Phi, (image_height, image_width)).astype(np.float32)
+
+    phase_x, phase_y = get_trap_phase_vectors(xm, ym, np.zeros(M),
+        image_width, image_height=image_height)
+    def get_real_V_abs(Phi):
+        # |V| of the traps at their real positions
+        return np.abs(_separable_trap_fields(Phi if aperture is None else
+            Phi[aperture], phase_x, phase_y, [False] * M, 0, image_width,
+            image_height, aperture))
+
+    V = None
+    V_abs = None
+    iterations = 0
+    for J in range(nbr_iterations):
+        slm_plane[:] = 0
+        np.cos(Phi, out=illuminated.real)
+        np.sin(Phi, out=illuminated.imag)
+        if aperture is not None:
+            illuminated *= aperture
+        forward()
+        V = focal_plane[rows, columns] / N
+        V_abs = np.abs(V)
+        if tolerance is not None and \
+            1 - get_uniformity(get_real_V_abs(Phi)) <= tolerance:
+            break
+        if not fixed_weights:
+            W = np.mean(V_abs) * W / V_abs
+        focal_plane[:] = 0
+        focal_plane[rows, columns] = W * V / V_abs
+        backward()
+        np.arctan2(illuminated.imag, illuminated.real, out=Phi)
+        iterations += 1
+        print('Iteration: ', J+1, 'of ', nbr_iterations)
+        if max_time is not None and time() - start > max_time:
+            break
+
+    real_V_abs = None if V is None or state is None else get_real_V_abs(Phi)
+    Phi = np.reshape(Phi, -1) if aperture is None else Phi[aperture]
+    if state is not None:
+        state['Phi'] = Phi
+        state['W'] = np.reshape(W, (M, 1))
+        state['trap_phases'] = None if V is None else np.angle(V)
+        _fill_report(state, real_V_abs, iterations, start)
+    return _phase_to_mask(Phi, image_width, image_height, aperture)
 
 
 def get_default_xm_ym():
@@ -251,51 +910,355 @@ def compensate_z(xm, ym, zm, x_comp, y_comp):
     return xm, ym
 
 
-def get_delta(image_width = 1080, xm=[], ym=[], zm=None, use_LGO=[False], order=-8,
-    x_comp=None, y_comp=None):
-    """
-    Calculates delta in paper. I.e the phase shift of light when travelling from
-    the SLM to the trap position for a specific set of points
-    Default parameters copied from Allessandros script
-    """
-    x = np.linspace(1,image_width,image_width)
-    y = np.reshape(np.transpose(np.linspace(1,image_width,image_width)),(image_width,1))
-
-    I = np.ones((1,image_width))
-    N = image_width**2
-    p = 9e-6 # pixel size
-    f = np.sqrt(2e-4*0.4) # Focal length of imaging system. Empirically found value
-    z = 0
-    lambda_ = 532e-9 # Laser wavelength
+def _prepare_traps(xm, ym, zm, use_LGO, x_comp=None, y_comp=None):
+    '''
+    Checks the trap parameters given to get_delta and puts them on a common
+    form. Uses the default positions if no traps are given, pads zm and use_LGO
+    to the number of traps and compensates for the lateral shift caused by zm.
 
+    Returns
+    -------
+    xm, ym, zm : 1d-arrays of length M
+    use_LGO : list of M bools
+    '''
     if len(xm)<1 or len(ym)<1:
         xm,ym = get_default_xm_ym()
         use_LGO = [False for i in range(len(xm))]
-    # TODO make the order into a list
-    if True in use_LGO:
-        LGO = get_LGO(image_width,order=order)
     M = len(xm) # Total number of traps
 
     # Initiate zm if not provided by user.
     if zm is None:
         zm = np.zeros((M))
+    zm = np.asarray(zm[:M], dtype=float)
+    if len(zm) < M:
+        zm = np.concatenate((zm, np.zeros(M-len(zm))))
     # Compensate for shift in x-y plane when changing z
-    zm = zm[:M]
     if x_comp is not None:
         xm, ym = compensate_z(xm, ym, zm, x_comp, y_comp)
         print('compensated')
-    Delta=np.zeros((M,N))
-    for m in range(M):
+    use_LGO = [len(use_LGO)>m and bool(use_LGO[m]) for m in range(M)]
+    return np.asarray(xm, dtype=float), np.asarray(ym, dtype=float), zm, use_LGO
 
+
+def get_decimated_width(image_width, decimation=1):
+    '''
+    Width of the SLM grid when only every decimation:th pixel is used.
+    '''
+    return ceil(image_width / decimation)
+
+
+def get_aperture(image_width=1080, image_height=None, radius=None, decimation=1):
+    '''
+    Circular active aperture of the SLM, the pixels which are illuminated by
+    the laser. Only these pixels need to be calculated so N, and with it the
+    time and memory used, shrinks with the unused area.
+
+    Parameters
+    ----------
+    image_width : int, optional
+        Width of the SLM in pixels.
+    image_height : int, optional
+        Height of the SLM in pixels, image_width if None.
+    radius : float, optional
+        Radius of the aperture in pixels, centered on the SLM. None for no
+        aperture.
+    decimation : int, optional
+        Returns the aperture on the grid of every decimation:th pixel, see
+        calculate_delta_row.
+
+    Returns
+    -------
+    aperture : 2d array of bools or None
+        True for the active pixels, read only. None if radius is None.
+    '''
+    if radius is None:
+        return None
+    if image_height is None:
+        image_height = image_width
+    return _get_aperture_cached(int(image_width), int(image_height),
+                                float(radius), int(decimation))
+
+
+@lru_cache(maxsize=8)
+def _get_aperture_cached(image_width, image_height, radius, decimation):
+    x = np.linspace(1, image_width, image_width) - image_width / 2
+    y = np.reshape(np.linspace(1, image_height, image_height) - image_height / 2,
+                   (image_height, 1))
+    aperture = (x**2 + y**2 <= radius**2)[::decimation, ::decimation]
+    aperture.setflags(write=False)
+    return aperture
+
+
+def get_nbr_pixels(image_width=1080, image_height=None, aperture=None,
+    decimation=1):
+    '''
+    Number of pixels N which the algorithms work on. aperture is given on the
+    decimated grid.
+    '''
+    if aperture is not None:
+        return int(np.count_nonzero(aperture))
+    if image_height is None:
+        image_height = image_width
+    return get_decimated_width(image_width, decimation) * \
+        get_decimated_width(image_height, decimation)
+
+
+@lru_cache(maxsize=8)
+def _get_coordinates(length, decimation=1):
+    # Pixel coordinates of the SLM along one axis and their squares. With
+    # decimation > 1 only every decimation:th pixel is included.
+    x = np.linspace(1, length, length)[::decimation]
+    x2 = x**2
+    x.setflags(write=False)
+    x2.setflags(write=False)
+    return x, x2
+
+
+def calculate_delta_row(row, image_width, xm, ym, zm=0, use_LGO=False, order=-8,
+    decimation=1, image_height=None, aperture=None):
+    '''
+    Calculates delta for a single trap and writes it into row.
+    The phase is separable, x*xm + y*ym + zm/(2f)*(x^2+y^2), so it is built from
+    two 1d phase vectors which are broadcast straight into row without
+    creating any image_height x image_width temporaries, unless an aperture
+    is used.
+
+    Parameters
+    ----------
+    row : 1d-array of length N, see get_nbr_pixels
+        Array which the result is written to, float64, float32 or uint16 for a
+        quantized phase.
+    image_width : int
+        Width of the phasemask in pixels.
+    xm, ym, zm : float
+        Position of the trap.
+    use_LGO : bool, optional
+        If the LGO phase should be added to the trap.
+    order : int, optional
+        Order of the LGO.
+    decimation : int, optional
+        Only every decimation:th pixel along each axis is calculated, row then
+        has length get_decimated_width(image_width, decimation)**2. The values
+        are exactly those of the corresponding pixels of the full row.
+    image_height : int, optional
+        Height of the phasemask, image_width if None.
+    aperture : 2d-array of bools, optional
+        Active pixels of the (decimated) grid, see get_aperture. Only these
+        are written to row.
+
+    Returns
+    -------
+    row
+    '''
+    if row.dtype == np.uint16:
+        phase = calculate_delta_row(np.empty(len(row), dtype=np.float32),
+            image_width, xm, ym, zm, use_LGO, order, decimation, image_height,
+            aperture)
+        return quantize_phase(phase, out=row)
+    phase_x, phase_y = get_trap_phase_vectors([xm], [ym], [zm], image_width,
+                                              decimation, image_height)
+    phase_x = phase_x[0]
+    phase_y = phase_y[0]
+    shape = (len(phase_y), len(phase_x))
+
+    if aperture is None:
+        plane = np.reshape(row, shape)
+    else:
+        plane = np.empty(shape, dtype=row.dtype)
+    np.add(np.reshape(phase_y, (-1, 1)), phase_x, out=plane)
+    _wrap_phase(plane)
+    if use_LGO:
+        plane += get_LGO(image_width, order=order,
+            image_height=image_height)[::decimation, ::decimation]
+        _wrap_phase(plane)
+    if aperture is not None:
+        row[:] = plane[aperture]
+    return row
+
+
+def get_trap_phase_vectors(xm, ym, zm, image_width=1080, decimation=1,
+    image_height=None):
+    '''
+    The phase of trap m is separable, Delta[m] = phase_y[m][row] +
+    phase_x[m][column] (plus the LGO phase), this function returns the two
+    phase vectors of all traps.
+
+    Returns
+    -------
+    phase_x : M x width array
+        width is get_decimated_width(image_width, decimation).
+    phase_y : M x height array
+        height is get_decimated_width(image_height, decimation), image_height
+        defaults to image_width.
+    '''
+    if image_height is None:
+        image_height = image_width
+    x, x2 = _get_coordinates(image_width, decimation)
+    y, y2 = _get_coordinates(image_height, decimation)
+    scale = 2*pi*SLM_pixel_size/laser_wavelength/focal_length
+    z_scale = np.reshape(np.asarray(zm, dtype=float), (-1, 1))/(2*focal_length)
+    xm = np.reshape(np.asarray(xm, dtype=float), (-1, 1))
+    ym = np.reshape(np.asarray(ym, dtype=float), (-1, 1))
+    # Using python "%" instead of Matlabs "rem"
+    phase_x = np.mod(scale*(x*xm + z_scale*x2), 2*pi)
+    phase_y = np.mod(scale*(y*ym + z_scale*y2), 2*pi)
+    return phase_x, phase_y
+
+
+def _wrap_phase(phase):
+    # Wraps a phase in [0, 4pi) to [0, 2pi) in place. Considerably faster
+    # than np.mod.
+    np.subtract(phase, 2*pi, out=phase, where=phase >= 2*pi)
+
+
+# Number of phase levels of a quantized Delta. The rounding error of a
+# quantized phase is at most pi/phase_levels = 4.8e-5 rad. Calculating the
+# phase in float32 before rounding and the complex64 phase table add a few
+# 1e-6 rad, so the total error stays below 5.5e-5 rad.
+phase_levels = 2**16
+
+
+def quantize_phase(phase, out=None):
+    '''
+    Quantizes a phase in [0, 2pi) to uint16 indices into get_phase_table().
+    Stores Delta in 2 bytes per pixel instead of 8 (float64) + 16 (complex128
+    exp(i*Delta)), see phase_levels for the error bound.
+    '''
+    indices = np.rint(phase * (phase_levels / (2*pi)))
+    indices[indices >= phase_levels] -= phase_levels
+    if out is None:
+        return indices.astype(np.uint16)
+    out[:] = indices
+    return out
+
+
+@lru_cache(maxsize=2)
+def get_phase_table(dtype=np.complex64):
+    '''
+    Lookup table with exp(i*2*pi*k/phase_levels), k = 0...phase_levels-1,
+    used to calculate exp(i*Delta) from a quantized Delta.
+    '''
+    table = np.exp(1j*2*pi*np.arange(phase_levels)/phase_levels).astype(dtype)
+    table.setflags(write=False)
+    return table
+
+
+def get_delta(image_width = 1080, xm=[], ym=[], zm=None, use_LGO=[False], order=-8,
+    x_comp=None, y_comp=None, dtype=np.float64, decimation=1, image_height=None,
+    aperture=None):
+    """
+    Calculates delta in paper. I.e the phase shift of light when travelling from
+    the SLM to the trap position for a specific set of points
+    Default parameters copied from Allessandros script
+
+    dtype can be set to np.float32 to halve the memory used by Delta or to
+    np.uint16 to store it quantized, see quantize_phase.
+    decimation > 1 calculates Delta on every decimation:th pixel only, see
+    calculate_delta_row.
+    image_height gives a rectangular SLM and aperture, see get_aperture,
+    restricts Delta to the active pixels.
+    """
+    N = get_nbr_pixels(image_width, image_height, aperture, decimation)
+    # TODO make the order into a list
+    xm, ym, zm, use_LGO = _prepare_traps(xm, ym, zm, use_LGO, x_comp, y_comp)
+    M = len(xm)
+
+    Delta = np.empty((M,N), dtype=dtype)
+    for m in range(M):
         # Calculate delta according to eq : in paper
-        # Using python "%" instead of Matlabs "rem"
-        Delta[m,:]=np.reshape(2*pi*p/lambda_/f*((np.transpose(I)*x*xm[m]+(y*I)*ym[m]) + 1/(2*f)*zm[m] * ( (np.transpose(I)*x)**2 + (y*I)**2 )) % (2*pi),(1,N))
-        if len(use_LGO)>m and use_LGO[m]:
-            Delta[m,:] += np.reshape(LGO,(N))
-            Delta[m,:] = Delta[m,:] % (2*pi)
+        calculate_delta_row(Delta[m], image_width, xm[m], ym[m], zm[m],
+                            use_LGO[m], order, decimation, image_height,
+                            aperture)
     return Delta, N, M
 
 
+class DeltaCache:
+    '''
+    Keeps Delta of the last set of traps and recalculates only the rows of
+    traps which changed since the previous call. A trap is identified by
+    (xm, ym, zm, use_LGO, order), so activating traps one at a time or adding
+    ghost traps only costs the new rows.
+
+    The returned Delta is owned by the cache and is overwritten by the next
+    call to get_delta.
+    '''
+    def __init__(self, image_width=1080, dtype=np.float64, decimation=1,
+        image_height=None, aperture=None):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.aperture = aperture # On the decimated grid, see get_aperture
+        self.dtype = dtype
+        self.decimation = decimation
+        self.clear()
+
+    def clear(self):
+        '''
+        Empties the cache and resets the hit/miss counters.
+        '''
+        self.Delta = None
+        self.keys = []
+        self.hits = 0 # Number of rows reused
+        self.misses = 0 # Number of rows calculated
+        self.last_hits = 0 # Hits and misses of the latest call to get_delta
+        self.last_misses = 0
+
+    def get_stats(self):
+        '''
+        Returns a dict with the total and latest hit/miss counters.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'last_hits': self.last_hits,
+            'last_misses': self.last_misses,
+        }
+
+    def get_delta(self, xm=[], ym=[], zm=None, use_LGO=[False], order=-8,
+        x_comp=None, y_comp=None):
+        '''
+        Same as get_delta but reuses the rows of unchanged traps.
+
+        Returns
+        -------
+        Delta, N, M
+        '''
+        N = get_nbr_pixels(self.image_width, self.image_height, self.aperture,
+                           self.decimation)
+        xm, ym, zm, use_LGO = _prepare_traps(xm, ym, zm, use_LGO, x_comp, y_comp)
+        M = len(xm)
+        keys = [(float(xm[m]), float(ym[m]), float(zm[m]), use_LGO[m],
+                 order if use_LGO[m] else None) for m in range(M)]
+        old_rows = {key: idx for idx, key in enumerate(self.keys)}
+
+        # Update the old Delta in place unless rows need to be moved around.
+        in_place = self.Delta is not None and self.Delta.shape == (M, N)
+        if in_place:
+            for m, key in enumerate(keys):
+                if key != self.keys[m] and key in old_rows:
+                    in_place = False
+                    break
+        Delta = self.Delta if in_place else np.empty((M, N), dtype=self.dtype)
+
+        hits = 0
+        for m, key in enumerate(keys):
+            if in_place and key == self.keys[m]:
+                hits += 1
+            elif not in_place and key in old_rows:
+                Delta[m] = self.Delta[old_rows[key]]
+                hits += 1
+            else:
+                calculate_delta_row(Delta[m], self.image_width, xm[m], ym[m],
+                                    zm[m], use_LGO[m], order, self.decimation,
+                                    self.image_height, self.aperture)
+        self.Delta = Delta
+        self.keys = keys
+        self.last_hits = hits
+        self.last_misses = M - hits
+        self.hits += self.last_hits
+        self.misses += self.last_misses
+        return Delta, N, M
+
+
 def setup_fullscreen_plt_image():
     '''
     This script magically sets up pyplot lib so it displays an image on a secondary display
@@ -326,6 +1289,673 @@ def setup_fullscreen_plt_image():
     figManager.window.setFocus()
 
 
+# Registry of the hologram algorithms which can be selected with
+# c_p['SLM_algorithm']. All algorithms are called in the same way,
+#   algorithm(N, M, Delta, traps, **options)
+# where traps is a dict with the prepared xm, ym, zm, use_LGO, LGO_order and
+# the oversampling of GS_FFT, and options are image_width, nbr_iterations,
+# Phi, W, trap_phases, state, tolerance, max_time, workspace and nbr_workers.
+# Algorithms ignore the options they do not use.
+SLM_ALGORITHMS = {}
+
+
+def register_algorithm(name, delta_dtype=np.float64, iterative=True,
+    weighted=True, supports_z_and_LGO=True, multi_core=False, cost=''):
+    '''
+    Decorator which adds an algorithm to SLM_ALGORITHMS.
+
+    Parameters
+    ----------
+    name : string
+        Name used in c_p['SLM_algorithm'].
+    delta_dtype : dtype or None, optional
+        dtype of the Delta the algorithm needs, None if it does not use Delta
+        but works directly on the trap positions.
+    iterative : bool, optional
+        If the algorithm improves the phase over iterations. Only iterative
+        algorithms are warm started and decimated.
+    weighted : bool, optional
+        If the algorithm uses the trap weights W. Weighted iterative algorithms
+        also take fixed_weights, see GSW, and are used for camera feedback.
+    supports_z_and_LGO : bool, optional
+        False if the algorithm can only place traps in the focal plane without
+        LGO.
+    multi_core : bool, optional
+        If the algorithm uses several cores (nbr_workers).
+    cost : string, optional
+        Time per iteration and memory used, for the user.
+    '''
+    def decorator(function):
+        SLM_ALGORITHMS[name] = {
+            'function': function,
+            'delta_dtype': delta_dtype,
+            'iterative': iterative,
+            'weighted': weighted,
+            'supports_z_and_LGO': supports_z_and_LGO,
+            'multi_core': multi_core,
+            'cost': cost,
+        }
+        return function
+    return decorator
+
+
+@register_algorithm('GSW', cost='O(M*N) per iteration, M x N float64 Delta '
+                    'and M x N complex128 temporaries')
+def _GSW_algorithm(N, M, Delta, traps, workspace=None, nbr_workers=None,
+    **options):
+    return GSW(N, M, Delta, **options)
+
+
+@register_algorithm('GS', weighted=False, cost='Same as GSW')
+def _GS_algorithm(N, M, Delta, traps, W=None, workspace=None, nbr_workers=None,
+    **options):
+    return GS(N, M, Delta, **options)
+
+
+@register_algorithm('GSW_float32', delta_dtype=np.float32,
+    cost='O(M*N) per iteration, M x N float32 Delta and complex64 exp(i*Delta)')
+def _GSW_float32_algorithm(N, M, Delta, traps, nbr_workers=None, **options):
+    return GSW_float32(N, M, Delta, **options)
+
+
+@register_algorithm('GS_float32', delta_dtype=np.float32, weighted=False,
+    cost='Same as GSW_float32')
+def _GS_float32_algorithm(N, M, Delta, traps, W=None, nbr_workers=None,
+    **options):
+    return GS_float32(N, M, Delta, **options)
+
+
+@register_algorithm('GSW_tiled', delta_dtype=np.float32, multi_core=True,
+    cost='O(M*N/cores) per iteration, same memory as GSW_float32')
+@register_algorithm('GSW_quantized', delta_dtype=np.uint16, multi_core=True,
+    cost='O(M*N/cores) per iteration, M x N uint16 Delta only')
+def _GSW_tiled_algorithm(N, M, Delta, traps, **options):
+    return GSW_tiled(N, M, Delta, **options)
+
+
+@register_algorithm('GS_FFT', delta_dtype=None, supports_z_and_LGO=False,
+    cost='O(N*log(N)) per iteration independent of M, no Delta')
+def _GS_FFT_algorithm(N, M, Delta, traps, workspace=None, nbr_workers=None,
+    **options):
+    return GS_FFT(traps['xm'], traps['ym'], oversampling=traps['oversampling'],
+                  **options)
+
+
+@lru_cache(maxsize=4)
+def _get_LGO_field(image_width, order, image_height=None):
+    # exp(i*LGO phase), kept since it is slow to calculate compared to the
+    # separable superpositions.
+    field = np.exp(1j*get_LGO(image_width, order=order, image_height=image_height))
+    field.setflags(write=False)
+    return field
+
+
+def _separable_fields(coefficients, xm, ym, zm, use_LGO, order, image_width,
+    image_height=None):
+    # Field on the SLM, sum_m coefficients[m]*exp(i*Delta[m]), using that
+    # exp(i*Delta[m]) is the outer product of exp(i*phase_y[m]) and
+    # exp(i*phase_x[m]) (apart from the LGO). Two matrix products instead of
+    # M x N arrays.
+    phase_x, phase_y = get_trap_phase_vectors(xm, ym, zm, image_width,
+                                              image_height=image_height)
+    E_x = np.exp(1j*phase_x)
+    E_y = np.exp(1j*phase_y) * np.reshape(coefficients, (-1, 1))
+    LGO_traps = np.asarray(use_LGO, dtype=bool)
+    field = np.dot(E_y[~LGO_traps].T, E_x[~LGO_traps])
+    if np.any(LGO_traps):
+        field += _get_LGO_field(image_width, order, image_height) * \
+            np.dot(E_y[LGO_traps].T, E_x[LGO_traps])
+    return field, phase_x, phase_y
+
+
+def _separable_trap_fields(Phi, phase_x, phase_y, use_LGO, order, image_width,
+    image_height=None, aperture=None):
+    # V[m] = mean(exp(i*(Phi-Delta[m]))) with the separable Delta. Phi holds
+    # the active pixels only if there is an aperture.
+    shape = (np.shape(phase_y)[1], image_width)
+    if aperture is None:
+        E = np.exp(1j*np.reshape(Phi, shape))
+    else:
+        E = np.zeros(shape, dtype=np.complex128)
+        E[aperture] = np.exp(1j*np.ravel(Phi))
+    LGO_traps = np.asarray(use_LGO, dtype=bool)
+    V = np.empty(len(phase_x), dtype=np.complex128)
+    for selection, field in [(~LGO_traps, E), (LGO_traps, None)]:
+        if not np.any(selection):
+            continue
+        if field is None:
+            field = E * np.conj(_get_LGO_field(image_width, order, image_height))
+        V[selection] = np.sum(np.dot(np.exp(-1j*phase_y[selection]), field) *
+                          np.exp(-1j*phase_x[selection]), axis=1)
+    return V / (np.size(E) if aperture is None else np.size(Phi))
+
+
+def RS_traps(xm, ym, zm=None, use_LGO=None, order=-8, image_width=1080,
+    trap_phases=None, W=None, state=None, image_height=None, aperture=None):
+    '''
+    Random superposition calculated directly from the trap positions. Uses
+    that the phase of a trap is separable so no M x N arrays are created,
+    which makes it fast enough for an instant preview.
+
+    Parameters
+    ----------
+    xm, ym, zm, use_LGO, order : trap parameters as for get_delta.
+    image_width : int, optional
+        Width of the phasemask.
+    trap_phases : array, optional
+        Phases of the traps, random if None.
+    W : array, optional
+        Amplitudes of the traps, equal if None.
+    state : dict, optional
+        Filled in the same way as by GSW.
+    image_height, aperture : optional
+        Shape of the SLM and its active pixels as for GSW.
+
+    Returns
+    -------
+    phasemask
+    '''
+    start = time()
+    xm, ym, zm, use_LGO = _prepare_traps(xm, ym, zm, [] if use_LGO is None
+                                         else use_LGO)
+    M = len(xm)
+    if trap_phases is None or np.size(trap_phases) != M:
+        trap_phases = np.random.uniform(0, 2*pi, M)
+    if W is None or np.size(W) != M:
+        W = np.ones(M)
+    coefficients = np.reshape(W, M) * np.exp(1j*np.reshape(trap_phases, M))
+    field, phase_x, phase_y = _separable_fields(coefficients, xm, ym, zm,
+        use_LGO, order, image_width, image_height)
+    Phi = np.angle(field)
+    Phi = np.reshape(Phi, -1) if aperture is None else Phi[aperture]
+    if state is not None:
+        V = _separable_trap_fields(Phi, phase_x, phase_y, use_LGO, order,
+                                   image_width, image_height, aperture)
+        state['Phi'] = Phi
+        state['W'] = np.reshape(W, (M, 1))
+        state['trap_phases'] = np.angle(V)
+        _fill_report(state, np.abs(V), 0, start)
+    return _phase_to_mask(Phi, image_width, image_height, aperture)
+
+
+def RM_traps(xm, ym, zm=None, use_LGO=None, order=-8, image_width=1080,
+    state=None, image_height=None, aperture=None):
+    '''
+    Random mask encoding calculated directly from the trap positions, each
+    pixel gets the phase of a randomly chosen trap. Uses O(N) memory.
+    Parameters are the same as for RS_traps.
+    '''
+    start = time()
+    xm, ym, zm, use_LGO = _prepare_traps(xm, ym, zm, [] if use_LGO is None
+                                         else use_LGO)
+    M = len(xm)
+    phase_x, phase_y = get_trap_phase_vectors(xm, ym, zm, image_width,
+                                              image_height=image_height)
+    height = np.shape(phase_y)[1]
+    choice = np.random.randint(0, M, (height, image_width))
+    Phi = phase_y[choice, np.reshape(np.arange(height), (-1, 1))] + \
+        phase_x[choice, np.arange(image_width)]
+    LGO_traps = np.asarray(use_LGO, dtype=bool)
+    if np.any(LGO_traps):
+        Phi += np.where(LGO_traps[choice], get_LGO(image_width, order=order,
+                        image_height=image_height), 0)
+    Phi = np.angle(np.exp(1j*Phi))
+    Phi = np.reshape(Phi, -1) if aperture is None else Phi[aperture]
+    if state is not None:
+        V = _separable_trap_fields(Phi, phase_x, phase_y, use_LGO, order,
+                                   image_width, image_height, aperture)
+        state['Phi'] = Phi
+        state['W'] = np.ones((M, 1))
+        state['trap_phases'] = np.angle(V)
+        _fill_report(state, np.abs(V), 0, start)
+    return _phase_to_mask(Phi, image_width, image_height, aperture)
+
+
+@register_algorithm('RS', delta_dtype=None, iterative=False, weighted=False,
+    cost='Two (width x M) x (M x width) matrix products, no Delta')
+def _RS_algorithm(N, M, Delta, traps, image_width=1080, W=None,
+    trap_phases=None, state=None, image_height=None, aperture=None, **options):
+    return RS_traps(traps['xm'], traps['ym'], traps['zm'], traps['use_LGO'],
+        traps['LGO_order'], image_width, trap_phases, W, state, image_height,
+        aperture)
+
+
+@register_algorithm('RM', delta_dtype=None, iterative=False, weighted=False,
+    cost='O(N), no Delta')
+def _RM_algorithm(N, M, Delta, traps, image_width=1080, state=None,
+    image_height=None, aperture=None, **options):
+    return RM_traps(traps['xm'], traps['ym'], traps['zm'], traps['use_LGO'],
+        traps['LGO_order'], image_width, state, image_height, aperture)
+
+
+# The weighted algorithms gain nothing from the weights with only two traps
+two_trap_algorithms = {'GSW': 'GS', 'GSW_float32': 'GS_float32'}
+
+
+def get_SLM_c_p():
+    '''
+    Function for retrieving the default c_p needed by CreatePhasemaskThread.
+    '''
+    SLM_c_p = {
+        'SLM_algorithm': 'GSW', # Any algorithm in SLM_ALGORITHMS: GSW, GS,
+        # GSW_float32, GS_float32, GSW_tiled, GSW_quantized, GS_FFT, RS or RM
+        'SLM_preview': False, # Show a random superposition phasemask while
+        # the final phasemask is calculated.
+        'SLM_nbr_workers': None, # Threads used by GSW_tiled, None for all cores
+        'SLM_warm_start': True, # Start from the previous phasemask when the
+        # number of traps is unchanged, e.g. when moving traps in small steps.
+        'SLM_warm_start_iterations': 2, # Iterations used when warm starting.
+        'SLM_warm_start_max_displacement': 3e-6, # Largest move of a trap, in
+        # the units of xm, ym and zm, for which the previous phasemask is used
+        # as a warm start. Larger moves use all SLM_iterations.
+        'SLM_tolerance': None, # Stop GSW when 1-uniformity of the traps is
+        # below this value. None to always use all iterations.
+        'SLM_max_time': None, # Maximum time in s to spend on a phasemask.
+        'SLM_report': {}, # Iterations, uniformity, efficiency and time of the
+        # last phasemask.
+        'SLM_worker_process': False, # Calculate the phasemasks in a separate
+        # process, see SLM_worker.py.
+        'SLM_cache_directory': 'phasemask_cache', # Directory of the phasemask
+        # cache, None to not use the cache.
+        'SLM_cache_max_bytes': 2e9, # Size of the cache before old phasemasks
+        # are removed.
+        'SLM_precompile': True, # Calculate the phasemasks of the experiment
+        # schedule in advance, see SLM_precompiler.py.
+        'precompiled_phasemasks': {}, # Filled by the PhasemaskPrecompiler
+        'SLM_decimation': 1, # Run the algorithm on every SLM_decimation:th
+        # pixel first and refine on the full SLM, 2 or 4 for fast phasemasks.
+        'SLM_refine_iterations': 2, # Full resolution iterations after a
+        # decimated run.
+        'SLM_oversampling': 1, # Focal plane grid of GS_FFT, traps are rounded
+        # to 1/SLM_oversampling pixel. 1 is fastest but less uniform than GSW,
+        # 4 is close to GSW at several times the cost.
+        'SLM_trajectory_rate': 2, # Phasemasks per second when streaming a
+        # trajectory, see SLM_trajectory.py.
+        'trajectory_streaming': False,
+        'SLM_camera_feedback': 0, # Rounds of camera feedback after each new
+        # phasemask. Each round measures the traps in c_p['image'] and
+        # corrects the trap weights, 0 to turn feedback off.
+        'SLM_feedback_iterations': 3, # Iterations per feedback round
+        'SLM_feedback_gain': 1, # Exponent of the weight correction
+        'SLM_feedback_delay': 0.3, # s to wait for the SLM and camera before
+        # measuring the traps.
+        'SLM_feedback_radius': 3, # Half width in pixels of the measured
+        # area around each trap.
+        'phasemask_width': 1080, # Size of the SLM in pixels
+        'phasemask_height': 1080,
+        'SLM_aperture_radius': None, # Radius in pixels of the illuminated
+        # part of the SLM, only these pixels are calculated. None for all.
+        'SLM_LUT_file': None, # Calibration LUT of the SLM for the laser
+        # wavelength, see SLM_output.load_lut. None for a linear LUT.
+        'SLM_grating_x': 0, # Blazed grating in periods per pixel added to
+        'SLM_grating_y': 0, # the phasemasks to move the traps away from the
+        'SLM_zero_order_zm': 0, # zero order, as well as a focus offset.
+        'SLM_output': None, # SLM_output.PhasemaskOutput used for the display
+    }
+    return SLM_c_p
+
+
+def get_phasemask_cache(c_p):
+    '''
+    Returns the PhasemaskCache configured in c_p, None if the cache is not used.
+    '''
+    if c_p['SLM_cache_directory'] is None:
+        return None
+    return PhasemaskCache(c_p['SLM_cache_directory'], c_p['SLM_cache_max_bytes'])
+
+
+# Control parameters which determine the phasemask
+phasemask_parameter_names = ['xm', 'ym', 'zm', 'use_LGO', 'LGO_order',
+    'SLM_iterations', 'SLM_algorithm', 'SLM_nbr_workers', 'SLM_warm_start',
+    'SLM_warm_start_iterations', 'SLM_warm_start_max_displacement',
+    'SLM_tolerance', 'SLM_max_time',
+    'SLM_decimation', 'SLM_refine_iterations', 'SLM_feedback_iterations',
+    'SLM_oversampling']
+
+
+def get_phasemask_parameters(c_p):
+    '''
+    Copies the control parameters needed to calculate a phasemask from c_p.
+    The result is small and can be sent to another process.
+    '''
+    parameters = {}
+    for key in phasemask_parameter_names:
+        value = c_p[key]
+        parameters[key] = np.copy(value) if isinstance(value, np.ndarray) \
+            else value
+    return parameters
+
+
+def get_phasemask_cache_key(parameters, image_width=1080, image_height=None,
+    aperture_radius=None):
+    '''
+    Key of the phasemask described by parameters in the PhasemaskCache.
+    '''
+    xm, ym, zm, use_LGO = _prepare_traps(parameters['xm'], parameters['ym'],
+        parameters['zm'], parameters['use_LGO'])
+    return get_phasemask_key(xm, ym, zm, use_LGO, parameters['LGO_order'],
+        parameters['SLM_iterations'], parameters['SLM_algorithm'], image_width,
+        parameters['SLM_decimation'], image_height, aperture_radius,
+        parameters['SLM_oversampling'])
+
+
+class PhasemaskCalculator():
+    '''
+    Calculates phasemasks from a dict of trap parameters, see
+    get_phasemask_parameters. Keeps what can be reused between consecutive
+    phasemasks: the Delta rows of unchanged traps, the phase and weights of the
+    last phasemask for warm starts and the buffers of the single precision
+    kernels.
+    If a PhasemaskCache is given phasemasks are looked up in it before they
+    are calculated and new phasemasks are stored in it.
+    The SLM can be rectangular, image_height defaults to image_width, and
+    only the pixels within aperture_radius of its center are calculated if
+    aperture_radius is given, see get_aperture.
+    '''
+    def __init__(self, image_width=1080, cache=None, image_height=None,
+        aperture_radius=None):
+        self.image_width = image_width
+        self.image_height = image_width if image_height is None else image_height
+        self.aperture_radius = aperture_radius
+        self.aperture = get_aperture(image_width, self.image_height,
+                                     aperture_radius)
+        self.cache = cache
+        self.delta_cache = DeltaCache(image_width, image_height=self.image_height,
+                                      aperture=self.aperture)
+        self.coarse_delta_cache = None # Delta on the decimated grid
+        self.coarse_workspace = GSWorkspace()
+        self.state = {} # Phase and weights of the last phasemask, for warm starts
+        self.workspace = GSWorkspace() # Buffers for the single precision kernels
+
+    def get_cache_key(self, parameters):
+        '''
+        Key of the phasemask for parameters on this SLM, see
+        get_phasemask_cache_key.
+        '''
+        return get_phasemask_cache_key(parameters, self.image_width,
+            self.image_height, self.aperture_radius)
+
+    def set_phasemask(self, phasemask, parameters):
+        '''
+        Makes phasemask, e.g. from the cache, the starting point of the next
+        warm start and camera feedback. parameters are the trap parameters of
+        the phasemask. The trap phases are recalculated from the phasemask.
+        Weights are not stored with phasemasks so a warm start begins from
+        equal weights.
+        '''
+        xm, ym, zm, use_LGO = _prepare_traps(parameters['xm'], parameters['ym'],
+            parameters['zm'], parameters['use_LGO'])
+        Phi = phasemask_to_phase(phasemask)
+        if self.aperture is not None:
+            Phi = Phi[np.ravel(self.aperture)]
+        phase_x, phase_y = get_trap_phase_vectors(xm, ym, zm, self.image_width,
+            image_height=self.image_height)
+        V = _separable_trap_fields(Phi, phase_x, phase_y, use_LGO,
+            parameters['LGO_order'], self.image_width, self.image_height,
+            self.aperture)
+        self.state = {'Phi': Phi, 'W': np.ones((len(xm), 1)),
+                      'trap_phases': np.angle(V),
+                      'positions': np.array([xm, ym, zm])}
+
+    def get_warm_start_displacement(self, xm, ym, zm):
+        '''
+        Largest distance any trap has moved since the last phasemask, infinite
+        if the number of traps has changed or there is no last phasemask.
+        '''
+        if 'Phi' not in self.state or 'positions' not in self.state or \
+            np.shape(self.state['positions']) != (3, len(xm)):
+            return np.inf
+        moves = np.array([xm, ym, zm]) - self.state['positions']
+        return np.max(np.sqrt(np.sum(moves**2, axis=0)))
+
+    def calculate(self, parameters, feedback_W=None):
+        '''
+        Calculates a new phasemask.
+        If parameters['SLM_warm_start'] is True, the number of traps is
+        unchanged and no trap has moved further than
+        parameters['SLM_warm_start_max_displacement'] the algorithm is started
+        from the previous phase and trap weights and only
+        parameters['SLM_warm_start_iterations'] iterations are used.
+        With feedback_W, trap weights from measured intensities (see
+        calculate_feedback), the previous phasemask is instead improved with
+        parameters['SLM_feedback_iterations'] iterations in which the weights
+        are kept fixed. The cache is not used then since the result depends
+        on the measurement.
+        Only phasemasks calculated from scratch with all
+        parameters['SLM_iterations'] iterations on the full SLM are stored in
+        the cache, not warm started, decimated or stopped early ones.
+
+        Parameters
+        ----------
+        parameters : dict
+            Trap positions and algorithm settings with the keys in
+            phasemask_parameter_names.
+
+        Returns
+        -------
+        phasemask : array
+            The new phasemask.
+        report : dict
+            Iterations, uniformity, efficiency and time of the calculation.
+            Has the key 'cached' set to True if the phasemask was loaded from
+            the cache. After a decimated run (parameters['SLM_decimation'] > 1)
+            also 'coarse_uniformity', the uniformity on the decimated grid,
+            and 'uniformity_penalty', how much lower the final uniformity is.
+        '''
+        algorithm = parameters['SLM_algorithm']
+        xm, ym, zm, use_LGO = _prepare_traps(parameters['xm'], parameters['ym'],
+            parameters['zm'], parameters['use_LGO'])
+        M = len(xm)
+        use_cache = self.cache is not None and feedback_W is None
+        if use_cache:
+            start = time()
+            key = self.get_cache_key(parameters)
+            phasemask, report = self.cache.load(key)
+            if phasemask is not None:
+                self.set_phasemask(phasemask, parameters)
+                report['cached'] = True
+                report['time'] = time() - start
+                return phasemask, report
+        if algorithm not in SLM_ALGORITHMS:
+            print('Unknown SLM algorithm', algorithm, 'using GSW')
+            algorithm = 'GSW'
+        if not SLM_ALGORITHMS[algorithm]['supports_z_and_LGO'] and \
+            (np.any(zm != 0) or True in use_LGO):
+            print(algorithm, 'does not support zm or LGO, using GSW_float32')
+            algorithm = 'GSW_float32'
+        if M == 2 and algorithm in two_trap_algorithms and feedback_W is None:
+            print('Using normal Grechbgerg-Saxton')
+            algorithm = two_trap_algorithms[algorithm]
+        if feedback_W is not None and not (SLM_ALGORITHMS[algorithm]['weighted']
+            and SLM_ALGORITHMS[algorithm]['iterative']):
+            algorithm = 'GSW_float32'
+        spec = SLM_ALGORITHMS[algorithm]
+
+        displacement = self.get_warm_start_displacement(xm, ym, zm)
+        previous_state = self.state
+        self.state = {}
+        if feedback_W is not None:
+            Phi = previous_state['Phi']
+            W = feedback_W
+            trap_phases = previous_state['trap_phases']
+            nbr_iterations = parameters['SLM_feedback_iterations']
+        elif parameters['SLM_warm_start'] and displacement <= \
+            parameters['SLM_warm_start_max_displacement'] * (1 + 1e-9):
+            # The margin keeps moves of exactly the limit, which come out a
+            # rounding error larger, warm started.
+            # The phases of the traps carry over better than the phase on
+            # the SLM when the traps have moved.
+            Phi = previous_state['Phi']
+            W = previous_state['W']
+            trap_phases = previous_state.get('trap_phases', None)
+            nbr_iterations = parameters['SLM_warm_start_iterations']
+        else:
+            Phi = None
+            W = None
+            trap_phases = None
+            nbr_iterations = parameters['SLM_iterations']
+        cold_start = Phi is None and trap_phases is None
+
+        options = {
+            'image_width': self.image_width,
+            'nbr_iterations': nbr_iterations,
+            'Phi': Phi,
+            'W': W,
+            'trap_phases': trap_phases,
+            'state': self.state,
+            'tolerance': parameters['SLM_tolerance'],
+            'max_time': parameters['SLM_max_time'],
+            'workspace': self.workspace,
+            'nbr_workers': parameters['SLM_nbr_workers'],
+            'image_height': self.image_height,
+            'aperture': self.aperture,
+        }
+        if feedback_W is not None:
+            # The measured weights are not expected to give uniform trap
+            # fields in the model, so the tolerance does not apply.
+            options['fixed_weights'] = True
+            options['tolerance'] = None
+        traps = {'xm': xm, 'ym': ym, 'zm': zm, 'use_LGO': use_LGO,
+                 'LGO_order': parameters['LGO_order'],
+                 'oversampling': parameters['SLM_oversampling']}
+        kernel = spec['function']
+        dtype = spec['delta_dtype']
+        coarse_state = None
+        if dtype is None:
+            # Works directly on the trap positions, no need for Delta
+            phasemask = kernel(get_nbr_pixels(self.image_width,
+                self.image_height, self.aperture), M, None, traps, **options)
+        else:
+            if self.delta_cache.dtype != dtype:
+                self.delta_cache = DeltaCache(self.image_width, dtype=dtype,
+                    image_height=self.image_height, aperture=self.aperture)
+
+            # Calcualte new delta, only the traps which have changed are
+            # recalculated.
+            Delta, N, M = self.delta_cache.get_delta(xm=xm, ym=ym, zm=zm,
+                use_LGO=use_LGO,
+                order=parameters['LGO_order'])
+            print('Delta rows reused:', self.delta_cache.last_hits,
+                  'recalculated:', self.delta_cache.last_misses)
+
+            if parameters['SLM_decimation'] > 1 and spec['iterative'] and \
+                trap_phases is None:
+                coarse_state = self.calculate_coarse(kernel, options, parameters,
+                    dtype, traps)
+                # The trap phases and weights from the decimated grid give the
+                # full resolution phase directly, only a few iterations are
+                # needed to adjust the weights.
+                options['trap_phases'] = coarse_state['trap_phases']
+                options['W'] = coarse_state['W']
+                options['nbr_iterations'] = parameters['SLM_refine_iterations']
+            phasemask = kernel(N, M, Delta, traps, **options)
+        self.state['positions'] = np.array([xm, ym, zm])
+        report = {name: self.state[name] for name in
+            ['iterations', 'uniformity', 'efficiency', 'time']}
+        if coarse_state is not None:
+            report['time'] += coarse_state['time']
+            report['coarse_uniformity'] = coarse_state['uniformity']
+            report['uniformity_penalty'] = coarse_state['uniformity'] - \
+                report['uniformity']
+        if feedback_W is not None:
+            report['camera_feedback'] = True
+        # The key only describes a cold start with all SLM_iterations on the
+        # full grid, other results would be returned for it later.
+        complete = not spec['iterative'] or \
+            report['iterations'] >= parameters['SLM_iterations']
+        if use_cache and cold_start and coarse_state is None and complete:
+            self.cache.store(key, phasemask, report)
+        return phasemask, report
+
+    def calculate_feedback(self, parameters, intensities, gain=1):
+        '''
+        Improves the last phasemask using measured trap intensities, one
+        round of camera feedback. The trap weights of the last phasemask are
+        corrected with get_feedback_weights and kept fixed while the phase is
+        recalculated from the trap phases of the last phasemask.
+
+        Parameters
+        ----------
+        parameters : dict
+            Same parameters as for the last call to calculate.
+        intensities : list or array
+            Measured intensity of each trap, see measure_trap_intensities.
+        gain : float, optional
+            Strength of the correction, see get_feedback_weights.
+
+        Returns
+        -------
+        phasemask, report : as for calculate. phasemask is None if the last
+            phasemask does not match the measurement.
+        '''
+        M = len(_prepare_traps(parameters['xm'], parameters['ym'],
+                               parameters['zm'], parameters['use_LGO'])[0])
+        if self.state.get('trap_phases', None) is None or \
+            np.size(self.state['W']) != M or np.size(intensities) != M:
+            print('Camera feedback needs the last phasemask and one intensity per trap')
+            return None, {}
+        W = get_feedback_weights(self.state['W'], intensities, gain)
+        return self.calculate(parameters, feedback_W=W)
+
+    def calculate_coarse(self, kernel, options, parameters, dtype, traps):
+        '''
+        Runs kernel, an algorithm from SLM_ALGORITHMS, on the SLM grid
+        decimated by parameters['SLM_decimation'] with
+        parameters['SLM_iterations'] iterations.
+        Returns the state of the kernel, see GSW.
+        '''
+        decimation = parameters['SLM_decimation']
+        if self.coarse_delta_cache is None or \
+            self.coarse_delta_cache.dtype != dtype or \
+            self.coarse_delta_cache.decimation != decimation:
+            self.coarse_delta_cache = DeltaCache(self.image_width, dtype,
+                decimation, self.image_height, get_aperture(self.image_width,
+                self.image_height, self.aperture_radius, decimation))
+        Delta, N, M = self.coarse_delta_cache.get_delta(xm=traps['xm'],
+            ym=traps['ym'], zm=traps['zm'], use_LGO=traps['use_LGO'],
+            order=traps['LGO_order'])
+        coarse_state = {}
+        coarse_options = dict(options, state=coarse_state,
+            image_width=get_decimated_width(self.image_width, decimation),
+            image_height=get_decimated_width(self.image_height, decimation),
+            aperture=self.coarse_delta_cache.aperture,
+            nbr_iterations=parameters['SLM_iterations'],
+            workspace=self.coarse_workspace)
+        kernel(N, M, Delta, traps, **coarse_options)
+        return coarse_state
+
+    def preview(self, parameters):
+        '''
+        Quick random superposition phasemask (RS_traps) of the traps in
+        parameters, for showing something on the SLM while the final
+        phasemask is calculated. Starts from the trap phases of the previous
+        phasemask if the number of traps is unchanged.
+        '''
+        xm, ym, zm, use_LGO = _prepare_traps(parameters['xm'], parameters['ym'],
+            parameters['zm'], parameters['use_LGO'])
+        return RS_traps(xm, ym, zm, use_LGO, parameters['LGO_order'],
+            self.image_width, trap_phases=self.state.get('trap_phases', None),
+            W=self.state.get('W', None), image_height=self.image_height,
+            aperture=self.aperture)
+
+
+def SLM_loc_to_trap_loc(c_p, xm, ym):
+    '''
+    Updates the positions of the traps in the camera image,
+    c_p['traps_absolute_pos'] and c_p['traps_relative_pos'], from their
+    positions xm, ym on the SLM.
+    '''
+    tmp_x = [x * c_p['slm_to_pixel'] + c_p['slm_x_center'] for x in xm]
+    tmp_y = [y * c_p['slm_to_pixel'] + c_p['slm_y_center'] for y in ym]
+    c_p['traps_absolute_pos'] = np.asarray([tmp_x, tmp_y])
+    print('Traps are at: ', c_p['traps_absolute_pos'] )
+    # Relative to the AOI of the camera as in
+    # CameraControls.update_traps_relative_pos
+    left, up = (c_p['AOI'][0], c_p['AOI'][2]) if 'AOI' in c_p else (0, 0)
+    c_p['traps_relative_pos'] = np.asarray([[x - left for x in tmp_x],
+                                            [y - up for y in tmp_y]])
+
+
 class CreatePhasemaskThread(Thread):
     def __init__(self, threadID, name, c_p):
         '''
@@ -348,6 +1978,9 @@ class CreatePhasemaskThread(Thread):
         self.name = name
         self.setDaemon(True)
         self.c_p = c_p
+        self.calculator = PhasemaskCalculator(c_p['phasemask_width'],
+            get_phasemask_cache(c_p), c_p['phasemask_height'],
+            c_p['SLM_aperture_radius'])
 
     def run(self):
         '''
@@ -358,45 +1991,127 @@ class CreatePhasemaskThread(Thread):
         '''
         #global c_p
         c_p = self.c_p
-        c_p['xm'], c_p['ym'] = SLM.get_default_xm_ym()
+        c_p['xm'], c_p['ym'] = get_default_xm_ym()
         c_p['zm'] = np.zeros(len(c_p['xm']))
-        Delta, N, M = SLM.get_delta(xm=c_p['xm'], ym=c_p['ym'], zm=c_p['zm'],
-            use_LGO=c_p['use_LGO'],
-            order=c_p['LGO_order'])
+        self.calculate_phasemask()
 
-        c_p['phasemask'] = SLM.GSW(
-            N, M, Delta, nbr_iterations=c_p['SLM_iterations'])
-
-        c_p['phasemask_updated'] = True
-        SLM_loc_to_trap_loc(xm=c_p['xm'], ym=c_p['ym'])
+        self.publish_phasemask()
+        SLM_loc_to_trap_loc(c_p, c_p['xm'], c_p['ym'])
 
         c_p['traps_occupied'] =\
             [False for i in range(len(c_p['traps_absolute_pos'][0]))]
+        self.camera_feedback()
 
         while c_p['program_running']:
             if c_p['new_phasemask']:
-                # Calcualte new delta and phasemask
-                Delta, N, M = SLM.get_delta(xm=c_p['xm'], ym=c_p['ym'],
-                    zm=c_p['zm'],
-                    use_LGO=c_p['use_LGO'],
-                    order=c_p['LGO_order'])
-                if M==2:
-                    print('Using normal Grechbgerg-Saxton since there are 2 traps')
-                    c_p['phasemask'] = SLM.GS(
-                        N, M, Delta,
-                        nbr_iterations=c_p['SLM_iterations'])
-                else:
-                    c_p['phasemask'] = SLM.GSW(
-                        N, M, Delta,
-                        nbr_iterations=c_p['SLM_iterations'])
+                self.calculate_phasemask()
                 # if c_p['save_phasemask']:
                 #     save_phasemask()
-                c_p['phasemask_updated'] = True
+                self.publish_phasemask()
                 c_p['new_phasemask'] = False
 
                 # Update the number of traps and their position
-                SLM_loc_to_trap_loc(xm=c_p['xm'], ym=c_p['ym'])
+                SLM_loc_to_trap_loc(c_p, c_p['xm'], c_p['ym'])
                 print(c_p['traps_absolute_pos'])
                 c_p['traps_occupied'] =\
                     [False for i in range(len(c_p['traps_absolute_pos'][0]))]
-            time.sleep(0.5)
+                self.camera_feedback()
+            sleep(0.5)
+
+    def publish_phasemask(self):
+        '''
+        Tells the SLM window that c_p['phasemask'] is new. The phasemask is
+        first converted to its display buffer by c_p['SLM_output'], if used,
+        so that the window does not need to convert it.
+        '''
+        c_p = self.c_p
+        if c_p['SLM_output'] is not None:
+            c_p['SLM_output'].get_display_buffer(c_p['phasemask'])
+        c_p['phasemask_updated'] = True
+
+    def use_precompiled_phasemask(self, parameters):
+        '''
+        Puts the phasemask for parameters in c_p['phasemask'] if it has been
+        precompiled. Returns True if the phasemask was found.
+        '''
+        c_p = self.c_p
+        key = self.calculator.get_cache_key(parameters)
+        if key not in c_p['precompiled_phasemasks']:
+            return False
+        phasemask, report = c_p['precompiled_phasemasks'][key]
+        self.set_phasemask(phasemask, parameters)
+        c_p['phasemask'] = phasemask
+        c_p['SLM_report'] = dict(report, precompiled=True)
+        print('Using precompiled phasemask')
+        return True
+
+    def set_phasemask(self, phasemask, parameters):
+        '''
+        Makes phasemask, which was not calculated by this thread, the starting
+        point of the next warm start and camera feedback, see
+        PhasemaskCalculator.set_phasemask.
+        '''
+        self.calculator.set_phasemask(phasemask, parameters)
+
+    def show_preview(self, parameters):
+        '''
+        Shows a quick preview phasemask if c_p['SLM_preview'] is True.
+        '''
+        c_p = self.c_p
+        if not c_p['SLM_preview'] or \
+            parameters['SLM_algorithm'] in ['RS', 'RM']:
+            return
+        c_p['phasemask'] = self.calculator.preview(parameters)
+        self.publish_phasemask()
+
+    def calculate_phasemask(self):
+        '''
+        Calculates a new phasemask from the current control parameters and
+        puts it in c_p['phasemask'].
+        '''
+        c_p = self.c_p
+        parameters = get_phasemask_parameters(c_p)
+        if self.use_precompiled_phasemask(parameters):
+            return
+        self.show_preview(parameters)
+        c_p['phasemask'], c_p['SLM_report'] = self.calculator.calculate(
+            parameters)
+        c_p['delta_cache_stats'] = self.calculator.delta_cache.get_stats()
+        print('Phasemask report:', c_p['SLM_report'])
+
+    def calculate_feedback_phasemask(self, parameters, intensities):
+        '''
+        One round of camera feedback, see PhasemaskCalculator.calculate_feedback.
+        Returns the new phasemask, None if it could not be calculated, and
+        the report.
+        '''
+        return self.calculator.calculate_feedback(parameters, intensities,
+            self.c_p['SLM_feedback_gain'])
+
+    def camera_feedback(self):
+        '''
+        Evens out the trap intensities seen by the camera with
+        c_p['SLM_camera_feedback'] rounds of feedback. Each round waits
+        c_p['SLM_feedback_delay'] for the current phasemask to show up in
+        c_p['image'], measures the traps at c_p['traps_relative_pos'] and
+        updates the phasemask with the corrected trap weights.
+        Stops early if a new phasemask is requested.
+        '''
+        c_p = self.c_p
+        parameters = get_phasemask_parameters(c_p)
+        for feedback_round in range(c_p['SLM_camera_feedback']):
+            sleep(c_p['SLM_feedback_delay'])
+            if not c_p['program_running'] or c_p['new_phasemask']:
+                return
+            intensities = measure_trap_intensities(c_p['image'],
+                c_p['traps_relative_pos'][0], c_p['traps_relative_pos'][1],
+                c_p['SLM_feedback_radius'])
+            phasemask, report = self.calculate_feedback_phasemask(parameters,
+                                                                  intensities)
+            if phasemask is None:
+                return
+            c_p['phasemask'] = phasemask
+            c_p['SLM_report'] = report
+            self.publish_phasemask()
+            print('Camera feedback round', feedback_round + 1, 'intensities:',
+                  intensities)
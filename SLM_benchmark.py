@@ -0,0 +1,317 @@
+# Benchmarks for the phasemask calculations in SLM.py
+import numpy as np
+import tracemalloc, io, contextlib, json, platform
+from math import pi, ceil, sqrt
+from time import time
+from datetime import datetime
+from os import cpu_count
+import SLM
+import SLM_simulation
+
+
+def legacy_get_LGO(image_width=1080, order=-8):
+    '''
+    The original implementation of SLM.get_LGO which uses atan2_vec_2d to
+    loop over every pixel of the SLM. Used as reference in the benchmarks.
+    '''
+    xc = image_width / 2
+    yc = image_width / 2
+    xxx, yyy = np.meshgrid(np.linspace(1, image_width, image_width),
+                    np.linspace(1, image_width, image_width))
+    return np.mod((order * SLM.atan2_vec_2d(yyy-yc, xxx-xc)), (2*pi))
+
+
+def benchmark_LGO(image_widths=[512, 1080, 1920], order=-8):
+    '''
+    Compares the time needed to calculate the LGO phase with the legacy
+    pixel-by-pixel implementation, the vectorized one and the cached one.
+
+    Parameters
+    ----------
+    image_widths : list of ints, optional
+        Widths of the (square) phasemasks to time.
+    order : int, optional
+        Order of the LGO.
+
+    Returns
+    -------
+    results : list of dicts
+        One dict per width with the times in seconds and the largest difference
+        between the legacy and the new phase.
+    '''
+    results = []
+    for image_width in image_widths:
+        start = time()
+        reference = legacy_get_LGO(image_width, order=order)
+        legacy_time = time() - start
+
+        SLM._get_LGO_cached.cache_clear()
+        start = time()
+        LGO = SLM.get_LGO(image_width, order=order)
+        vectorized_time = time() - start
+
+        start = time()
+        SLM.get_LGO(image_width, order=order)
+        cached_time = time() - start
+
+        # Phases close to 0 and 2pi are the same
+        difference = np.abs(reference - LGO)
+        max_error = np.max(np.minimum(difference, 2*pi - difference))
+
+        result = {
+            'image_width': image_width,
+            'legacy_time': legacy_time,
+            'vectorized_time': vectorized_time,
+            'cached_time': cached_time,
+            'max_error': max_error,
+        }
+        print('Width', image_width, 'legacy:', round(legacy_time, 4),
+              's vectorized:', round(vectorized_time, 4),
+              's cached:', round(cached_time, 6), 's max error:', max_error)
+        results.append(result)
+    return results
+
+
+def run_measured(function, *args, **kwargs):
+    '''
+    Calls function(*args, **kwargs) and measures the time and the peak memory
+    allocated during the call. Output printed by the function is suppressed.
+
+    Returns
+    -------
+    result, time in seconds, peak memory in bytes
+    '''
+    tracemalloc.start()
+    start = time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    duration = time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def benchmark_GSW_kernels(trap_counts=[4, 9, 25], image_width=1080,
+    nbr_iterations=10):
+    '''
+    Compares time and peak memory of GSW/GS with the single precision
+    in-place kernels GSW_float32/GS_float32. Delta is calculated outside of
+    the measurement and each kernel gets Delta in its own precision.
+
+    Returns
+    -------
+    results : list of dicts
+        One dict per kernel and trap count.
+    '''
+    kernels = [
+        ('GSW', SLM.GSW, np.float64),
+        ('GSW_float32', SLM.GSW_float32, np.float32),
+        ('GS', SLM.GS, np.float64),
+        ('GS_float32', SLM.GS_float32, np.float32),
+    ]
+    results = []
+    for nbr_traps in trap_counts:
+        nbr_rows = int(np.ceil(np.sqrt(nbr_traps)))
+        xm, ym = SLM.get_xm_ym_rect(nbr_rows, nbr_rows, dx=20e-6, dy=20e-6)
+        xm, ym = xm[:nbr_traps], ym[:nbr_traps]
+        for name, kernel, dtype in kernels:
+            Delta, N, M = SLM.get_delta(image_width, xm, ym, dtype=dtype)
+            state = {}
+            options = {'workspace': SLM.GSWorkspace()} if dtype == np.float32 else {}
+            np.random.seed(0)
+            _, duration, peak = run_measured(kernel, N, M, Delta,
+                image_width=image_width, nbr_iterations=nbr_iterations,
+                state=state, **options)
+            del Delta
+            result = {
+                'kernel': name,
+                'nbr_traps': M,
+                'image_width': image_width,
+                'time': duration,
+                'peak_memory': peak,
+                'uniformity': state['uniformity'],
+                'efficiency': state['efficiency'],
+            }
+            print(name, 'traps:', M, 'time:', round(duration, 3), 's peak memory:',
+                  round(peak/1e6, 1), 'MB uniformity:', round(state['uniformity'], 4))
+            results.append(result)
+    return results
+
+
+def get_benchmark_layouts(trap_counts=[4, 9, 25], d=20e-6):
+    '''
+    Trap layouts used by benchmark_suite: rectangular and hexagonal lattices
+    with each of the trap_counts and the default layout of
+    SLM.get_default_xm_ym.
+
+    Returns
+    -------
+    layouts : list of (name, xm, ym) tuples
+    '''
+    layouts = []
+    for nbr_traps in trap_counts:
+        nbr_rows = ceil(sqrt(nbr_traps))
+        xm, ym = SLM.get_xm_ym_rect(nbr_rows, nbr_rows, dx=d, dy=d)
+        layouts.append(('rect', xm[:nbr_traps], ym[:nbr_traps]))
+        xm, ym = SLM.hexagonal_lattice(nbr_rows, nbr_rows, -115e-6, -115e-6, d)
+        layouts.append(('hexagonal', xm[:nbr_traps], ym[:nbr_traps]))
+    xm, ym = SLM.get_default_xm_ym()
+    layouts.append(('default', xm, ym))
+    return layouts
+
+
+def evaluate_phasemask(phasemask, xm, ym, zm=None, use_LGO=None, order=-8):
+    '''
+    Calculates the trap fields V of a phasemask independently of the algorithm
+    which made it, using the separable trap phase.
+
+    Returns
+    -------
+    uniformity, efficiency of the traps.
+    '''
+    image_height, image_width = np.shape(phasemask)
+    xm, ym, zm, use_LGO = SLM._prepare_traps(xm, ym, zm,
+        [] if use_LGO is None else use_LGO)
+    phase_x, phase_y = SLM.get_trap_phase_vectors(xm, ym, zm, image_width,
+                                                  image_height=image_height)
+    Phi = SLM.phasemask_to_phase(phasemask)
+    V_abs = np.abs(SLM._separable_trap_fields(Phi, phase_x, phase_y, use_LGO,
+                                              order, image_width, image_height))
+    return float(SLM.get_uniformity(V_abs)), float(SLM.get_efficiency(V_abs))
+
+
+def benchmark_suite(trap_counts=[4, 9, 25], image_widths=[540, 1080],
+    LGO_options=[False, True], z_offsets=[0, 5e-6],
+    algorithms=['GSW_float32', 'GSW_tiled', 'GSW_quantized', 'GS_FFT', 'RS'],
+    nbr_iterations=10, output_file='SLM_benchmark_results.json'):
+    '''
+    Calculates phasemasks for all combinations of trap layout (see
+    get_benchmark_layouts), SLM width, LGO, z-offset of the traps and
+    algorithm with SLM.PhasemaskCalculator, starting from scratch each time.
+    Combinations which an algorithm does not support (z or LGO for GS_FFT)
+    are skipped.
+    GS_FFT rounds the traps to its FFT grid, so its simulated uniformity is
+    close to 1 while the uniformity at the real trap positions is only about
+    0.7-0.8 and the efficiency about 0.5, compared with 0.99 and 0.9 for GSW.
+
+    Parameters
+    ----------
+    trap_counts : list of ints, optional
+        Numbers of traps of the lattice layouts.
+    image_widths : list of ints, optional
+        Widths of the phasemask.
+    LGO_options : list of bools, optional
+        Run without and/or with LGO on all traps.
+    z_offsets : list of floats, optional
+        zm of all traps.
+    algorithms : list of strings, optional
+        Names in SLM.SLM_ALGORITHMS.
+    nbr_iterations : int, optional
+        Iterations of the iterative algorithms.
+    output_file : string, optional
+        JSON file the results are written to, None to not write a file.
+
+    Returns
+    -------
+    results : list of dicts
+        One dict per combination with the wall time, peak memory
+        (tracemalloc), iterations and the uniformity and efficiency of the
+        traps as evaluated by evaluate_phasemask and as simulated in the
+        focal plane by SLM_simulation.get_simulated_quality.
+    '''
+    results = []
+    parameters = SLM.get_phasemask_parameters(dict(SLM.get_SLM_c_p(),
+        xm=[], ym=[], zm=None, use_LGO=[False], LGO_order=-8,
+        SLM_iterations=nbr_iterations))
+    parameters['SLM_warm_start'] = False
+    for layout, xm, ym in get_benchmark_layouts(trap_counts):
+        M = len(xm)
+        for image_width in image_widths:
+            for LGO in LGO_options:
+                for z_offset in z_offsets:
+                    zm = np.full(M, z_offset)
+                    use_LGO = [LGO] * M
+                    for algorithm in algorithms:
+                        spec = SLM.SLM_ALGORITHMS[algorithm]
+                        if not spec['supports_z_and_LGO'] and (LGO or z_offset):
+                            continue
+                        calculator = SLM.PhasemaskCalculator(image_width)
+                        (phasemask, report), duration, peak = run_measured(
+                            calculator.calculate, dict(parameters, xm=xm, ym=ym,
+                            zm=zm, use_LGO=use_LGO, SLM_algorithm=algorithm))
+                        uniformity, efficiency = evaluate_phasemask(phasemask,
+                            xm, ym, zm, use_LGO, parameters['LGO_order'])
+                        # Independent check on the discretized focal plane,
+                        # LGO and defocused traps are spread over more pixels
+                        simulated_uniformity, simulated_efficiency = \
+                            SLM_simulation.get_simulated_quality(phasemask,
+                            xm, ym, trap_radius=2 if LGO or z_offset else 1)
+                        del calculator, phasemask
+                        result = {
+                            'layout': layout,
+                            'nbr_traps': M,
+                            'image_width': image_width,
+                            'LGO': LGO,
+                            'z_offset': z_offset,
+                            'algorithm': algorithm,
+                            'time': duration,
+                            'peak_memory': peak,
+                            'iterations': report['iterations'],
+                            'uniformity': uniformity,
+                            'efficiency': efficiency,
+                            'simulated_uniformity': simulated_uniformity,
+                            'simulated_efficiency': simulated_efficiency,
+                        }
+                        print(layout, M, 'traps width:', image_width, 'LGO:', LGO,
+                              'z:', z_offset, algorithm, 'time:', round(duration, 3),
+                              's peak memory:', round(peak/1e6, 1),
+                              'MB uniformity:', round(uniformity, 4))
+                        results.append(result)
+    if output_file is not None:
+        with open(output_file, 'w') as file:
+            json.dump({
+                'date': datetime.now().isoformat(),
+                'platform': platform.platform(),
+                'cpu_count': cpu_count(),
+                'numpy_version': np.__version__,
+                'results': results,
+                }, file, indent=1)
+    return results
+
+
+def compare_benchmarks(baseline_file, new_file, time_tolerance=0.1,
+    uniformity_tolerance=0.01):
+    '''
+    Compares two result files of benchmark_suite and prints the combinations
+    which became more than time_tolerance (relative) slower or lost more than
+    uniformity_tolerance in uniformity.
+
+    Returns
+    -------
+    regressions : list of (baseline result, new result) tuples
+    '''
+    keys = ['layout', 'nbr_traps', 'image_width', 'LGO', 'z_offset', 'algorithm']
+    with open(baseline_file) as file:
+        baseline = {tuple(result[key] for key in keys): result
+                    for result in json.load(file)['results']}
+    with open(new_file) as file:
+        new_results = json.load(file)['results']
+    regressions = []
+    for new in new_results:
+        old = baseline.get(tuple(new[key] for key in keys), None)
+        if old is None:
+            continue
+        if new['time'] > old['time'] * (1 + time_tolerance) or \
+            new['uniformity'] < old['uniformity'] - uniformity_tolerance:
+            print('Regression in', [new[key] for key in keys], 'time:',
+                  round(old['time'], 3), '->', round(new['time'], 3),
+                  'uniformity:', round(old['uniformity'], 4), '->',
+                  round(new['uniformity'], 4))
+            regressions.append((old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    benchmark_LGO()
+    benchmark_GSW_kernels()
+    benchmark_suite()
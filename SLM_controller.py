@@ -20,13 +20,15 @@ def get_default_c_p(
     '''
     Function for creating starting parameters of phasemask
     '''
-    c_p = {
+    c_p = SLM.get_SLM_c_p() # Algorithm settings, see SLM.get_SLM_c_p
+    c_p.update({
         'new_phasemask' : False, # True if the phasemask is to be recalculated
         'phasemask_updated' : False, # True if the phasemask image needs to be updated
         'SLM_iterations' : int(SLM_iterations),
         'trap_separation' : 20e-6,
         'phasemask_width' : int(phasemask_width),
         'phasemask_height' : int(phasemask_height),
+        'SLM_aperture_radius' : None, # Only calculate the illuminated pixels
         'experiment_running' : True,
         'phasemask_position' : 2340,
         'SLM_algorithm' : 'GSW',
@@ -49,7 +51,7 @@ def get_default_c_p(
         'LGO_order':-8,
 
         # TODO add display option for traps locations
-    }
+    })
     c_p['phasemask'] = np.zeros((c_p['phasemask_height'],c_p['phasemask_width']))
 
     c_p['traps_absolute_pos'] = np.zeros((2,1)) # This will need updating
@@ -99,6 +101,15 @@ def update_trap_locs():
     SLM_loc_to_trap_loc(c_p['xm'], c_p['ym'])
 
 
+def get_aperture():
+    '''
+    Active aperture of the SLM set by c_p['SLM_aperture_radius'], see
+    SLM.get_aperture.
+    '''
+    return SLM.get_aperture(c_p['phasemask_width'], c_p['phasemask_height'],
+                            c_p['SLM_aperture_radius'])
+
+
 class CreateSLMThread(threading.Thread):
     '''
     Thread for calculating the new phasemasks in the background.
@@ -108,46 +119,40 @@ class CreateSLMThread(threading.Thread):
         self.threadID = threadID
         self.name = name
         self.setDaemon(True)
+        self.calculator = SLM.PhasemaskCalculator(c_p['phasemask_width'],
+            SLM.get_phasemask_cache(c_p), c_p['phasemask_height'],
+            c_p['SLM_aperture_radius'])
         update_xm_ym()
 
     def run(self):
         global c_p
         update_xm_ym()
         c_p['zm'] = np.ones(len(c_p['xm'])) * c_p['d0z']
-
-        Delta, N, M = SLM.get_delta(xm=c_p['xm'],
-            ym=c_p['ym'],
-            zm=c_p['zm'],
-            use_LGO=c_p['use_LGO'],
-            order = c_p['LGO_order'])
-        self.generate_phasemask(Delta, N, M)
+        self.generate_phasemask()
         c_p['phasemask_updated'] = True
 
         while c_p['experiment_running']:
             if c_p['new_phasemask']:
-                # Calcualte new delta and phasemask
+                # Calcualte new phasemask
                 c_p['zm'] = np.ones(len(c_p['xm'])) * c_p['d0z']
-                Delta,N,M = SLM.get_delta(xm=c_p['xm'],
-                    ym=c_p['ym'],
-                    zm=c_p['zm'],
-                    use_LGO=c_p['use_LGO'],
-                    order=c_p['LGO_order'],
-                    x_comp=c_p['x_comp'],
-                    y_comp=c_p['y_comp'])
-                self.generate_phasemask(Delta,N,M)
+                self.generate_phasemask()
 
                 # Let the other threads know that a new phasemask has been calculated
                 c_p['phasemask_updated'] = True
                 c_p['new_phasemask'] = False
             time.sleep(1)
-    def generate_phasemask(self,Delta,N,M):
+    def generate_phasemask(self):
+        '''
+        Calculates the phasemask of the traps in c_p with the algorithm
+        c_p['SLM_algorithm'], any of SLM.SLM_ALGORITHMS.
+        '''
         global c_p
-        if c_p['SLM_algorithm'] == 'GSW':
-            c_p['phasemask'] = SLM.GSW(N, M, Delta,
-                nbr_iterations=c_p['SLM_iterations'])
-        elif c_p['SLM_algorithm'] == 'GS':
-            c_p['phasemask'] = SLM.GS(N, M, Delta,
-                nbr_iterations=c_p['SLM_iterations'])
+        parameters = SLM.get_phasemask_parameters(c_p)
+        # The calculator does not compensate the lateral shift caused by zm
+        parameters['xm'], parameters['ym'] = SLM.compensate_z(c_p['xm'],
+            c_p['ym'], c_p['zm'], c_p['x_comp'], c_p['y_comp'])
+        c_p['phasemask'], c_p['SLM_report'] = self.calculator.calculate(
+            parameters)
 
 
     def calculate_trap_position():
@@ -241,11 +246,9 @@ class TkinterDisplay:
 
     def create_algorithm_selection(self, x_pos, y_pos):
         self.selected_algorithm = StringVar()
-        self.selected_algorithm.set('GSW')
-        self.gsw_button = Radiobutton(self.window, text='GSW', value='GSW', variable=self.selected_algorithm)
-        self.gs_button = Radiobutton(self.window, text='GS', value='GS', variable=self.selected_algorithm)
-        self.gsw_button.place(x=x_pos, y=y_pos)
-        self.gs_button.place(x=x_pos+50, y=y_pos)
+        self.algorithm_menu = OptionMenu(self.window, self.selected_algorithm,
+            c_p['SLM_algorithm'], *SLM.SLM_ALGORITHMS)
+        self.algorithm_menu.place(x=x_pos, y=y_pos)
 
     def create_LGO_selection(self, x_pos, y_pos):
         self.toggle_LGO = BooleanVar()
@@ -401,10 +404,10 @@ class TkinterDisplay:
         '''
         position_text = 'Current dx is: ' + str(c_p['dx'])+' px. Current dy is: ' + str(c_p['dy']) + ' px'
         position_text += '\n Number of iterations set to: ' +str(c_p['SLM_iterations'])
-        if c_p['SLM_algorithm'] == 'GS':
-            position_text += '\n Using Grechbgerg-Saxton algorithm'
-        else:
-            position_text += '\n Using Weighted Grechbgerg-Saxton algorithm'
+        position_text += '\n Using ' + c_p['SLM_algorithm'] + ' algorithm'
+        if c_p['SLM_algorithm'] == 'GS_FFT' and c_p['SLM_oversampling'] < 4:
+            position_text += '\n Warning: GS_FFT rounds the traps to its grid,' +\
+                ' less uniform than GSW unless SLM_oversampling is 4'
         self.position_label.config(text=position_text)
 
         setup_text = 'x-positions are : ' + str(c_p['traps_absolute_pos'][0])
@@ -0,0 +1,161 @@
+# Output stage between the phasemask algorithms and the SLM window.
+# The algorithms return float phasemasks, 128+Phi*255/(2*pi), which the SLM
+# window used to convert with PIL on every refresh and which ignore the
+# nonlinear phase response of the SLM. Here a phasemask is quantized once into
+# a uint8 buffer through a calibration lookup table (LUT) for the laser
+# wavelength, optionally adding a blazed grating and a focus offset which
+# move the traps away from the undiffracted zero order. The offset planes are
+# cached and the display buffers are reused, so the SLM window gets a buffer
+# it can show directly.
+import numpy as np
+from functools import lru_cache
+from math import pi
+import SLM
+
+# Number of phase levels between the phasemask and the LUT. A power of 2 so
+# that the phase can be wrapped with a bitwise and.
+lut_levels = 1024
+
+
+def get_linear_lut():
+    '''
+    LUT which reproduces the uncalibrated phasemask, gray level
+    128+Phi*255/(2*pi) for the phase Phi in [-pi, pi).
+    '''
+    phase = 2*pi*np.arange(lut_levels)/lut_levels
+    phase[phase >= pi] -= 2*pi
+    return np.clip(np.rint(128 + phase*255/(2*pi)), 0, 255).astype(np.uint8)
+
+
+def load_lut(path):
+    '''
+    Loads a calibration LUT of the SLM for the laser wavelength.
+
+    Parameters
+    ----------
+    path : string
+        .npy or text file with the gray levels (0-255) which give the phases
+        2*pi*k/L, k = 0...L-1, for any number of entries L.
+
+    Returns
+    -------
+    lut : array of lut_levels uint8
+        The LUT resampled to lut_levels entries. The linear LUT if the file
+        could not be read.
+    '''
+    try:
+        if path.endswith('.npy'):
+            raw_lut = np.load(path)
+        else:
+            raw_lut = np.loadtxt(path)
+    except (OSError, ValueError) as e:
+        print('Could not load SLM LUT', path, e, 'using a linear LUT')
+        return get_linear_lut()
+    raw_lut = np.ravel(raw_lut)
+    indices = (np.arange(lut_levels) * len(raw_lut)) // lut_levels
+    return np.clip(np.rint(raw_lut[indices]), 0, 255).astype(np.uint8)
+
+
+@lru_cache(maxsize=4)
+def get_offset_plane(image_width, image_height, grating_x=0, grating_y=0, zm=0):
+    '''
+    Phase added to every phasemask, in units of LUT levels, plus the constants
+    which turn a phasemask into rounded LUT indices, see
+    PhasemaskOutput.convert.
+
+    Parameters
+    ----------
+    image_width, image_height : int
+        Size of the SLM.
+    grating_x, grating_y : float, optional
+        Blazed grating in periods per pixel along x and y.
+    zm : float, optional
+        Focus offset of all traps, same units as the zm of the traps.
+
+    Returns
+    -------
+    plane : image_height x image_width float32 array
+        Read only.
+    '''
+    phase_x, phase_y = SLM.get_trap_phase_vectors([0], [0], [zm], image_width,
+                                                  image_height=image_height)
+    x = np.arange(image_width)
+    y = np.reshape(np.arange(image_height), (-1, 1))
+    phase = phase_x[0] + np.reshape(phase_y[0], (-1, 1)) + \
+        2*pi*(grating_x*x + grating_y*y)
+    plane = np.mod(np.rint(phase * lut_levels / (2*pi)), lut_levels)
+    # Phasemasks are 128+Phi*255/(2*pi), remove the 128, add one period to
+    # keep the values positive and 0.5 to round when truncating.
+    plane += lut_levels - 128 * lut_levels / 255 + 0.5
+    plane = plane.astype(np.float32)
+    plane.setflags(write=False)
+    return plane
+
+
+class PhasemaskOutput():
+    '''
+    Converts phasemasks to uint8 buffers for the SLM window. Two display
+    buffers are used alternately so a new phasemask is never written to the
+    buffer currently shown.
+    '''
+    def __init__(self, image_width=1080, image_height=None, lut=None,
+        grating_x=0, grating_y=0, zm=0):
+        '''
+        Parameters
+        ----------
+        image_width, image_height : int, optional
+            Size of the SLM, image_height defaults to image_width.
+        lut : array, optional
+            Calibration LUT from load_lut, linear if None.
+        grating_x, grating_y, zm : float, optional
+            Offsets added to every phasemask, see get_offset_plane.
+        '''
+        self.image_width = image_width
+        self.image_height = image_width if image_height is None else image_height
+        shape = (self.image_height, image_width)
+        self.lut = get_linear_lut() if lut is None else lut
+        self.offset = get_offset_plane(image_width, self.image_height,
+                                       grating_x, grating_y, zm)
+        self.phase_buffer = np.empty(shape, dtype=np.float32)
+        self.index_buffer = np.empty(shape, dtype=np.int32)
+        self.display_buffers = [np.empty(shape, dtype=np.uint8) for _ in range(2)]
+        self.buffer_index = 0
+        self.source = None # The phasemask in the current display buffer
+
+    def convert(self, phasemask):
+        '''
+        Converts phasemask to gray levels of the SLM.
+
+        Returns
+        -------
+        buffer : image_height x image_width uint8 array
+            Owned by PhasemaskOutput, valid until the next but one call.
+        '''
+        self.buffer_index = (self.buffer_index + 1) % len(self.display_buffers)
+        buffer = self.display_buffers[self.buffer_index]
+        np.multiply(phasemask, lut_levels / 255, out=self.phase_buffer,
+                    casting='same_kind')
+        self.phase_buffer += self.offset
+        np.copyto(self.index_buffer, self.phase_buffer, casting='unsafe')
+        np.bitwise_and(self.index_buffer, lut_levels - 1, out=self.index_buffer)
+        np.take(self.lut, self.index_buffer, out=buffer)
+        self.source = phasemask
+        return buffer
+
+    def get_display_buffer(self, phasemask):
+        '''
+        Returns the display buffer of phasemask, converting it only if it is
+        not the phasemask converted last.
+        '''
+        if phasemask is not self.source:
+            return self.convert(phasemask)
+        return self.display_buffers[self.buffer_index]
+
+
+def get_phasemask_output(c_p):
+    '''
+    Creates the PhasemaskOutput configured in c_p.
+    '''
+    lut = None if c_p['SLM_LUT_file'] is None else load_lut(c_p['SLM_LUT_file'])
+    return PhasemaskOutput(c_p['phasemask_width'], c_p['phasemask_height'], lut,
+        c_p['SLM_grating_x'], c_p['SLM_grating_y'], c_p['SLM_zero_order_zm'])
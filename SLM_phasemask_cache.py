@@ -0,0 +1,162 @@
+# Persistent cache of calculated phasemasks.
+# Phasemasks are stored as float32 .npy files named by a hash of the trap
+# parameters so that a schedule entry which has been run before, e.g. earlier
+# the same day, does not need a new GSW calculation. Files are memory mapped
+# when loaded and the least recently used ones are removed when the cache
+# grows larger than max_bytes.
+import numpy as np
+import hashlib, json, os
+
+
+def get_phasemask_key(xm, ym, zm, use_LGO, LGO_order, nbr_iterations,
+    algorithm, image_width=1080, decimation=1, image_height=None,
+    aperture_radius=None, oversampling=1):
+    '''
+    Calculates the cache key of a phasemask.
+
+    Parameters
+    ----------
+    xm, ym, zm : arrays
+        Trap positions, padded to the same length as in SLM._prepare_traps.
+    use_LGO : list of bools
+        Which traps use LGO.
+    LGO_order : int
+        Order of the LGO, only part of the key if any trap uses LGO.
+    nbr_iterations : int
+        Number of iterations of the algorithm.
+    algorithm : string
+        Name of the algorithm.
+    image_width : int, optional
+        Width of the phasemask.
+    decimation : int, optional
+        SLM_decimation used, only part of the key if larger than 1.
+    image_height : int, optional
+        Height of the phasemask, only part of the key if it differs from
+        image_width.
+    aperture_radius : float, optional
+        Radius of the active aperture, only part of the key if given.
+    oversampling : int, optional
+        SLM_oversampling used, only part of the key if larger than 1.
+
+    Returns
+    -------
+    key : string
+        sha1 hex digest of the parameters.
+    '''
+    hash = hashlib.sha1()
+    for array in [xm, ym, zm]:
+        hash.update(np.ascontiguousarray(array, dtype='<f8').tobytes())
+    hash.update(np.asarray(use_LGO, dtype=np.uint8).tobytes())
+    LGO_order = int(LGO_order) if True in use_LGO else None
+    hash.update(json.dumps([LGO_order, int(nbr_iterations), str(algorithm),
+                            int(image_width)]).encode())
+    if decimation > 1:
+        hash.update(json.dumps(['decimation', int(decimation)]).encode())
+    if oversampling > 1:
+        hash.update(json.dumps(['oversampling', int(oversampling)]).encode())
+    if (image_height is not None and image_height != image_width) or \
+        aperture_radius is not None:
+        hash.update(json.dumps(['shape', None if image_height is None else
+            int(image_height), aperture_radius]).encode())
+    return hash.hexdigest()
+
+
+class PhasemaskCache():
+    '''
+    Content addressed phasemask cache in a directory on disk.
+    Each entry is a float32 .npy file with the phasemask and a .json file with
+    the report of the calculation.
+    '''
+    def __init__(self, directory='phasemask_cache', max_bytes=2e9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key, extension='.npy'):
+        return os.path.join(self.directory, key + extension)
+
+    def load(self, key):
+        '''
+        Loads the phasemask stored under key.
+
+        Returns
+        -------
+        phasemask : read only memory mapped array or None
+            None if the phasemask is not in the cache.
+        report : dict
+            The report saved with the phasemask, empty if not available.
+        '''
+        path = self._get_path(key)
+        try:
+            phasemask = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            self.misses += 1
+            return None, {}
+        self.hits += 1
+        os.utime(path) # Marks the phasemask as recently used
+        try:
+            with open(self._get_path(key, '.json')) as file:
+                report = json.load(file)
+        except (OSError, ValueError):
+            report = {}
+        return phasemask, report
+
+    def store(self, key, phasemask, report=None):
+        '''
+        Stores a phasemask in the cache and removes the least recently used
+        phasemasks if the cache is larger than max_bytes.
+        '''
+        path = self._get_path(key)
+        # Write to a temporary file first so that other processes never see a
+        # partially written phasemask.
+        tmp_path = self._get_path(key, '.tmp' + str(os.getpid()))
+        try:
+            with open(tmp_path, 'wb') as file:
+                np.save(file, np.asarray(phasemask, dtype=np.float32))
+            os.replace(tmp_path, path)
+            if report is not None:
+                with open(self._get_path(key, '.json'), 'w') as file:
+                    json.dump(report, file)
+        except OSError as e:
+            print('Could not store phasemask in cache:', e)
+            return
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used phasemasks until the total size is
+        below max_bytes.
+        '''
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                json_path = path[:-4] + '.json'
+                if os.path.exists(json_path):
+                    os.remove(json_path)
+            except OSError:
+                # Memory mapped phasemasks cannot be removed on Windows.
+                continue
+            total_size -= size
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def phasemask_to_phase(phasemask):
+    '''
+    Recovers the phase Phi, in radians, from a phasemask created by
+    SLM._phase_to_mask. Used to warm start from a cached phasemask.
+    '''
+    return (np.ravel(phasemask) - 128) * (2 * np.pi / 255)
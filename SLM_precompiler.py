@@ -0,0 +1,170 @@
+# Ahead of time calculation of the phasemasks of an experiment schedule.
+# ExperimentControlThread only asks for the phasemask of an experiment when
+# the experiment starts. PhasemaskPrecompiler walks through the schedule in
+# advance, finds every trap configuration the experiments will use, including
+# the partial trap sets of activate_traps_one_by_one and the ghost traps, and
+# calculates the phasemasks in the background. CreatePhasemaskThread then only
+# has to swap in the precompiled phasemask.
+import numpy as np
+from threading import Thread
+import SLM, SLM_worker
+
+# Keys of a schedule entry which change the phasemask, as in update_c_p
+requires_new_phasemask = ['use_LGO', 'LGO_order', 'xm', 'ym', 'zm',
+                          'SLM_iterations', 'SLM_decimation']
+
+
+def pixels_to_SLM_locs(locs, axis, c_p):
+    '''
+    Converts trap locations from camera pixels to SLM locations along axis
+    (0 for x, 1 for y) using the calibration in c_p.
+    '''
+    if axis != 0 and axis != 1:
+        print('cannot perform conversion, incorrect choice of axis')
+        return locs
+    offset = c_p['slm_x_center'] if not axis else c_p['slm_y_center']
+    return [((x - offset) / c_p['slm_to_pixel']) for x in locs]
+
+
+def append_ghost_traps(xm, ym, zm, ghost_traps_x, ghost_traps_y, c_p,
+    ghost_traps_z=None):
+    '''
+    Appends ghost traps to the traps at xm, ym, zm. Used both by
+    ExperimentControlThread.add_ghost_traps and when precompiling so that the
+    precompiled phasemasks have the same trap parameters as the live ones.
+    Ghost traps given in camera pixels are converted to SLM locations and zm
+    is padded with zeros to the number of traps.
+
+    Returns
+    -------
+    xm, ym : lists
+        Positions of the traps followed by the ghost traps.
+    zm : array
+    '''
+    if min(ghost_traps_x) >= 1:
+        ghost_traps_x = pixels_to_SLM_locs(ghost_traps_x, 0, c_p)
+    if min(ghost_traps_y) >= 1:
+        ghost_traps_y = pixels_to_SLM_locs(ghost_traps_y, 1, c_p)
+    if ghost_traps_z is None:
+        ghost_traps_z = np.zeros(len(ghost_traps_x))
+    nbr_traps = len(xm)
+    zm = np.asarray([] if zm is None else zm, dtype=float)[:nbr_traps]
+    zm = np.concatenate((zm, np.zeros(nbr_traps - len(zm))))
+    return list(xm) + list(ghost_traps_x), list(ym) + list(ghost_traps_y), \
+        np.concatenate((zm, np.asarray(ghost_traps_z, dtype=float)))
+
+
+def get_schedule_trap_configurations(schedule, c_p):
+    '''
+    Walks through an experiment schedule the same way as
+    ExperimentControlThread.run and update_c_p and lists the phasemask
+    parameters of every phasemask the schedule can ask for.
+
+    Parameters
+    ----------
+    schedule : list of dicts
+        Experiment schedule, e.g. c_p['experiment_schedule'] or the result of
+        read_dict_from_file.ReadFileToExperimentList.
+    c_p : dict
+        Control parameters. Gives the starting values of the trap parameters
+        and the calibration of the SLM. Not changed.
+
+    Returns
+    -------
+    configurations : list of dicts
+        Parameters as returned by SLM.get_phasemask_parameters, in the order
+        they will be needed.
+    '''
+    current = SLM.get_phasemask_parameters(c_p)
+    configurations = []
+    for setup_dict in schedule:
+        if 'phasemask' in setup_dict:
+            # Phasemask given directly, nothing to calculate
+            continue
+        for key in requires_new_phasemask:
+            if key not in setup_dict:
+                continue
+            value = setup_dict[key]
+            if key == 'xm' and len(value) > 0 and min(value) > 1:
+                value = pixels_to_SLM_locs(value, 0, c_p)
+            elif key == 'ym' and len(value) > 0 and min(value) > 1:
+                value = pixels_to_SLM_locs(value, 1, c_p)
+            current[key] = value
+        nbr_traps = min(len(current['xm']), len(current['ym']))
+        current['xm'] = current['xm'][:nbr_traps]
+        current['ym'] = current['ym'][:nbr_traps]
+        if not any(key in setup_dict for key in requires_new_phasemask):
+            continue
+        configurations.append(dict(current))
+
+        activate_traps_one_by_one = setup_dict.get('activate_traps_one_by_one',
+            c_p.get('activate_traps_one_by_one', False))
+        if activate_traps_one_by_one:
+            for nbr_active_traps in range(min(3, nbr_traps), nbr_traps):
+                configurations.append(dict(current,
+                    xm=current['xm'][:nbr_active_traps],
+                    ym=current['ym'][:nbr_active_traps]))
+
+        if 'ghost_traps_x' in setup_dict:
+            xm, ym, zm = append_ghost_traps(current['xm'], current['ym'],
+                current['zm'], setup_dict['ghost_traps_x'],
+                setup_dict['ghost_traps_y'], c_p,
+                setup_dict.get('ghost_traps_z', None))
+            # The ghost traps stay until the next schedule entry changes xm/ym
+            current = dict(current, xm=xm, ym=ym, zm=zm)
+            configurations.append(dict(current))
+    return configurations
+
+
+class PhasemaskPrecompiler(Thread):
+    '''
+    Thread which calculates the phasemasks of an experiment schedule in the
+    background. The phasemasks are put in c_p['precompiled_phasemasks'] as
+    (phasemask, report) tuples, keyed by SLM.get_phasemask_cache_key, and are
+    also stored in the phasemask cache if it is used.
+    If c_p['SLM_worker_process'] is True the phasemasks are calculated in a
+    worker process of their own, see SLM_worker.PhasemaskWorker, so that the
+    precompiling does not hold the GIL.
+    '''
+    def __init__(self, c_p, schedule=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.c_p = c_p
+        self.schedule = c_p['experiment_schedule'] if schedule is None \
+            else schedule
+        self.calculator = SLM.PhasemaskCalculator(c_p['phasemask_width'],
+            SLM.get_phasemask_cache(c_p), c_p['phasemask_height'],
+            c_p['SLM_aperture_radius'])
+
+    def run(self):
+        c_p = self.c_p
+        precompiled = c_p['precompiled_phasemasks']
+        configurations = get_schedule_trap_configurations(self.schedule, c_p)
+        print('Precompiling', len(configurations), 'phasemasks')
+        worker = None
+        if c_p['SLM_worker_process']:
+            worker = SLM_worker.PhasemaskWorker(c_p)
+            worker.start()
+        try:
+            for parameters in configurations:
+                if not c_p['program_running']:
+                    return
+                key = self.calculator.get_cache_key(parameters)
+                if key in precompiled:
+                    continue
+                # All precompiled phasemasks are calculated with the full
+                # number of iterations.
+                parameters['SLM_warm_start'] = False
+                if worker is None:
+                    phasemask, report = self.calculator.calculate(parameters)
+                else:
+                    phasemask, report = worker.request(parameters)
+                if phasemask is None:
+                    continue
+                # Copies the phasemask out of the shared memory of the worker
+                precompiled[key] = (np.asarray(phasemask, dtype=np.float32),
+                                    report)
+        finally:
+            if worker is not None:
+                worker.stop()
+        print('Precompiled phasemasks ready')
@@ -0,0 +1,235 @@
+# Simulation of the focal plane of the SLM.
+# Checking a phasemask used to mean putting it on the SLM and looking at the
+# camera. Here the focal plane is instead calculated as the 2d FFT of the SLM
+# plane, the same discretization as in SLM.GS_FFT, which gives the expected
+# intensities of the traps without any hardware. Several phasemasks are
+# propagated at once with a batched FFTW plan which is kept between calls.
+import numpy as np
+from threading import local
+from os import cpu_count
+import pyfftw
+import SLM
+
+
+# Plans are kept per thread since a plan works on its own arrays.
+_batch_fft_plans = local()
+
+
+def _get_batch_fft_plan(size, batch_size, max_plans=4):
+    # In-place forward FFTW plan over the last two axes of a stack of
+    # batch_size (padded) SLM planes for the calling thread. Creating the plan
+    # is slow so it is kept between calls.
+    plans = getattr(_batch_fft_plans, 'plans', None)
+    if plans is None:
+        plans = _batch_fft_plans.plans = {}
+    if (size, batch_size) not in plans:
+        if len(plans) >= max_plans:
+            plans.clear()
+        planes = pyfftw.empty_aligned((batch_size, size, size),
+                                      dtype='complex64')
+        with SLM._fft_planner_lock:
+            plans[(size, batch_size)] = pyfftw.FFTW(planes, planes,
+                axes=(1, 2), threads=cpu_count())
+    return plans[(size, batch_size)]
+
+
+def _mask_to_phase(phasemask):
+    # Phase in radians of a phasemask from SLM._phase_to_mask, 2d.
+    phasemask = np.asarray(phasemask, dtype=np.float32)
+    return (phasemask - 128) * np.float32(2 * np.pi / 255)
+
+
+def _downsample(image, downsampling):
+    # Sums blocks of downsampling x downsampling pixels.
+    height = (np.shape(image)[0] // downsampling) * downsampling
+    width = (np.shape(image)[1] // downsampling) * downsampling
+    image = image[:height, :width]
+    return image.reshape(height // downsampling, downsampling,
+                         width // downsampling, downsampling).sum(axis=(1, 3))
+
+
+def simulate_focal_plane(phasemasks, xm=None, ym=None, traps_absolute_pos=None,
+    c_p=None, oversampling=1, trap_radius=0, downsampling=None, batch_size=4,
+    aperture=None):
+    '''
+    Calculates the intensity in the focal plane of one or several phasemasks.
+
+    Parameters
+    ----------
+    phasemasks : array or list of arrays
+        A phasemask as created by CreatePhasemaskThread or loaded from file,
+        or a stack/list of phasemasks of the same size.
+    xm, ym : lists or arrays, optional
+        Trap positions in SLM units as in c_p['xm'], c_p['ym'].
+    traps_absolute_pos : 2xM array, optional
+        Trap positions in camera pixels as in c_p['traps_absolute_pos'],
+        used if xm, ym are not given. Needs the calibration in c_p.
+    c_p : dict, optional
+        Control parameters with slm_x_center, slm_y_center and slm_to_pixel.
+    oversampling : int, optional
+        Zero padding factor of the SLM plane, gives a finer focal plane grid.
+    trap_radius : int, optional
+        The intensity of a trap is summed over the focal plane pixels at most
+        trap_radius pixels from the trap in each direction. 0 uses only the
+        nearest pixel which is only accurate for traps on the focal plane grid
+        such as those of SLM.GS_FFT. Other traps, and in particular LGO traps
+        and traps with a z-offset, need a larger radius since their light is
+        spread over several pixels.
+    downsampling : int, optional
+        If given the focal plane images, downsampled by this factor and
+        centered on the zeroth order, are also returned.
+    batch_size : int, optional
+        Number of phasemasks propagated by each FFT.
+    aperture : 2d array of bools, optional
+        Illuminated pixels of the SLM, see SLM.get_aperture. All pixels if None.
+
+    Returns
+    -------
+    intensities : array
+        Intensity of each trap, one row per phasemask, as the fraction of the
+        light which ends up in the trap pixels. For a square SLM without
+        aperture and oversampling a trap on the focal plane grid has the
+        intensity |V|^2 used in SLM.get_efficiency. Otherwise the spot of a
+        trap covers several pixels, see trap_radius.
+    images : array
+        Only if downsampling is given. The focal plane intensities.
+    '''
+    phasemasks = np.asarray(phasemasks)
+    single_mask = phasemasks.ndim == 2
+    if single_mask:
+        phasemasks = phasemasks[np.newaxis]
+    nbr_masks, image_height, image_width = np.shape(phasemasks)
+    # A rectangular SLM is zero padded to a square as in SLM.GS_FFT
+    width = max(image_width, image_height)
+    if xm is None:
+        rows, columns = SLM.camera_to_focal_plane_indices(
+            traps_absolute_pos[0], traps_absolute_pos[1], c_p, width,
+            oversampling)
+    else:
+        rows, columns = SLM.get_focal_plane_indices(xm, ym, width, oversampling)
+    size = width * oversampling
+    # Normalizes the total intensity of the focal plane to 1 (Parseval)
+    normalization = 1 / (size**2 * SLM.get_nbr_pixels(image_width,
+                                                      image_height, aperture))
+    offsets = np.arange(-trap_radius, trap_radius + 1)
+    window_rows = np.mod(rows[:, None, None] + offsets[None, :, None], size)
+    window_columns = np.mod(columns[:, None, None] + offsets[None, None, :], size)
+
+    batch_size = max(1, min(batch_size, nbr_masks))
+    fft = _get_batch_fft_plan(size, batch_size)
+    planes = fft.input_array
+    intensities = np.zeros((nbr_masks, len(rows)))
+    images = []
+    for first in range(0, nbr_masks, batch_size):
+        batch = phasemasks[first:first+batch_size]
+        planes[:] = 0
+        for index, phasemask in enumerate(batch):
+            Phi = _mask_to_phase(phasemask)
+            illuminated = planes[index, :image_height, :image_width]
+            np.cos(Phi, out=illuminated.real)
+            np.sin(Phi, out=illuminated.imag)
+            if aperture is not None:
+                illuminated *= aperture
+        fft()
+        for index in range(len(batch)):
+            intensity = np.abs(planes[index])**2 * normalization
+            intensities[first + index] = np.sum(
+                intensity[window_rows, window_columns], axis=(1, 2))
+            if downsampling is not None:
+                images.append(_downsample(np.fft.fftshift(intensity),
+                                          downsampling))
+    if single_mask:
+        intensities = intensities[0]
+    if downsampling is None:
+        return intensities
+    images = np.asarray(images)
+    return intensities, images[0] if single_mask else images
+
+
+def get_simulated_quality(phasemasks, xm, ym, **options):
+    '''
+    Simulated uniformity and efficiency of the traps of one or several
+    phasemasks, see simulate_focal_plane for the options.
+
+    Returns
+    -------
+    uniformity, efficiency : floats or arrays
+        One value per phasemask if several phasemasks are given.
+    '''
+    options.pop('downsampling', None)
+    intensities = simulate_focal_plane(phasemasks, xm, ym, **options)
+    V_abs = np.sqrt(intensities)
+    if np.ndim(V_abs) == 1:
+        return float(SLM.get_uniformity(V_abs)), float(SLM.get_efficiency(V_abs))
+    uniformity = (1 - (np.max(V_abs, axis=1) - np.min(V_abs, axis=1)) /
+                  (np.max(V_abs, axis=1) + np.min(V_abs, axis=1)))
+    return uniformity, np.sum(V_abs**2, axis=1)
+
+
+class SimulatedCamera():
+    '''
+    Stand-in for the camera when testing camera feedback without hardware.
+    Renders the simulated trap intensities of a phasemask as gaussian spots
+    at given image positions. Each trap can be given a transmission factor
+    to mimic the aberrations and losses of a real setup which the phasemask
+    algorithms do not know about.
+    '''
+    def __init__(self, xm, ym, x, y, image_shape=(1000, 1200),
+        transmission=None, spot_width=1.5, peak_value=200, noise=0,
+        background=10, trap_radius=1):
+        '''
+        Parameters
+        ----------
+        xm, ym : lists or arrays
+            Trap positions in SLM units, used for the simulation.
+        x, y : lists or arrays
+            Positions of the traps in the image in pixels, as in
+            c_p['traps_relative_pos'].
+        image_shape : tuple, optional
+            Height and width of the images.
+        transmission : list or array, optional
+            Factor multiplying the intensity of each trap, 1 if None.
+        spot_width : float, optional
+            Standard deviation in pixels of the trap spots.
+        peak_value : float, optional
+            Peak value of a spot with the mean trap intensity.
+        noise : float, optional
+            Standard deviation of gaussian noise added to the images.
+        background : float, optional
+            Background level of the images.
+        trap_radius : int, optional
+            See simulate_focal_plane.
+        '''
+        self.xm = xm
+        self.ym = ym
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.image_shape = image_shape
+        self.transmission = np.ones(len(xm)) if transmission is None else \
+            np.asarray(transmission, dtype=float)
+        self.spot_width = spot_width
+        self.peak_value = peak_value
+        self.noise = noise
+        self.background = background
+        self.trap_radius = trap_radius
+        self.mean_intensity = None
+
+    def capture(self, phasemask):
+        '''
+        Returns the image the camera would take of the traps of phasemask.
+        '''
+        intensities = self.transmission * simulate_focal_plane(phasemask,
+            self.xm, self.ym, trap_radius=self.trap_radius)
+        if self.mean_intensity is None:
+            # Fixed exposure, set by the first phasemask
+            self.mean_intensity = np.mean(intensities)
+        amplitudes = self.peak_value * intensities / self.mean_intensity
+        rows = np.arange(self.image_shape[0])[:, None]
+        columns = np.arange(self.image_shape[1])[None, :]
+        image = np.full(self.image_shape, float(self.background))
+        for amplitude, x, y in zip(amplitudes, self.x, self.y):
+            image += amplitude * np.exp(-((columns - x)**2 + (rows - y)**2) /
+                                        (2 * self.spot_width**2))
+        if self.noise > 0:
+            image += np.random.normal(0, self.noise, self.image_shape)
+        return image
@@ -0,0 +1,199 @@
+# Precalculated phasemask sequences for moving traps.
+# Moving traps by repeatedly asking CreatePhasemaskThread for a new phasemask
+# is limited by the calculation time of each phasemask. Here the whole
+# trajectory is calculated up front, in parallel chunks where each phasemask
+# is warm started from the previous one, and then streamed to the SLM at a
+# fixed rate. All chunks start from the phasemask of the first layout so that
+# the phasemasks at the chunk boundaries are related too.
+import numpy as np
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+from time import time, sleep
+import SLM
+
+
+def get_trajectory(xm_start, ym_start, xm_end, ym_end, nbr_steps, zm_start=None,
+    zm_end=None):
+    '''
+    Linear interpolation between two trap layouts with the same number of traps.
+
+    Parameters
+    ----------
+    xm_start, ym_start : lists or arrays
+        Start positions of the traps.
+    xm_end, ym_end : lists or arrays
+        End positions of the traps.
+    nbr_steps : int
+        Number of steps between the start and the end.
+    zm_start, zm_end : lists or arrays, optional
+        z-positions of the traps, zero if not given.
+
+    Returns
+    -------
+    layouts : list of (xm, ym, zm) tuples
+        nbr_steps+1 trap layouts, starting with the start layout and ending
+        with the end layout. None if the layouts have different numbers of traps.
+    '''
+    M = len(xm_start)
+    if len(ym_start) != M or len(xm_end) != M or len(ym_end) != M:
+        print('Start and end of the trajectory need the same number of traps')
+        return None
+    zm_start = np.zeros(M) if zm_start is None else zm_start
+    zm_end = np.zeros(M) if zm_end is None else zm_end
+    start = np.asarray([xm_start, ym_start, zm_start[:M]], dtype=float)
+    end = np.asarray([xm_end, ym_end, zm_end[:M]], dtype=float)
+    layouts = []
+    for step in range(nbr_steps + 1):
+        xm, ym, zm = start + (end - start) * step / nbr_steps
+        layouts.append((xm, ym, zm))
+    return layouts
+
+
+def get_step_length(layouts):
+    '''
+    Largest distance any trap moves between two consecutive layouts.
+    '''
+    positions = np.asarray(layouts, dtype=float)
+    if len(positions) < 2:
+        return 0.0
+    return float(np.max(np.sqrt(np.sum(np.diff(positions, axis=0)**2, axis=1))))
+
+
+def _calculate_chunk(layouts, parameters, image_width, image_height,
+    aperture_radius, start_phasemask, start_parameters, first_iterations):
+    # Calculates the phasemasks of consecutive layouts, each one warm started
+    # from the one before. The first one is warm started from the phasemask
+    # of the first layout of the trajectory with first_iterations iterations.
+    calculator = SLM.PhasemaskCalculator(image_width, None, image_height,
+                                         aperture_radius)
+    calculator.set_phasemask(start_phasemask, start_parameters)
+    phasemasks = []
+    reports = []
+    for step, (xm, ym, zm) in enumerate(layouts):
+        step_parameters = dict(parameters, xm=xm, ym=ym, zm=zm,
+                               SLM_warm_start=True)
+        if step == 0:
+            step_parameters['SLM_warm_start_max_displacement'] = np.inf
+            step_parameters['SLM_warm_start_iterations'] = first_iterations
+        phasemask, report = calculator.calculate(step_parameters)
+        phasemasks.append(phasemask)
+        reports.append(report)
+    return phasemasks, reports
+
+
+def calculate_trajectory(layouts, parameters, nbr_workers=None,
+    image_width=1080, image_height=None, aperture_radius=None):
+    '''
+    Calculates the phasemasks of a trajectory. The phasemask of the first
+    layout is calculated first, the remaining layouts are split into one chunk
+    per worker and the chunks are calculated in parallel. Within a chunk every
+    phasemask is warm started from its neighbour, whatever the step length.
+    The first phasemask of each chunk is started from the phasemask of the
+    first layout, with all SLM_iterations unless it is its neighbour.
+
+    Parameters
+    ----------
+    layouts : list of (xm, ym, zm) tuples
+        Trap layouts, e.g. from get_trajectory.
+    parameters : dict
+        Phasemask parameters, e.g. from SLM.get_phasemask_parameters. Gives
+        the algorithm, LGO and iteration settings, the trap positions are taken
+        from the layouts.
+    nbr_workers : int, optional
+        Number of threads to use, None for all cores.
+    image_width, image_height : int, optional
+        Size of the phasemasks, image_height defaults to image_width.
+    aperture_radius : float, optional
+        Active aperture of the SLM, see SLM.get_aperture.
+
+    Returns
+    -------
+    phasemasks : list of arrays
+        One phasemask per layout.
+    reports : list of dicts
+        The reports of the calculations.
+    '''
+    step_length = get_step_length(layouts)
+    xm, ym, zm = layouts[0]
+    start_parameters = dict(parameters, xm=xm, ym=ym, zm=zm,
+                            SLM_warm_start=False)
+    phasemask, report = SLM.PhasemaskCalculator(image_width, None,
+        image_height, aperture_radius).calculate(start_parameters)
+    phasemasks = [phasemask]
+    reports = [report]
+    layouts = layouts[1:]
+    if len(layouts) == 0:
+        return phasemasks, reports
+
+    nbr_workers = cpu_count() if nbr_workers is None else nbr_workers
+    nbr_workers = max(1, min(nbr_workers, len(layouts)))
+    chunk_size = int(np.ceil(len(layouts) / nbr_workers))
+    chunks = [layouts[i:i+chunk_size] for i in range(0, len(layouts), chunk_size)]
+    # The kernels use the cores of their own worker, not a shared pool. The
+    # steps of the trajectory are meant to be warm started.
+    parameters = dict(parameters, SLM_nbr_workers=1,
+        SLM_warm_start_max_displacement=max(step_length,
+        parameters['SLM_warm_start_max_displacement']))
+    def calculate_chunk(index):
+        first_iterations = parameters['SLM_warm_start_iterations'] \
+            if index == 0 else parameters['SLM_iterations']
+        return _calculate_chunk(chunks[index], parameters, image_width,
+            image_height, aperture_radius, phasemask, start_parameters,
+            first_iterations)
+    with ThreadPoolExecutor(nbr_workers) as pool:
+        for chunk_phasemasks, chunk_reports in pool.map(calculate_chunk,
+                                                        range(len(chunks))):
+            phasemasks += chunk_phasemasks
+            reports += chunk_reports
+    return phasemasks, reports
+
+
+class TrajectoryStreamer(Thread):
+    '''
+    Thread which puts precalculated phasemasks in c_p['phasemask'] one at a
+    time at a fixed rate, updating xm, ym and zm to match and setting
+    c_p['phasemask_updated'] so that the SLM window is updated.
+    c_p['trajectory_streaming'] is True while the thread runs.
+    '''
+    def __init__(self, c_p, phasemasks, layouts, rate=None, step_callback=None):
+        '''
+        Parameters
+        ----------
+        c_p : dict
+            Control parameters.
+        phasemasks : list of arrays
+            Phasemasks from calculate_trajectory.
+        layouts : list of (xm, ym, zm) tuples
+            The trap layouts of the phasemasks.
+        rate : float, optional
+            Phasemasks per second, c_p['SLM_trajectory_rate'] if None.
+        step_callback : function, optional
+            Called with xm and ym after each phasemask, e.g. for updating the
+            trap positions on the camera.
+        '''
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.c_p = c_p
+        self.phasemasks = phasemasks
+        self.layouts = layouts
+        self.rate = c_p['SLM_trajectory_rate'] if rate is None else rate
+        self.step_callback = step_callback
+
+    def run(self):
+        c_p = self.c_p
+        c_p['trajectory_streaming'] = True
+        next_time = time()
+        for phasemask, (xm, ym, zm) in zip(self.phasemasks, self.layouts):
+            if not c_p['program_running']:
+                break
+            c_p['xm'], c_p['ym'], c_p['zm'] = list(xm), list(ym), zm
+            if c_p['SLM_output'] is not None:
+                c_p['SLM_output'].get_display_buffer(phasemask)
+            c_p['phasemask'] = phasemask
+            c_p['phasemask_updated'] = True
+            if self.step_callback is not None:
+                self.step_callback(c_p['xm'], c_p['ym'])
+            next_time += 1 / self.rate
+            sleep(max(0, next_time - time()))
+        c_p['trajectory_streaming'] = False
@@ -0,0 +1,227 @@
+# Calculation of phasemasks in a separate process.
+# The phasemask calculations hold the GIL for long stretches which makes the
+# camera, tracking and stage threads stutter. Running the calculations in a
+# worker process avoids this. Trap configurations are sent to the worker
+# through a queue and the finished phasemasks are written to a double buffer
+# in shared memory so that no full size phasemasks need to be pickled.
+# On Windows the script starting the worker must protect its main code with
+# if __name__ == '__main__': since the worker process imports it.
+import numpy as np
+from multiprocessing import Process, Queue
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+import SLM
+
+
+def phasemask_worker(request_queue, result_queue, shared_memory_name,
+    mask_shape, nbr_buffers=2, cache_directory=None, cache_max_bytes=2e9,
+    aperture_radius=None):
+    '''
+    Main function of the worker process. Waits for requests on the
+    request_queue, calculates the phasemasks with a SLM.PhasemaskCalculator
+    and writes them into the shared memory buffers.
+
+    Parameters
+    ----------
+    request_queue : Queue
+        Requests as tuples (buffer_index, parameters, feedback) where
+        parameters is a dict from SLM.get_phasemask_parameters and feedback
+        is None for a new phasemask or (intensities, gain) for a round of
+        camera feedback on the last one. If feedback is 'set_phasemask' the
+        buffer holds a phasemask calculated elsewhere which is used as the
+        last phasemask, nothing is put on the result_queue then.
+        None stops the worker.
+    result_queue : Queue
+        The worker puts (buffer_index, report, delta_cache_stats) here when a
+        phasemask is ready. If the calculation fails report is None and the
+        last element is the error message.
+    shared_memory_name : string
+        Name of the shared memory holding the phasemask buffers.
+    mask_shape : tuple
+        Shape of a phasemask, (height, width).
+    nbr_buffers : int, optional
+        Number of phasemask buffers in the shared memory.
+    cache_directory : string, optional
+        Directory of the PhasemaskCache to use, None to not use a cache.
+    cache_max_bytes : float, optional
+        Maximum size of the cache.
+    aperture_radius : float, optional
+        Active aperture of the SLM, see SLM.get_aperture.
+
+    Returns
+    -------
+    None.
+
+    '''
+    shared_memory = SharedMemory(name=shared_memory_name)
+    buffers = np.ndarray((nbr_buffers,) + tuple(mask_shape), dtype=np.float64,
+                         buffer=shared_memory.buf)
+    cache = None
+    if cache_directory is not None:
+        cache = SLM.PhasemaskCache(cache_directory, cache_max_bytes)
+    calculator = SLM.PhasemaskCalculator(mask_shape[1], cache, mask_shape[0],
+                                         aperture_radius)
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        buffer_index, parameters, feedback = request
+        if isinstance(feedback, str) and feedback == 'set_phasemask':
+            calculator.set_phasemask(np.copy(buffers[buffer_index]), parameters)
+            continue
+        try:
+            if feedback is None:
+                phasemask, report = calculator.calculate(parameters)
+            else:
+                phasemask, report = calculator.calculate_feedback(parameters,
+                                                                  *feedback)
+        except Exception as e:
+            result_queue.put((buffer_index, None, str(e)))
+            continue
+        if phasemask is None:
+            result_queue.put((buffer_index, None, 'no phasemask to improve'))
+            continue
+        buffers[buffer_index] = phasemask
+        result_queue.put((buffer_index, report,
+                          calculator.delta_cache.get_stats()))
+    del buffers
+    shared_memory.close()
+
+
+class PhasemaskWorker():
+    '''
+    A phasemask_worker process together with its queues and the shared
+    memory buffers it writes the phasemasks to. The buffers are used
+    alternately so the worker never writes to the last returned phasemask.
+    '''
+    def __init__(self, c_p, mask_shape=None, nbr_buffers=2):
+        self.c_p = c_p
+        if mask_shape is None:
+            mask_shape = (c_p['phasemask_height'], c_p['phasemask_width'])
+        self.mask_shape = mask_shape
+        self.nbr_buffers = nbr_buffers
+        self.buffer_index = 0
+        self.shared_memory = SharedMemory(create=True,
+            size=self.nbr_buffers * int(np.prod(mask_shape)) * 8)
+        self.buffers = np.ndarray((self.nbr_buffers,) + tuple(mask_shape),
+            dtype=np.float64, buffer=self.shared_memory.buf)
+        self.request_queue = Queue()
+        self.result_queue = Queue()
+        self.process = Process(target=phasemask_worker,
+            args=(self.request_queue, self.result_queue,
+                  self.shared_memory.name, mask_shape, self.nbr_buffers,
+                  c_p['SLM_cache_directory'], c_p['SLM_cache_max_bytes'],
+                  c_p['SLM_aperture_radius']),
+            daemon=True)
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        '''
+        Stops the worker process and releases the shared memory. Phasemasks
+        returned by request are views of the shared memory and must be copied
+        before.
+        '''
+        self.request_queue.put(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        del self.buffers
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+    def request(self, parameters, feedback=None):
+        '''
+        Sends a request to the worker and waits for the result.
+
+        Returns
+        -------
+        phasemask : array or None
+            View of the shared memory buffer with the phasemask, None if the
+            worker failed or the program was stopped.
+        report : dict
+            Report of the calculation.
+        '''
+        c_p = self.c_p
+        self.buffer_index = (self.buffer_index + 1) % self.nbr_buffers
+        self.request_queue.put((self.buffer_index, parameters, feedback))
+        while c_p['program_running']:
+            try:
+                buffer_index, report, stats = self.result_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            if report is None:
+                print('Could not calculate phasemask:', stats)
+                return None, {}
+            c_p['delta_cache_stats'] = stats
+            return self.buffers[buffer_index], report
+        return None, {}
+
+    def set_phasemask(self, phasemask, parameters):
+        '''
+        Makes phasemask, e.g. a precompiled one, the last phasemask of the
+        worker so that its next warm start or camera feedback starts from it.
+        '''
+        self.buffer_index = (self.buffer_index + 1) % self.nbr_buffers
+        self.buffers[self.buffer_index] = phasemask
+        self.request_queue.put((self.buffer_index, parameters,
+                                'set_phasemask'))
+
+
+class CreatePhasemaskProcessThread(SLM.CreatePhasemaskThread):
+    '''
+    Replacement for SLM.CreatePhasemaskThread which leaves the calculations to
+    a worker process, see PhasemaskWorker. Uses the same
+    new_phasemask/phasemask_updated handshake, c_p['phasemask'] is set to a
+    view of the shared memory buffer which holds the latest phasemask.
+    '''
+    def __init__(self, threadID, name, c_p, mask_shape=None):
+        SLM.CreatePhasemaskThread.__init__(self, threadID, name, c_p)
+        self.worker = PhasemaskWorker(c_p, mask_shape)
+
+    def run(self):
+        self.worker.start()
+        try:
+            SLM.CreatePhasemaskThread.run(self)
+        finally:
+            self.stop_worker()
+
+    def stop_worker(self):
+        '''
+        Stops the worker process and releases the shared memory.
+        '''
+        self.c_p['phasemask'] = np.copy(self.c_p['phasemask'])
+        self.worker.stop()
+
+    def set_phasemask(self, phasemask, parameters):
+        '''
+        Makes phasemask the starting point of the next calculation both here,
+        for the previews, and in the worker.
+        '''
+        self.calculator.set_phasemask(phasemask, parameters)
+        self.worker.set_phasemask(phasemask, parameters)
+
+    def calculate_phasemask(self):
+        '''
+        Sends the current control parameters to the worker and waits for the
+        new phasemask which is then put in c_p['phasemask'].
+        '''
+        c_p = self.c_p
+        parameters = SLM.get_phasemask_parameters(c_p)
+        if self.use_precompiled_phasemask(parameters):
+            return
+        self.show_preview(parameters)
+        phasemask, report = self.worker.request(parameters)
+        if phasemask is None:
+            return
+        c_p['phasemask'] = phasemask
+        c_p['SLM_report'] = report
+        print('Phasemask report:', report)
+
+    def calculate_feedback_phasemask(self, parameters, intensities):
+        '''
+        Lets the worker do a round of camera feedback on its last phasemask.
+        '''
+        return self.worker.request(parameters,
+            (intensities, self.c_p['SLM_feedback_gain']))
@@ -69,6 +69,85 @@ def get_x_y(counts, particle_upper_size_threshold, particle_size_threshold, sepa
             y.append(cy)
     return x, y
 
+def get_label_properties(separate_particles_image, nbr_labels=None):
+    """
+    Calculates the area, center of mass, bounding box and second order
+    central moments of every label in a labeled image in a single pass over
+    the foreground pixels, instead of one pass over the whole image per label
+    as in get_x_y.
+    Parameters :
+        separate_particles_image - Labeled image, e.g. from measure.label.
+            0 is background.
+        nbr_labels - Largest label in the image, calculated if not given.
+    Returns :
+        properties - dict of arrays with one element per label 1...nbr_labels:
+            'label', 'area' (pixels), 'x', 'y' (center of mass in pixels),
+            'bbox' (nbr_labels x 4, top, left, bottom, right with bottom and
+            right exclusive), 'mu_xx', 'mu_yy', 'mu_xy' (second order central
+            moments divided by the area) and 'eccentricity' (0 for a circle,
+            towards 1 for elongated particles).
+    """
+    width = np.shape(separate_particles_image)[1]
+    flat_image = np.ravel(separate_particles_image)
+    foreground = np.flatnonzero(flat_image)
+    labels = flat_image[foreground]
+    if nbr_labels is None:
+        nbr_labels = int(labels.max()) if len(labels) > 0 else 0
+    rows, columns = np.divmod(foreground, width)
+
+    def label_sums(weights=None):
+        return np.bincount(labels, weights=weights, minlength=nbr_labels+1)[1:]
+    area = label_sums()
+    nonzero_area = np.maximum(area, 1)
+    y = label_sums(rows) / nonzero_area
+    x = label_sums(columns) / nonzero_area
+    mu_yy = label_sums(rows.astype(float)**2) / nonzero_area - y**2
+    mu_xx = label_sums(columns.astype(float)**2) / nonzero_area - x**2
+    mu_xy = label_sums(rows.astype(float) * columns) / nonzero_area - x*y
+
+    # Eigenvalues of the covariance matrix give the axes of the particle
+    root = np.sqrt(((mu_xx - mu_yy) / 2)**2 + mu_xy**2)
+    major = (mu_xx + mu_yy) / 2 + root
+    minor = (mu_xx + mu_yy) / 2 - root
+    eccentricity = np.sqrt(np.clip(1 - minor / np.maximum(major, 1e-12), 0, 1))
+
+    bbox = np.zeros((nbr_labels, 4), dtype=int)
+    for index, bounds in enumerate(ndi.find_objects(separate_particles_image,
+                                                    max_label=nbr_labels)):
+        if bounds is not None:
+            bbox[index] = [bounds[0].start, bounds[1].start, bounds[0].stop,
+                           bounds[1].stop]
+    return {
+        'label': np.arange(1, nbr_labels+1),
+        'area': area,
+        'x': x,
+        'y': y,
+        'bbox': bbox,
+        'mu_xx': mu_xx,
+        'mu_yy': mu_yy,
+        'mu_xy': mu_xy,
+        'eccentricity': eccentricity,
+    }
+
+
+def find_particle_properties(image,threshold=120,particle_size_threshold=200,particle_upper_size_threshold=5000):
+    """
+    Same as find_particle_centers but returns all the properties calculated
+    by get_label_properties of the particles within the size thresholds.
+    Returns :
+        properties - dict from get_label_properties, only the particles.
+        thresholded_image - The thresholded image.
+    """
+    thresholded_image = cv2.medianBlur(image, 5) > threshold
+    separate_particles_image = measure.label(thresholded_image)
+    properties = get_label_properties(separate_particles_image)
+    particles = (particle_upper_size_threshold > properties['area']) & \
+        (properties['area'] > particle_size_threshold)
+    for key in properties:
+        properties[key] = properties[key][particles]
+    return properties, thresholded_image
+
+
 #@jit
 def find_particle_centers(image,threshold=120,particle_size_threshold=200,particle_upper_size_threshold=5000,bright_particle=True):
     """
@@ -82,34 +161,8 @@ def find_particle_centers(image,threshold=120,particle_size_threshold=200,partic
         x,y - arrays with the x and y coordinates of the particle in the image in pixels.
             Returns empty arrays if no particle was found
     """
-
-    # Do thresholding of the image
-    thresholded_image = cv2.medianBlur(image, 5) > threshold # Added thresholding here
-
-    # Separate the thresholded image into different sections
-    separate_particles_image = measure.label(thresholded_image)
-    # use cv2.findContours instead?
-    # Count the number of pixels in each section
-    counts = np.bincount(np.reshape(separate_particles_image,(np.shape(separate_particles_image)[0]*np.shape(separate_particles_image)[1])))
-
-    x = []
-    y = []
-    #group = 0
-
-    # Check for pixel sections which are larger than particle_size_threshold.
-    # particle_images = find_groups_of_interest(counts, \
-    #                                           particle_upper_size_threshold, \
-    #                                           particle_size_threshold, \
-    #                                           separate_particles_image)
-    # x, y = parallel_center_of_masses(particle_images)
-
-    # TODO Calcualte image-moments to determine shape
-    for group, pixel_count in enumerate(counts): # First will be background
-        if particle_upper_size_threshold>pixel_count>particle_size_threshold:
-            # Particle found, locate center of mass of the particle
-            cy, cx = ndi.center_of_mass(separate_particles_image==group) # This is slow
-            x.append(cx)
-            y.append(cy)
-
-
-    return x, y, thresholded_image
+    # The center of mass, and the shape, of all particles is found in one
+    # pass, see get_label_properties.
+    properties, thresholded_image = find_particle_properties(image, threshold,
+        particle_size_threshold, particle_upper_size_threshold)
+    return list(properties['x']), list(properties['y']), thresholded_image
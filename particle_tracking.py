@@ -0,0 +1,505 @@
+# Incremental tracking of particles between camera frames.
+# Detecting the particles in every full 3600x3008 frame is slow although
+# trapped particles stay close to the traps and free particles only move a
+# few pixels between frames. ROITracker instead runs the detection in small
+# windows (regions of interest) around the last known positions of the
+# particles and the traps and only scans the full frame on a schedule or when
+# a particle is lost. ParticleLinker links the detections of consecutive
+# frames into tracks so that the particles keep their IDs between frames, and
+# estimates their velocities with a Kalman filter. The predicted positions are
+# used to place the windows and to aim the motor moves at where the particles
+# will be when the motors have moved.
+import numpy as np
+from collections import deque
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from time import time
+
+
+def get_tracking_c_p():
+    '''
+    Function for retrieving default c_p needed for the ROI tracking and the
+    linking of the particles.
+    '''
+    tracking_params = {
+        'ROI_tracking': True, # Track in windows around the particles and traps
+        'ROI_half_width': 50, # Particles are searched for within this many
+        # pixels from their last position
+        'ROI_margin': 30, # Extra pixels around the windows so that particles
+        # at the edge of a window are not cut.
+        'ROI_full_frame_interval': 20, # Number of frames between full scans
+        'linking_max_distance': 30, # Largest distance in pixels a particle
+        # may move between two frames and keep its ID
+        'linking_max_missed_frames': 5, # Frames a particle may be missing
+        # before its track ends
+        'track_history_length': 100, # Number of positions kept per track
+        'particle_ids': [], # Track IDs of the particles in particle_centers
+        'particle_velocities': [[], []], # Velocities of the particles in
+        # pixels per second
+        'particle_timestamp': 0, # Time when particle_centers were detected
+        'kalman_measurement_noise': 1, # Precision of the detections in pixels
+        'kalman_diffusion': 20, # Diffusion of the particles in pixels^2/s,
+        # needs to be calibrated.
+        'kalman_acceleration_noise': 100, # Random accelerations in pixels^2/s^3
+        'kalman_initial_velocity_std': 100, # Expected speed of new particles
+        # in pixels/s
+        'motor_latency': 0.2, # Seconds from a tracked frame until the motors
+        # have moved, particles are moved to where they are predicted to be
+        # then. Needs to be calibrated.
+        'piezo_latency': 0.05, # Same for the piezos
+        'trapped_particle_ids': {}, # ID of the particle in each trap
+    }
+    return tracking_params
+
+
+def get_window(center, half_size, image_shape):
+    '''
+    Returns the slices of a window of 2*half_size+1 pixels centered on
+    center = (x, y). Windows reaching outside of the image are moved inside it
+    so that all windows have the same shape, unless the image is smaller than
+    the window.
+    '''
+    window = []
+    for position, length in zip((center[1], center[0]), image_shape[:2]):
+        size = min(2 * half_size + 1, length)
+        start = int(round(position)) - half_size
+        start = min(max(start, 0), length - size)
+        window.append(slice(start, start + size))
+    return tuple(window)
+
+
+class ROITracker():
+    '''
+    Tracks particles by searching windows around their previous positions.
+    The detection function is only run on the full frame every
+    full_frame_interval frames, when there is nothing to track or when a
+    particle is not found in its window.
+    '''
+    def __init__(self, detect, half_width=50, margin=30,
+        full_frame_interval=20, duplicate_distance=3):
+        '''
+        Parameters
+        ----------
+        detect : function
+            Takes an image, or a part of it, and returns lists with the x and
+            y positions in pixels of the particles in it.
+        half_width : int, optional
+            Particles are searched for within half_width pixels from their
+            previous position and from the seeds, in x and y.
+        margin : int, optional
+            The windows given to detect extend margin pixels beyond
+            half_width, particles detected in the margin are not used.
+        full_frame_interval : int, optional
+            Maximum number of frames between two full frame scans.
+        duplicate_distance : float, optional
+            Detections closer than this, in pixels, are the same particle seen
+            in overlapping windows.
+        '''
+        self.detect = detect
+        self.half_width = half_width
+        self.margin = margin
+        self.full_frame_interval = full_frame_interval
+        self.duplicate_distance = duplicate_distance
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.frames_since_full_scan = 0
+        self.full_frame_scans = 0
+        self.ROI_scans = 0
+
+    def reset(self):
+        '''
+        Forgets the particles so that the next frame is scanned fully, for
+        instance after the stage or the AOI of the camera has moved.
+        '''
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+
+    def scan_full_frame(self, image):
+        x, y = self.detect(image)
+        self.frames_since_full_scan = 0
+        self.full_frame_scans += 1
+        return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+    def scan_windows(self, image, seeds_x, seeds_y):
+        '''
+        Detects the particles in the windows around the seeds.
+
+        Returns
+        -------
+        x, y : arrays
+            Positions of the particles found, duplicates removed.
+        found : array of bools
+            True for the seeds with a particle in their window.
+        '''
+        x = []
+        y = []
+        found = np.zeros(len(seeds_x), dtype=bool)
+        for index, seed in enumerate(zip(seeds_x, seeds_y)):
+            rows, columns = get_window(seed, self.half_width + self.margin,
+                                       np.shape(image))
+            window_x, window_y = self.detect(image[rows, columns])
+            window_x = np.asarray(window_x, dtype=float) + columns.start
+            window_y = np.asarray(window_y, dtype=float) + rows.start
+            inside = (np.abs(window_x - seed[0]) <= self.half_width) & \
+                (np.abs(window_y - seed[1]) <= self.half_width)
+            found[index] = np.any(inside)
+            x.extend(window_x[inside])
+            y.extend(window_y[inside])
+        x = np.asarray(x)
+        y = np.asarray(y)
+        # Overlapping windows find the same particles several times
+        unique = np.ones(len(x), dtype=bool)
+        for index in range(1, len(x)):
+            distances = np.hypot(x[:index] - x[index], y[:index] - y[index])
+            unique[index] = not np.any(distances[unique[:index]] <
+                                       self.duplicate_distance)
+        return x[unique], y[unique], found
+
+    def track(self, image, seeds=None, centers=None):
+        '''
+        Locates the particles in a new frame.
+
+        Parameters
+        ----------
+        image : array
+            The frame.
+        seeds : 2xN array, optional
+            Extra positions, in pixels, around which to look for particles, for
+            instance c_p['traps_relative_pos'] to find newly trapped particles.
+        centers : tuple of arrays, optional
+            Predicted positions x, y of the particles returned for the
+            previous frame, see predict_particle_centers. The windows are
+            centered on these instead of the previous positions.
+
+        Returns
+        -------
+        x, y : lists
+            Positions of the particles in pixels. Particles found again are
+            in the same order as in the previous frame.
+        '''
+        self.frames_since_full_scan += 1
+        full_scan = len(self.x) == 0 or \
+            self.frames_since_full_scan >= self.full_frame_interval
+        if not full_scan:
+            if centers is not None and len(centers[0]) == len(self.x):
+                self.x, self.y = centers
+            x, y, found = self.scan_windows(image, self.x, self.y)
+            # A particle which is not in its window, or which merged with
+            # another one, may be anywhere.
+            full_scan = not np.all(found) or len(x) < len(self.x)
+            if not full_scan and seeds is not None and len(seeds[0]) > 0:
+                seeds_x, seeds_y, _ = self.scan_windows(image, seeds[0],
+                                                        seeds[1])
+                new = [np.min(np.hypot(x - seed_x, y - seed_y)) >=
+                       self.duplicate_distance
+                       for seed_x, seed_y in zip(seeds_x, seeds_y)]
+                x = np.concatenate((x, seeds_x[new]))
+                y = np.concatenate((y, seeds_y[new]))
+            if not full_scan:
+                self.ROI_scans += 1
+        if full_scan:
+            x, y = self.scan_full_frame(image)
+        self.x = x
+        self.y = y
+        return list(x), list(y)
+
+
+class KalmanFilter():
+    '''
+    Kalman filter of the positions and velocities of many particles at once.
+    The particles move with constant velocity plus Brownian motion and
+    random accelerations, the same model along x and y. Since the model and
+    the measurements are the same for both axes a particle has a single
+    position-velocity covariance, stored as the three arrays p_xx, p_xv and
+    p_vv.
+    '''
+    def __init__(self, measurement_noise=1, diffusion=20,
+        acceleration_noise=100, initial_velocity_std=100):
+        '''
+        Parameters
+        ----------
+        measurement_noise : float, optional
+            Standard deviation of the detected positions in pixels.
+        diffusion : float, optional
+            Diffusion constant of the particles in pixels^2 per time unit.
+        acceleration_noise : float, optional
+            Spectral density of the random accelerations in pixels^2 per
+            time unit^3.
+        initial_velocity_std : float, optional
+            Standard deviation of the velocity of new particles in pixels per
+            time unit.
+        '''
+        self.measurement_noise = measurement_noise
+        self.diffusion = diffusion
+        self.acceleration_noise = acceleration_noise
+        self.initial_velocity_std = initial_velocity_std
+        self.position = np.zeros((0, 2))
+        self.velocity = np.zeros((0, 2))
+        self.p_xx = np.zeros(0)
+        self.p_xv = np.zeros(0)
+        self.p_vv = np.zeros(0)
+
+    def predict(self, dt):
+        '''
+        Moves the state of all particles dt time units forward.
+        '''
+        q = self.acceleration_noise
+        self.position += self.velocity * dt
+        self.p_xx += 2*dt*self.p_xv + dt**2*self.p_vv + \
+            2*self.diffusion*dt + q*dt**3/3
+        self.p_xv += dt*self.p_vv + q*dt**2/2
+        self.p_vv += q*dt
+
+    def update(self, indices, measured):
+        '''
+        Updates the particles indices with their measured positions, a
+        len(indices) x 2 array.
+        '''
+        innovation = measured - self.position[indices]
+        p_xx = self.p_xx[indices]
+        p_xv = self.p_xv[indices]
+        gain_x = p_xx / (p_xx + self.measurement_noise**2)
+        gain_v = p_xv / (p_xx + self.measurement_noise**2)
+        self.position[indices] += gain_x[:, None] * innovation
+        self.velocity[indices] += gain_v[:, None] * innovation
+        self.p_xx[indices] = (1 - gain_x) * p_xx
+        self.p_xv[indices] = (1 - gain_x) * p_xv
+        self.p_vv[indices] -= gain_v * p_xv
+
+    def add(self, measured):
+        '''
+        Adds particles at the measured positions with unknown velocities.
+        '''
+        nbr_new = len(measured)
+        self.position = np.concatenate((self.position, measured))
+        self.velocity = np.concatenate((self.velocity, np.zeros((nbr_new, 2))))
+        self.p_xx = np.concatenate((self.p_xx,
+            np.full(nbr_new, float(self.measurement_noise**2))))
+        self.p_xv = np.concatenate((self.p_xv, np.zeros(nbr_new)))
+        self.p_vv = np.concatenate((self.p_vv,
+            np.full(nbr_new, float(self.initial_velocity_std**2))))
+
+    def keep(self, kept):
+        '''
+        Removes all particles but those where kept is True.
+        '''
+        self.position = self.position[kept]
+        self.velocity = self.velocity[kept]
+        self.p_xx = self.p_xx[kept]
+        self.p_xv = self.p_xv[kept]
+        self.p_vv = self.p_vv[kept]
+
+
+class ParticleLinker():
+    '''
+    Links the particles detected in consecutive frames into tracks, each with
+    a unique ID. The positions and velocities of the tracks are estimated with
+    a KalmanFilter. A detection is linked to a track if it is within
+    max_distance of the predicted position of the track, conflicts are
+    resolved by minimizing the total distance of the links.
+    '''
+    def __init__(self, max_distance=30, max_missed_frames=5,
+        history_length=100, measurement_noise=1, diffusion=20,
+        acceleration_noise=100, initial_velocity_std=100):
+        '''
+        Parameters
+        ----------
+        max_distance : float, optional
+            Largest distance in pixels between a detection and the predicted
+            position of a track for them to be linked.
+        max_missed_frames : int, optional
+            A track ends when it has not been linked for this many frames.
+        history_length : int, optional
+            Number of positions kept in the history of each track.
+        measurement_noise, diffusion, acceleration_noise, initial_velocity_std
+            : float, optional
+            Parameters of the KalmanFilter, in the time unit of the
+            timestamps given to link.
+        '''
+        self.max_distance = max_distance
+        self.max_missed_frames = max_missed_frames
+        self.history_length = history_length
+        self.filter = KalmanFilter(measurement_noise, diffusion,
+                                   acceleration_noise, initial_velocity_std)
+        self.next_id = 0
+        self.frame = 0
+        self.time = 0
+        self.ids = np.zeros(0, dtype=int)
+        self.last_frame = np.zeros(0, dtype=int)
+        self.history = {}
+
+    def reset(self):
+        '''
+        Ends all tracks.
+        '''
+        self.filter.keep(np.zeros(len(self.ids), dtype=bool))
+        self.ids = np.zeros(0, dtype=int)
+        self.last_frame = np.zeros(0, dtype=int)
+        self.history = {}
+
+    def match(self, x, y):
+        '''
+        Finds the links between the tracks, at their predicted positions, and
+        the detections x, y.
+
+        Returns
+        -------
+        tracks, detections : arrays of ints
+            Track k is linked to detection detections[k].
+        '''
+        if len(self.ids) == 0 or len(x) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        detected = np.column_stack((x, y))
+        # Only pairs within max_distance are candidates, found with KD-trees
+        # so that the number of candidates grows linearly with the number of
+        # particles.
+        candidates = cKDTree(self.filter.position).sparse_distance_matrix(
+            cKDTree(detected), self.max_distance, output_type='coo_matrix')
+        if candidates.nnz == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        tracks = np.unique(candidates.row)
+        detections = np.unique(candidates.col)
+        unlinked = 2 * self.max_distance * (len(tracks) + len(detections))
+        costs = np.full((len(tracks), len(detections)), float(unlinked))
+        costs[np.searchsorted(tracks, candidates.row),
+              np.searchsorted(detections, candidates.col)] = candidates.data
+        rows, columns = linear_sum_assignment(costs)
+        linked = costs[rows, columns] < unlinked
+        return tracks[rows[linked]], detections[columns[linked]]
+
+    def link(self, x, y, timestamp=None):
+        '''
+        Links the detections of a new frame to the tracks.
+
+        Parameters
+        ----------
+        x, y : lists or arrays
+            Positions of the particles detected in the frame in pixels.
+        timestamp : float, optional
+            Time of the frame, e.g. from time.time(). The frame number if
+            None, the velocities are then in pixels per frame.
+
+        Returns
+        -------
+        ids : array of ints
+            Track ID of each detection. Detections which could not be linked
+            start new tracks.
+        '''
+        self.frame += 1
+        timestamp = self.frame if timestamp is None else timestamp
+        self.filter.predict(timestamp - self.time)
+        self.time = timestamp
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        tracks, detections = self.match(x, y)
+
+        # Update the linked tracks
+        self.filter.update(tracks, np.column_stack((x[detections],
+                                                    y[detections])))
+        self.last_frame[tracks] = self.frame
+
+        # End the tracks which have been missing for too long
+        ended = self.frame - self.last_frame > self.max_missed_frames
+        for track_id in self.ids[ended]:
+            del self.history[track_id]
+        ids = np.full(len(x), -1)
+        ids[detections] = self.ids[tracks]
+        kept = ~ended
+        self.ids = self.ids[kept]
+        self.last_frame = self.last_frame[kept]
+        self.filter.keep(kept)
+
+        # Start new tracks
+        new = np.flatnonzero(ids < 0)
+        ids[new] = np.arange(self.next_id, self.next_id + len(new))
+        self.next_id += len(new)
+        self.ids = np.concatenate((self.ids, ids[new]))
+        self.last_frame = np.concatenate((self.last_frame,
+                                          np.full(len(new), self.frame)))
+        self.filter.add(np.column_stack((x[new], y[new])))
+        for track_id in ids[new]:
+            self.history[track_id] = deque(maxlen=self.history_length)
+        for track_id, particle_x, particle_y in zip(ids, x, y):
+            self.history[track_id].append((timestamp, particle_x, particle_y))
+        return ids
+
+    def get_velocities(self, ids):
+        '''
+        Returns the estimated velocities vx, vy in pixels per time unit of the
+        tracks ids.
+        '''
+        velocity = self.filter.velocity[np.searchsorted(self.ids, ids)]
+        return velocity[:, 0], velocity[:, 1]
+
+    def predict(self, ids, timestamp):
+        '''
+        Returns the predicted positions x, y at timestamp of the tracks ids.
+        '''
+        indices = np.searchsorted(self.ids, ids)
+        position = self.filter.position[indices] + \
+            self.filter.velocity[indices] * (timestamp - self.time)
+        return position[:, 0], position[:, 1]
+
+    def get_history(self, track_id):
+        '''
+        Returns the latest positions of a track as an array with the rows
+        timestamp, x, y.
+        '''
+        return np.asarray(self.history[track_id]).T
+
+
+def get_linker(c_p):
+    '''
+    Creates the ParticleLinker configured in c_p.
+    '''
+    return ParticleLinker(c_p['linking_max_distance'],
+        c_p['linking_max_missed_frames'], c_p['track_history_length'],
+        c_p['kalman_measurement_noise'], c_p['kalman_diffusion'],
+        c_p['kalman_acceleration_noise'], c_p['kalman_initial_velocity_std'])
+
+
+def update_particle_centers(c_p, linker, x, y, timestamp=None):
+    '''
+    Links the particles x, y to the tracks of linker and puts their positions,
+    track IDs, velocities and the timestamp in c_p.
+    '''
+    timestamp = time() if timestamp is None else timestamp
+    ids = linker.link(x, y, timestamp)
+    vx, vy = linker.get_velocities(ids)
+    c_p['particle_centers'] = [x, y]
+    c_p['particle_ids'] = ids.tolist()
+    c_p['particle_velocities'] = [vx.tolist(), vy.tolist()]
+    c_p['particle_timestamp'] = timestamp
+
+
+def predict_particle_centers(c_p, latency=0):
+    '''
+    Predicts where the particles in c_p['particle_centers'] will be latency
+    seconds from now, from their velocities.
+
+    Returns
+    -------
+    x, y : arrays or None
+        The predicted positions in pixels, None if the particles have not
+        been linked.
+    '''
+    if get_particle_ids(c_p) is None or \
+        len(c_p['particle_velocities'][0]) != len(c_p['particle_centers'][0]):
+        return None
+    elapsed = time() + latency - c_p['particle_timestamp']
+    x = np.asarray(c_p['particle_centers'][0], dtype=float) + \
+        np.asarray(c_p['particle_velocities'][0]) * elapsed
+    y = np.asarray(c_p['particle_centers'][1], dtype=float) + \
+        np.asarray(c_p['particle_velocities'][1]) * elapsed
+    return x, y
+
+
+def get_particle_ids(c_p):
+    '''
+    Returns the track IDs of the particles in c_p['particle_centers'], None
+    if the particles have not been linked.
+    '''
+    ids = c_p.get('particle_ids', [])
+    if len(ids) != len(c_p['particle_centers'][0]):
+        return None
+    return ids
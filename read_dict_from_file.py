@@ -14,7 +14,7 @@ float_parameters = ['LGO_order', 'setpoint_temperature',
 
 bool_parameters = ['temperature_output_on', 'activate_traps_one_by_one',
                    'need_T_stable']
-int_parameters = ['SLM_iterations']
+int_parameters = ['SLM_iterations', 'SLM_decimation', 'SLM_camera_feedback']
 
 bool_list = ['use_LGO']
 float_list = ['xm', 'ym', 'zm', 'ghost_traps_x', 'ghost_traps_y',
@@ -28,6 +28,8 @@ def LoadPhasemask(phasemaskDictPath):
     Function for loading the phasemask of a previous experiment located in a
     pickled dict in phasemaskDictPath (as automatically saved by the program).
     Returns the loaded phasemask if successfull, otherwise None.
+    Legacy, phasemasks are now reused through the phasemask cache, see
+    SLM_phasemask_cache.py.
     '''
     try:
         file = open(phasemaskDictPath,'rb')
@@ -0,0 +1,57 @@
+# Tests of the FFTW plans of the quantum dot tracking, run with pytest.
+import os
+from time import sleep, time
+import pyfftw
+import pytest
+import QD_tracking
+
+
+@pytest.fixture
+def fresh_plans(tmp_path, monkeypatch):
+    '''
+    Empty plan cache and wisdom, saved to a temporary wisdom_file.
+    '''
+    monkeypatch.setattr(QD_tracking, 'wisdom_file',
+                        str(tmp_path / 'FFTW_wisdom.pickle'))
+    monkeypatch.setattr(QD_tracking, 'fft_objects', QD_tracking.OrderedDict())
+    monkeypatch.setattr(QD_tracking, 'measuring_shapes', set())
+    monkeypatch.setattr(QD_tracking, 'wisdom_loaded', False)
+    pyfftw.forget_wisdom()
+    yield QD_tracking.wisdom_file
+    pyfftw.forget_wisdom()
+
+
+def wait_for(condition, timeout=60):
+    start = time()
+    while not condition():
+        assert time() - start < timeout, 'Timed out'
+        sleep(0.05)
+
+
+def test_plans_are_measured_in_the_background(fresh_plans):
+    shape = (48, 60)
+    estimated = QD_tracking.get_fft_object(shape)
+    assert 'FFTW_ESTIMATE' in estimated.flags
+    wait_for(lambda: 'FFTW_MEASURE' in QD_tracking.fft_objects[shape].flags)
+    assert os.path.isfile(fresh_plans)
+    measured = QD_tracking.get_fft_object(shape)
+    assert measured is QD_tracking.fft_objects[shape]
+    assert not QD_tracking.measuring_shapes
+
+    # A new session creates the measured plan from the saved wisdom
+    pyfftw.forget_wisdom()
+    QD_tracking.fft_objects.clear()
+    QD_tracking.wisdom_loaded = False
+    planned = QD_tracking.get_fft_object(shape)
+    assert 'FFTW_WISDOM_ONLY' in planned.flags
+    assert not QD_tracking.measuring_shapes
+
+
+def test_wisdom_is_saved_for_evicted_shapes(fresh_plans):
+    # The shape is no longer in fft_objects when the measurement finishes
+    QD_tracking.measure_fft_object((40, 36))
+    assert (40, 36) not in QD_tracking.fft_objects
+    pyfftw.forget_wisdom()
+    assert QD_tracking.load_wisdom()
+    QD_tracking.create_fft_object((40, 36),
+                                  ('FFTW_MEASURE', 'FFTW_WISDOM_ONLY'))
@@ -0,0 +1,293 @@
+# Tests of the phasemask calculation, run with pytest.
+import numpy as np
+from time import sleep, time
+import SLM
+
+
+def get_test_c_p(image_width=64):
+    '''
+    Control parameters for calculating small phasemasks without hardware.
+    '''
+    c_p = SLM.get_SLM_c_p()
+    c_p.update({
+        'phasemask_width': image_width,
+        'phasemask_height': image_width,
+        'SLM_cache_directory': None,
+        'SLM_iterations': 10,
+        'xm': [], 'ym': [], 'zm': [],
+        'use_LGO': [False],
+        'LGO_order': -8,
+        'slm_to_pixel': 5e6,
+        'slm_x_center': 558,
+        'slm_y_center': 576,
+        'program_running': True,
+        'new_phasemask': False,
+        'phasemask_updated': False,
+        'phasemask': np.zeros((image_width, image_width)),
+        'image': np.zeros((100, 100)),
+    })
+    return c_p
+
+
+def wait_for(condition, timeout=60):
+    start = time()
+    while not condition():
+        assert time() - start < timeout, 'Timed out'
+        sleep(0.05)
+
+
+def test_phasemask_thread_calculates_two_masks():
+    c_p = get_test_c_p()
+    thread = SLM.CreatePhasemaskThread(1, 'Test phasemask thread', c_p)
+    thread.start()
+    try:
+        wait_for(lambda: c_p['phasemask_updated'])
+        first = np.copy(c_p['phasemask'])
+        assert len(c_p['traps_absolute_pos'][0]) == len(c_p['xm'])
+
+        c_p['phasemask_updated'] = False
+        c_p['xm'] = [1e-5, -1e-5, 2e-5]
+        c_p['ym'] = [1e-5, 2e-5, -1e-5]
+        c_p['zm'] = np.zeros(3)
+        c_p['new_phasemask'] = True
+        wait_for(lambda: not c_p['new_phasemask'])
+        assert c_p['phasemask_updated']
+        assert thread.is_alive()
+        assert not np.array_equal(first, c_p['phasemask'])
+        assert np.shape(c_p['traps_absolute_pos']) == (2, 3)
+        assert np.allclose(c_p['traps_absolute_pos'][0],
+                           [608, 508, 658])
+    finally:
+        c_p['program_running'] = False
+        thread.join(timeout=5)
+
+
+def test_GS_FFT_in_parallel_threads():
+    # GS_FFT keeps FFTW plans between calls, threads must not share them.
+    from concurrent.futures import ThreadPoolExecutor
+    xm, ym = SLM.get_xm_ym_rect(3, 3, dx=20e-6, dy=20e-6, d0x=-20e-6,
+                                d0y=-20e-6)
+    # Fixed trap phases instead of a random start so the results are equal
+    trap_phases = np.linspace(0, 2*np.pi, 9, endpoint=False)
+    def calculate(i):
+        return SLM.GS_FFT(xm, ym, image_width=128, nbr_iterations=20,
+                          trap_phases=trap_phases)
+    expected = calculate(0)
+    with ThreadPoolExecutor(8) as executor:
+        phasemasks = list(executor.map(calculate, range(16)))
+    for phasemask in phasemasks:
+        assert np.allclose(phasemask, expected, atol=1e-2)
+
+
+def test_only_complete_phasemasks_are_cached(tmp_path):
+    c_p = get_test_c_p()
+    c_p['SLM_cache_directory'] = str(tmp_path)
+    calculator = SLM.PhasemaskCalculator(64, SLM.get_phasemask_cache(c_p))
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(2, 2, dx=20e-6, dy=20e-6)
+    c_p['zm'] = np.zeros(4)
+    c_p['use_LGO'] = [False]
+    phasemask, report = calculator.calculate(SLM.get_phasemask_parameters(c_p))
+    assert report['iterations'] == c_p['SLM_iterations']
+
+    # Warm started from the first phasemask, must not be stored.
+    c_p['xm'] = np.asarray(c_p['xm']) + 0.5e-6
+    parameters = SLM.get_phasemask_parameters(c_p)
+    phasemask, report = calculator.calculate(parameters)
+    assert report['iterations'] == c_p['SLM_warm_start_iterations']
+    assert calculator.cache.load(calculator.get_cache_key(parameters))[0] is None
+
+    parameters['SLM_warm_start'] = False
+    calculator.calculate(parameters)
+    assert calculator.cache.load(calculator.get_cache_key(parameters))[0] is not None
+
+
+def test_warm_start_only_after_small_moves():
+    c_p = get_test_c_p()
+    calculator = SLM.PhasemaskCalculator(64)
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(2, 2, dx=20e-6, dy=20e-6)
+    c_p['zm'] = np.zeros(4)
+    calculator.calculate(SLM.get_phasemask_parameters(c_p))
+
+    c_p['xm'] = np.asarray(c_p['xm']) + 0.5e-6
+    report = calculator.calculate(SLM.get_phasemask_parameters(c_p))[1]
+    assert report['iterations'] == c_p['SLM_warm_start_iterations']
+
+    # Same number of traps but rearranged, starts from scratch.
+    c_p['xm'] = np.asarray(c_p['xm']) + 15e-6
+    report = calculator.calculate(SLM.get_phasemask_parameters(c_p))[1]
+    assert report['iterations'] == c_p['SLM_iterations']
+
+
+def test_precompiler_in_worker_process_with_ghost_traps():
+    import SLM_precompiler
+    c_p = get_test_c_p()
+    c_p['SLM_worker_process'] = True
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(2, 2, dx=20e-6, dy=20e-6)
+    c_p['zm'] = np.zeros(4)
+    schedule = [{'xm': c_p['xm'], 'ym': c_p['ym'],
+                 'ghost_traps_x': [3e-5], 'ghost_traps_y': [-3e-5]}]
+    precompiler = SLM_precompiler.PhasemaskPrecompiler(c_p, schedule)
+    precompiler.run()
+
+    # The traps as add_ghost_traps sets them when the experiment runs
+    c_p['xm'], c_p['ym'], c_p['zm'] = SLM_precompiler.append_ghost_traps(
+        c_p['xm'], c_p['ym'], c_p['zm'], [3e-5], [-3e-5], c_p)
+    key = precompiler.calculator.get_cache_key(SLM.get_phasemask_parameters(c_p))
+    assert len(c_p['precompiled_phasemasks']) == 2
+    phasemask, report = c_p['precompiled_phasemasks'][key]
+    assert np.shape(phasemask) == (64, 64)
+    assert report['iterations'] == c_p['SLM_iterations']
+
+
+def test_worker_warm_starts_from_phasemask_set_in_parent():
+    import SLM_worker
+    c_p = get_test_c_p()
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(3, 3, dx=20e-6, dy=20e-6)
+    c_p['zm'] = np.zeros(9)
+    worker = SLM_worker.PhasemaskWorker(c_p)
+    worker.start()
+    try:
+        assert worker.request(SLM.get_phasemask_parameters(c_p))[0] is not None
+
+        # A precompiled phasemask of other traps is shown on the SLM
+        c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(2, 2, dx=20e-6, dy=20e-6)
+        c_p['zm'] = np.zeros(4)
+        parameters = SLM.get_phasemask_parameters(c_p)
+        phasemask = SLM.PhasemaskCalculator(64).calculate(parameters)[0]
+        worker.set_phasemask(phasemask, parameters)
+
+        c_p['xm'] = np.asarray(c_p['xm']) + 0.5e-6
+        report = worker.request(SLM.get_phasemask_parameters(c_p))[1]
+        assert report['iterations'] == c_p['SLM_warm_start_iterations']
+    finally:
+        worker.stop()
+
+
+def test_camera_feedback_on_cached_phasemask(tmp_path):
+    c_p = get_test_c_p()
+    c_p['SLM_cache_directory'] = str(tmp_path)
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(2, 2, dx=20e-6, dy=20e-6)
+    c_p['zm'] = np.zeros(4)
+    parameters = SLM.get_phasemask_parameters(c_p)
+    first = SLM.PhasemaskCalculator(64, SLM.get_phasemask_cache(c_p))
+    first.calculate(parameters)
+
+    calculator = SLM.PhasemaskCalculator(64, SLM.get_phasemask_cache(c_p))
+    report = calculator.calculate(parameters)[1]
+    assert report['cached']
+    # The trap phases are recovered from the phasemask, close to those of
+    # the calculation up to the rounding of the stored phasemask.
+    difference = np.angle(np.exp(1j*(calculator.state['trap_phases'] -
+                                     first.state['trap_phases'])))
+    assert np.max(np.abs(difference)) < 0.3
+    phasemask, report = calculator.calculate_feedback(parameters,
+        [1, 1, 1, 0.5])
+    assert phasemask is not None
+    assert report['camera_feedback']
+
+
+def test_GSW_tiled_reports_like_GSW_float32():
+    xm, ym = SLM.get_xm_ym_rect(3, 3, dx=20e-6, dy=20e-6)
+    Delta, N, M = SLM.DeltaCache(64, dtype=np.float32).get_delta(xm=xm,
+        ym=ym, zm=np.zeros(9), use_LGO=[False]*9, order=-8)
+    trap_phases = np.linspace(0, 2*np.pi, 9, endpoint=False)
+    reports = []
+    for kernel in [SLM.GSW_float32, SLM.GSW_tiled]:
+        state = {}
+        kernel(N, M, Delta, image_width=64, nbr_iterations=3,
+               trap_phases=trap_phases, state=state)
+        reports.append(state)
+    assert reports[0]['iterations'] == reports[1]['iterations'] == 3
+    assert np.isclose(reports[0]['uniformity'], reports[1]['uniformity'],
+                      atol=1e-4)
+    # Both are float32 sums over the pixels, in different orders
+    assert np.allclose(np.exp(1j*reports[0]['trap_phases']),
+                       np.exp(1j*reports[1]['trap_phases']), atol=5e-3)
+
+
+def test_reports_describe_the_returned_phasemask():
+    from SLM_benchmark import evaluate_phasemask
+    xm, ym = SLM.get_xm_ym_rect(3, 3, dx=20e-6, dy=20e-6)
+    traps = dict(xm=xm, ym=ym, zm=np.zeros(9), use_LGO=[False]*9, order=-8)
+    Delta, N, M = SLM.get_delta(image_width=64, **traps)
+    Delta_32 = SLM.DeltaCache(64, dtype=np.float32).get_delta(**traps)[0]
+    trap_phases = np.linspace(0, 2*np.pi, 9, endpoint=False)
+    for kernel, kernel_Delta in [(SLM.GSW, Delta), (SLM.GS, Delta),
+        (SLM.GSW_float32, Delta_32), (SLM.GSW_tiled, Delta_32)]:
+        state = {}
+        phasemask = kernel(N, M, kernel_Delta, image_width=64,
+            nbr_iterations=2, trap_phases=trap_phases, state=state)
+        uniformity, efficiency = evaluate_phasemask(phasemask, xm, ym)
+        assert np.isclose(state['uniformity'], uniformity, atol=1e-5)
+        assert np.isclose(state['efficiency'], efficiency, atol=1e-5)
+    state = {}
+    phasemask = SLM.GS_FFT(xm, ym, image_width=64, nbr_iterations=2,
+                           state=state)
+    assert np.isclose(state['uniformity'],
+                      evaluate_phasemask(phasemask, xm, ym)[0], atol=1e-5)
+
+
+def test_decimated_phasemask_is_close_to_the_coarse_one():
+    from SLM_benchmark import evaluate_phasemask
+    c_p = get_test_c_p(128)
+    c_p['SLM_decimation'] = 2
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(3, 3, dx=20e-6, dy=20e-6)
+    c_p['zm'] = np.zeros(9)
+    calculator = SLM.PhasemaskCalculator(128, image_height=96)
+    phasemask, report = calculator.calculate(
+        SLM.get_phasemask_parameters(c_p))
+    assert np.shape(phasemask) == (96, 128)
+    assert report['iterations'] == c_p['SLM_refine_iterations']
+    assert np.isclose(report['uniformity_penalty'],
+                      report['coarse_uniformity'] - report['uniformity'])
+    assert report['uniformity_penalty'] < 0.05
+    uniformity = evaluate_phasemask(phasemask, c_p['xm'], c_p['ym'])[0]
+    assert np.isclose(uniformity, report['uniformity'], atol=1e-5)
+
+
+def test_warm_start_on_steps_of_exactly_the_limit():
+    c_p = get_test_c_p()
+    c_p['SLM_warm_start_max_displacement'] = 1e-6
+    calculator = SLM.PhasemaskCalculator(64)
+    c_p['xm'], c_p['ym'], c_p['zm'] = [1.7e-5, -1e-5], [1e-5, -2e-5], np.zeros(2)
+    calculator.calculate(SLM.get_phasemask_parameters(c_p))
+    for step in range(5):
+        c_p['xm'] = [x + 1e-6 for x in c_p['xm']]
+        report = calculator.calculate(SLM.get_phasemask_parameters(c_p))[1]
+        assert report['iterations'] == c_p['SLM_warm_start_iterations']
+
+
+def test_trajectory_chunks_start_from_the_first_phasemask():
+    import SLM_trajectory
+    c_p = get_test_c_p(128)
+    xm, ym = SLM.get_xm_ym_rect(2, 2, dx=20e-6, dy=20e-6)
+    # 2 um steps, longer than the default warm start limit
+    layouts = SLM_trajectory.get_trajectory(xm, ym, np.asarray(xm) + 40e-6,
+                                            ym, 20)
+    phasemasks, reports = SLM_trajectory.calculate_trajectory(layouts,
+        SLM.get_phasemask_parameters(c_p), nbr_workers=4, image_width=128)
+    assert len(phasemasks) == 21
+    iterations = [report['iterations'] for report in reports]
+    # One cold start, then the starts of the 3 chunks which are not next to
+    # the first layout.
+    assert iterations.count(c_p['SLM_iterations']) == 4
+    assert iterations.count(c_p['SLM_warm_start_iterations']) == 17
+    assert min(report['uniformity'] for report in reports) > 0.9
+
+
+def test_GS_FFT_oversampling_from_parameters():
+    c_p = get_test_c_p(128)
+    c_p['SLM_algorithm'] = 'GS_FFT'
+    c_p['SLM_iterations'] = 20
+    c_p['xm'], c_p['ym'] = SLM.get_xm_ym_rect(3, 3, dx=20e-6, dy=20e-6,
+                                              d0x=-20e-6, d0y=-20e-6)
+    c_p['zm'] = np.zeros(9)
+    calculator = SLM.PhasemaskCalculator(128)
+    coarse = SLM.get_phasemask_parameters(c_p)
+    c_p['SLM_oversampling'] = 4
+    fine = SLM.get_phasemask_parameters(c_p)
+    assert calculator.get_cache_key(coarse) != calculator.get_cache_key(fine)
+    coarse_report = calculator.calculate(dict(coarse, SLM_warm_start=False))[1]
+    fine_report = calculator.calculate(dict(fine, SLM_warm_start=False))[1]
+    assert fine_report['uniformity'] > coarse_report['uniformity']
+    assert fine_report['uniformity'] > 0.95
@@ -0,0 +1,15 @@
+# Tests of the conversion of phasemasks for the SLM, run with pytest.
+import numpy as np
+from math import pi
+import SLM_output
+
+
+def test_linear_lut_reproduces_the_phasemask():
+    Phi = np.random.RandomState(0).uniform(-pi, pi, (40, 50))
+    Phi[0, :4] = [-pi, pi - 1e-9, 0, pi/2]
+    output = SLM_output.PhasemaskOutput(50, 40)
+    buffer = output.convert(128 + Phi*255/(2*pi))
+    assert buffer.dtype == np.uint8 and np.shape(buffer) == (40, 50)
+    # Compared as phases since gray levels 0 and 255 are both about pi
+    difference = np.angle(np.exp(1j*((buffer - 128.0)*2*pi/255 - Phi)))
+    assert np.max(np.abs(difference)) <= 2*pi/255
@@ -0,0 +1,21 @@
+# Tests of the focal plane simulation, run with pytest.
+import numpy as np
+import SLM
+import SLM_simulation
+
+
+def test_simulated_intensities_match_GS_FFT_report():
+    image_width = 64
+    # Traps on the focal plane grid, where |V|^2 is the simulated intensity
+    grid_spacing = SLM.laser_wavelength * SLM.focal_length / \
+        (SLM.SLM_pixel_size * image_width)
+    xm = np.array([3, 7, -5, 10, -9]) * grid_spacing
+    ym = np.array([2, -6, 8, 0, -3]) * grid_spacing
+    state = {}
+    phasemask = SLM.GS_FFT(xm, ym, image_width=image_width, nbr_iterations=5,
+                           state=state)
+    intensities = SLM_simulation.simulate_focal_plane(phasemask, xm, ym,
+                                                      trap_radius=0)
+    assert np.isclose(np.sum(intensities), state['efficiency'], rtol=1e-4)
+    assert np.isclose(SLM.get_uniformity(np.sqrt(intensities)),
+                      state['uniformity'], atol=1e-4)
@@ -0,0 +1,44 @@
+# Tests of the particle detection, run with pytest.
+import numpy as np
+import scipy.ndimage as ndi
+from skimage import measure
+import find_particle_threshold as fpt
+
+
+def test_label_properties_match_center_of_mass():
+    labels = np.zeros((40, 50), dtype=int)
+    labels[2:5, 3:10] = 1
+    labels[20:31, 30:34] = 2
+    labels[9:12, 39:42] = 3
+    labels[25:28, 5:8] = 2 # A label can have several parts
+    # Label 4 is missing
+    labels[35:38, 20:30] = 5
+    properties = fpt.get_label_properties(labels)
+    assert list(properties['label']) == [1, 2, 3, 4, 5]
+    assert list(properties['area']) == [21, 53, 9, 0, 30]
+    for label in [1, 2, 3, 5]:
+        index = label - 1
+        y, x = ndi.center_of_mass(labels == label)
+        assert np.isclose(properties['x'][index], x)
+        assert np.isclose(properties['y'][index], y)
+    assert list(properties['bbox'][0]) == [2, 3, 5, 10]
+    # Square particles have no eccentricity, elongated ones high
+    assert properties['eccentricity'][2] < 1e-3
+    assert properties['eccentricity'][0] > 0.8
+
+
+def test_find_particle_centers_within_size_thresholds():
+    image = np.zeros((100, 120), dtype=np.uint8)
+    rows, columns = np.mgrid[:100, :120]
+    for x, y, radius in [(20, 30, 3), (60, 50, 8), (95, 70, 20)]:
+        image[(rows - y)**2 + (columns - x)**2 <= radius**2] = 200
+    image[55:58, 66:75] = 200 # Makes the middle particle asymmetric
+    # Only the middle particle, about 230 pixels, is within the thresholds
+    x, y, thresholded_image = fpt.find_particle_centers(image, threshold=120,
+        particle_size_threshold=100, particle_upper_size_threshold=1000)
+    assert len(x) == len(y) == 1
+    labels = measure.label(thresholded_image)
+    expected_y, expected_x = ndi.center_of_mass(labels == labels[50, 60])
+    assert np.isclose(x[0], expected_x)
+    assert np.isclose(y[0], expected_y)
+    assert not np.isclose(x[0], 60)
@@ -0,0 +1,93 @@
+# Tests of the tracking and linking of particles, run with pytest.
+import numpy as np
+import particle_tracking
+
+
+def detect_bright_pixels(image):
+    '''
+    Detection function for ROITracker, every bright pixel is a particle.
+    '''
+    y, x = np.nonzero(image > 0.5)
+    return list(x), list(y)
+
+
+def get_image(x, y, shape=(200, 300)):
+    image = np.zeros(shape)
+    image[np.round(y).astype(int), np.round(x).astype(int)] = 1
+    return image
+
+
+def test_ids_are_kept_between_frames():
+    linker = particle_tracking.ParticleLinker(max_distance=10)
+    x = np.array([10., 50., 90.])
+    y = np.array([20., 20., 60.])
+    first = linker.link(x, y)
+    # The particles move a little and are detected in another order
+    order = [2, 0, 1]
+    ids = linker.link(x[order] + 2, y[order] - 1)
+    assert list(ids) == list(first[order])
+    assert linker.next_id == 3
+
+
+def test_missed_frames_keep_the_id():
+    linker = particle_tracking.ParticleLinker(max_distance=10,
+                                              max_missed_frames=2)
+    ids = linker.link([10, 50], [20, 20])
+    # The second particle is missing for max_missed_frames frames
+    linker.link([10], [20])
+    linker.link([10], [20])
+    assert list(linker.link([10, 50], [20, 20])) == list(ids)
+    # but is a new particle when it has been missing for longer
+    for frame in range(3):
+        linker.link([10], [20])
+    new_ids = linker.link([10, 50], [20, 20])
+    assert new_ids[0] == ids[0]
+    assert new_ids[1] not in ids
+    assert ids[1] not in linker.history
+
+
+def test_ended_tracks_keep_ids_sorted():
+    linker = particle_tracking.ParticleLinker(max_distance=5,
+        max_missed_frames=0, measurement_noise=0.1)
+    linker.link([10, 50, 90], [20, 20, 20], timestamp=0)
+    # The middle track ends and a new one starts elsewhere
+    ids = linker.link([11, 91, 150], [20, 20, 80], timestamp=1)
+    assert list(ids) == [0, 2, 3]
+    assert list(linker.ids) == [0, 2, 3]
+    # searchsorted finds the rows of the tracks in the filter
+    vx, vy = linker.get_velocities([2, 3, 0])
+    assert vx[0] > 0 and vx[2] > 0
+    assert vx[1] == 0
+    x, y = linker.predict([3], 1)
+    assert np.allclose([x[0], y[0]], [150, 80], atol=0.5)
+
+
+def test_kalman_filter_follows_constant_velocity():
+    kalman = particle_tracking.KalmanFilter(measurement_noise=0.1,
+        diffusion=0, acceleration_noise=1)
+    kalman.add(np.array([[0., 0.]]))
+    velocity = np.array([3., -2.])
+    for step in range(1, 20):
+        kalman.predict(1)
+        kalman.update(np.array([0]), velocity[None, :] * step)
+    assert np.allclose(kalman.velocity[0], velocity, atol=1e-2)
+    kalman.predict(1)
+    assert np.allclose(kalman.position[0], velocity * 20, atol=1e-2)
+
+
+def test_ROI_tracker_scans_full_frame_when_a_particle_is_lost():
+    tracker = particle_tracking.ROITracker(detect_bright_pixels, half_width=10,
+        margin=5, full_frame_interval=100)
+    x, y = [50, 200], [40, 150]
+    assert tracker.track(get_image(x, y)) == ([50, 200], [40, 150])
+    assert tracker.full_frame_scans == 1
+    # Small moves are found in the windows, in the same order
+    x, y = [53, 198], [42, 150]
+    assert tracker.track(get_image(x, y)) == (x, y)
+    assert tracker.ROI_scans == 1
+    assert tracker.full_frame_scans == 1
+    # The second particle jumped out of its window
+    x, y = [54, 100], [42, 100]
+    found_x, found_y = tracker.track(get_image(x, y))
+    assert tracker.full_frame_scans == 2
+    assert sorted(zip(found_x, found_y)) == sorted(zip(x, y))
@@ -0,0 +1,326 @@
+# Benchmarks for the particle detection and tracking
+import numpy as np
+import tracemalloc, io, contextlib
+from time import time
+from skimage import measure
+import find_particle_threshold as fpt
+from particle_tracking import ROITracker, ParticleLinker
+
+
+def run_measured(function, *args, **kwargs):
+    '''
+    Calls function(*args, **kwargs) and measures the time and the peak memory
+    allocated during the call. Output printed by the function is suppressed.
+    Same as in SLM_benchmark, which is not imported since it needs the SLM
+    dependencies.
+
+    Returns
+    -------
+    result, time in seconds, peak memory in bytes
+    '''
+    tracemalloc.start()
+    start = time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    duration = time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def get_test_frame(image_shape=(3008, 3600), nbr_particles=30, radius=15,
+    brightness=200, noise=5, seed=0, x=None, y=None):
+    '''
+    Synthetic camera frame with bright round particles on a dark background.
+    The particles are put at random positions unless x and y are given.
+
+    Returns
+    -------
+    image : uint8 array
+    x, y : arrays
+        True centers of the particles in pixels.
+    '''
+    random_state = np.random.RandomState(seed)
+    margin = 3 * radius
+    if x is None:
+        x = random_state.uniform(margin, image_shape[1] - margin, nbr_particles)
+        y = random_state.uniform(margin, image_shape[0] - margin, nbr_particles)
+    image = random_state.normal(20, noise, image_shape)
+    for px, py in zip(x, y):
+        top, left = int(py) - margin, int(px) - margin
+        rows = np.arange(top, top + 2*margin)[:, None]
+        columns = np.arange(left, left + 2*margin)[None, :]
+        inside = (rows - py)**2 + (columns - px)**2 <= radius**2
+        image[top:top+2*margin, left:left+2*margin][inside] = brightness
+    return np.clip(image, 0, 255).astype(np.uint8), x, y
+
+
+def benchmark_particle_centers(image_shapes=[(1000, 1200), (3008, 3600)],
+    particle_counts=[5, 30], threshold=120, particle_size_threshold=200,
+    particle_upper_size_threshold=5000):
+    '''
+    Compares the single pass get_label_properties with the old loop over the
+    labels, get_x_y, which scans the whole frame once per particle.
+    Labeling is done outside of the measurement.
+
+    Returns
+    -------
+    results : list of dicts
+        One dict per frame size and particle count with the times, peak
+        memory and the largest difference between the centers.
+    '''
+    results = []
+    for image_shape in image_shapes:
+        for nbr_particles in particle_counts:
+            image, _, _ = get_test_frame(image_shape, nbr_particles)
+            separate_particles_image = measure.label(
+                fpt.cv2.medianBlur(image, 5) > threshold)
+            counts = np.bincount(np.ravel(separate_particles_image))
+            counts[0] = 0 # get_x_y would otherwise count the background
+            (x_loop, y_loop), loop_time, loop_peak = run_measured(fpt.get_x_y,
+                counts, particle_upper_size_threshold, particle_size_threshold,
+                separate_particles_image)
+            properties, single_pass_time, single_pass_peak = run_measured(
+                fpt.get_label_properties, separate_particles_image)
+            particles = (particle_upper_size_threshold > properties['area']) & \
+                (properties['area'] > particle_size_threshold)
+            difference = np.max(np.abs(np.concatenate((
+                properties['x'][particles] - x_loop,
+                properties['y'][particles] - y_loop)))) if len(x_loop) else 0
+            result = {
+                'image_shape': image_shape,
+                'nbr_particles': int(np.sum(particles)),
+                'loop_time': loop_time,
+                'loop_peak_memory': loop_peak,
+                'single_pass_time': single_pass_time,
+                'single_pass_peak_memory': single_pass_peak,
+                'max_difference': float(difference),
+            }
+            print(image_shape, result['nbr_particles'], 'particles, loop:',
+                  round(loop_time, 4), 's single pass:',
+                  round(single_pass_time, 4), 's difference:', difference)
+            results.append(result)
+    return results
+
+
+def get_test_sequence(image_shape=(3008, 3600), nbr_particles=30,
+    nbr_frames=40, step=2, seed=0):
+    '''
+    Frames of particles diffusing with a standard deviation of step pixels
+    per frame and per axis.
+
+    Returns
+    -------
+    frames : list of uint8 arrays
+    positions : list of (x, y) tuples
+        True positions of the particles in each frame.
+    '''
+    random_state = np.random.RandomState(seed)
+    _, x, y = get_test_frame(image_shape, nbr_particles, seed=seed)
+    margin = 50
+    frames = []
+    positions = []
+    for _ in range(nbr_frames):
+        x = np.clip(x + random_state.normal(0, step, nbr_particles), margin,
+                    image_shape[1] - margin)
+        y = np.clip(y + random_state.normal(0, step, nbr_particles), margin,
+                    image_shape[0] - margin)
+        frame, _, _ = get_test_frame(image_shape, seed=seed, x=x, y=y)
+        frames.append(frame)
+        positions.append((x, y))
+    return frames, positions
+
+
+def benchmark_ROI_tracking(image_shape=(3008, 3600), particle_counts=[3, 30],
+    nbr_frames=40, step=2, threshold=120, particle_size_threshold=200,
+    particle_upper_size_threshold=5000, half_width=50, margin=30,
+    full_frame_interval=20):
+    '''
+    Compares tracking with ROITracker to detecting the particles in every
+    full frame, on sequences of diffusing particles.
+
+    Returns
+    -------
+    results : list of dicts
+        One dict per particle count with the mean times per frame, the
+        number of full frame scans and the largest difference between the
+        positions found by the two methods.
+    '''
+    def detect(image):
+        x, y, _ = fpt.find_particle_centers(image, threshold,
+            particle_size_threshold, particle_upper_size_threshold)
+        return x, y
+
+    results = []
+    for nbr_particles in particle_counts:
+        frames, _ = get_test_sequence(image_shape, nbr_particles, nbr_frames,
+                                      step)
+        tracker = ROITracker(detect, half_width, margin, full_frame_interval)
+        full_frame_time = 0
+        ROI_time = 0
+        difference = 0
+        for frame in frames:
+            start = time()
+            x_full, y_full = detect(frame)
+            full_frame_time += time() - start
+            start = time()
+            x, y = tracker.track(frame)
+            ROI_time += time() - start
+            if len(x) != len(x_full):
+                difference = np.inf
+            elif len(x) > 0:
+                distances = np.hypot(np.subtract.outer(x, x_full),
+                                     np.subtract.outer(y, y_full))
+                difference = max(difference, np.max(np.min(distances, axis=1)))
+        result = {
+            'image_shape': image_shape,
+            'nbr_particles': nbr_particles,
+            'full_frame_time': full_frame_time / nbr_frames,
+            'ROI_time': ROI_time / nbr_frames,
+            'full_frame_scans': tracker.full_frame_scans,
+            'max_difference': float(difference),
+        }
+        print(nbr_particles, 'particles, full frame:',
+              round(result['full_frame_time'], 4), 's ROI:',
+              round(result['ROI_time'], 4), 's full scans:',
+              tracker.full_frame_scans, 'difference:', difference)
+        results.append(result)
+    return results
+
+
+def benchmark_linking(particle_counts=[10, 100, 500], nbr_frames=100,
+    step=1, speed=3, missed_fraction=0.02, max_distance=15, seed=0):
+    '''
+    Times ParticleLinker on particles moving with random constant velocities
+    and diffusing with a standard deviation of step pixels per frame. A
+    fraction missed_fraction of the particles is left out of each frame.
+
+    Returns
+    -------
+    results : list of dicts
+        One dict per particle count with the mean time per frame and the
+        number of times a particle got a different ID than in the frame
+        before it was last seen.
+    '''
+    random_state = np.random.RandomState(seed)
+    results = []
+    for nbr_particles in particle_counts:
+        x = random_state.uniform(0, 3600, nbr_particles)
+        y = random_state.uniform(0, 3008, nbr_particles)
+        vx = random_state.normal(0, speed, nbr_particles)
+        vy = random_state.normal(0, speed, nbr_particles)
+        linker = ParticleLinker(max_distance, diffusion=step**2/2,
+            acceleration_noise=0.01, initial_velocity_std=2*speed)
+        last_ids = {}
+        id_switches = 0
+        link_time = 0
+        for _ in range(nbr_frames):
+            x += vx + random_state.normal(0, step, nbr_particles)
+            y += vy + random_state.normal(0, step, nbr_particles)
+            seen = np.flatnonzero(random_state.uniform(size=nbr_particles) >=
+                                  missed_fraction)
+            seen = random_state.permutation(seen)
+            start = time()
+            ids = linker.link(x[seen], y[seen])
+            link_time += time() - start
+            for particle, track_id in zip(seen, ids):
+                if last_ids.get(particle, track_id) != track_id:
+                    id_switches += 1
+                last_ids[particle] = track_id
+        result = {
+            'nbr_particles': nbr_particles,
+            'link_time': link_time / nbr_frames,
+            'id_switches': id_switches,
+        }
+        print(nbr_particles, 'particles, linking:', round(result['link_time'],
+              5), 's per frame, ID switches:', id_switches)
+        results.append(result)
+    return results
+
+
+def simulate_catch(use_prediction, speed=40, latency=0.3,
+    frame_interval=0.05, diffusion=20, threshold=10, frames_between_moves=6,
+    max_moves=30, random_state=None):
+    '''
+    Simulates catching a drifting particle as in catch_particle. Every
+    frames_between_moves frames, unless a move is pending, the stage is moved
+    so that the particle ends up in the trap at the origin. Moves take effect
+    latency seconds after they are commanded.
+
+    Parameters
+    ----------
+    use_prediction : bool
+        Aim at the position predicted by ParticleLinker for the time the move
+        takes effect instead of the last detected position.
+    speed : float
+        Drift speed of the particle in pixels/s.
+    diffusion : float
+        Diffusion constant of the particle in pixels^2/s.
+    threshold : float
+        The particle is caught when it is within threshold pixels of the trap.
+
+    Returns
+    -------
+    nbr_moves : int
+        Number of moves needed, max_moves if the particle was not caught.
+    '''
+    random_state = np.random if random_state is None else random_state
+    angle = random_state.uniform(0, 2*np.pi)
+    velocity = speed * np.array([np.cos(angle), np.sin(angle)])
+    position = random_state.uniform(-200, 200, 2)
+    linker = ParticleLinker(diffusion=diffusion, acceleration_noise=1,
+                            initial_velocity_std=2*speed)
+    now = 0
+    frame = 0
+    nbr_moves = 0
+    pending_move = None # (time when it takes effect, displacement)
+    while nbr_moves < max_moves:
+        now += frame_interval
+        frame += 1
+        position += velocity * frame_interval + random_state.normal(0,
+            np.sqrt(2 * diffusion * frame_interval), 2)
+        if pending_move is not None and pending_move[0] <= now:
+            position += pending_move[1]
+            pending_move = None
+        detected = position + random_state.normal(0, 1, 2)
+        ids = linker.link([detected[0]], [detected[1]], now)
+        if pending_move is not None:
+            continue
+        if np.hypot(position[0], position[1]) < threshold:
+            break
+        if frame % frames_between_moves == 0:
+            target = detected
+            if use_prediction:
+                target = np.ravel(linker.predict(ids, now + latency))
+            pending_move = (now + latency, -target)
+            nbr_moves += 1
+    return nbr_moves
+
+
+def benchmark_catching(nbr_trials=200, speeds=[10, 40], seed=0, **options):
+    '''
+    Mean number of moves needed to catch a drifting particle when aiming at
+    the last detected and at the predicted position, see simulate_catch for
+    the options.
+    '''
+    results = []
+    for speed in speeds:
+        result = {'speed': speed}
+        for use_prediction in [False, True]:
+            random_state = np.random.RandomState(seed)
+            moves = [simulate_catch(use_prediction, speed,
+                                    random_state=random_state, **options)
+                     for _ in range(nbr_trials)]
+            result['predicted_moves' if use_prediction else 'moves'] = \
+                float(np.mean(moves))
+        print('Speed', speed, 'pixels/s, moves per catch:', result['moves'],
+              'with prediction:', result['predicted_moves'])
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_particle_centers()
+    benchmark_ROI_tracking()
+    benchmark_linking()
+    benchmark_catching()